@@ -1,24 +1,11 @@
 import cv2
 import os
 
-def extract_26_frames(video_path, output_folder):
-    # Create output folder if it doesn't exist
-    os.makedirs(output_folder, exist_ok=True)
-    
-    # Get output path
-    output_filename = os.path.basename(video_path)
-    output_path = os.path.join(output_folder, output_filename)
-    
-    # Open the video file
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)  # Frames per second
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    
-    # Ensure the video is valid
-    if not cap.isOpened():
-        print(f"Error: Unable to process video {video_path}")
-        return
-    
+def select_frame_indices(total_frames):
+    """
+    Pick the 26 frame indices kept from a video of total_frames frames:
+    the first 3, the last 3 and 20 evenly spaced middle frames
+    """
     # Always include the first 3 and last 3 frames
     first_frames = list(range(0, min(3, total_frames)))
     last_frames = list(range(max(total_frames - 3, 0), total_frames))
@@ -35,7 +22,32 @@ def extract_26_frames(video_path, output_folder):
         middle_frames = [int(middle_start + i * gap) for i in range(middle_frame_count)]
 
     # Combine all selected frames
-    frame_indices = sorted(set(first_frames + middle_frames + last_frames))
+    return sorted(set(first_frames + middle_frames + last_frames))
+
+def extract_26_frames(video_path, output_folder, output_filename=None):
+    """
+    Write the 26 selected frames of video_path to output_folder.
+    Returns the path of the clipped video, or None if it could not be made.
+    """
+    # Create output folder if it doesn't exist
+    os.makedirs(output_folder, exist_ok=True)
+    
+    # Get output path
+    if output_filename is None:
+        output_filename = os.path.basename(video_path)
+    output_path = os.path.join(output_folder, output_filename)
+    
+    # Open the video file
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)  # Frames per second
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    
+    # Ensure the video is valid
+    if not cap.isOpened():
+        print(f"Error: Unable to process video {video_path}")
+        return None
+    
+    frame_indices = select_frame_indices(total_frames)
 
     # Prepare to save video
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -48,7 +60,7 @@ def extract_26_frames(video_path, output_folder):
         if not out.isOpened():
             print(f"Error: Could not create output file for {video_path}")
             cap.release()
-            return
+            return None
             
         # Read and save selected frames
         frame_counter = 0
@@ -70,6 +82,7 @@ def extract_26_frames(video_path, output_folder):
             print(f"Successfully extracted 26 frames to {output_path}")
         else:
             print(f"Warning: Only wrote {frames_written} frames to {output_path}")
+        return output_path if frames_written else None
                 
     except Exception as e:
         print(f"Error processing {video_path}: {str(e)}")
@@ -77,8 +90,10 @@ def extract_26_frames(video_path, output_folder):
             out.release()
         if 'cap' in locals():
             cap.release()
+        return None
 
 def clip26frames(input_folder):
+    """Clip every video in input_folder; returns the paths written"""
     # Create Results directory at the same level as input folder
     results_dir = os.path.join(os.path.dirname(input_folder), "Results")
     os.makedirs(results_dir, exist_ok=True)
@@ -99,7 +114,11 @@ def clip26frames(input_folder):
     os.makedirs(output_folder, exist_ok=True)
     
     # Process all videos in the input folder
+    clipped_paths = []
     for video_file in os.listdir(input_folder):
         if video_file.endswith(('.mp4', '.avi', '.mov')):
             video_path = os.path.join(input_folder, video_file)
-            extract_26_frames(video_path, output_folder)
+            clipped_path = extract_26_frames(video_path, output_folder)
+            if clipped_path:
+                clipped_paths.append(clipped_path)
+    return clipped_paths
@@ -1,5 +1,7 @@
 import os
+import sys
 import json
+import logging
 import cv2
 import pandas as pd
 import warnings
@@ -7,9 +9,25 @@ import threading
 import torch
 import time
 import gc
+from dataclasses import dataclass
 from mmpose.apis import MMPoseInferencer
 from mmpose.utils import register_all_modules
 
+try:
+    import metrics
+except ImportError:  # run as a script from this folder, without the repo root on the path
+    metrics = None
+
+try:
+    from stage_cache import file_digest
+    from log_utils import configure_logging
+except ImportError:  # same, stage_cache and log_utils are in the repo root
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from stage_cache import file_digest
+    from log_utils import configure_logging
+
+logger = logging.getLogger(__name__)
+
 # Suppress specific tkinter warnings
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
@@ -18,93 +36,194 @@ threading_lock = threading.Lock()
 
 register_all_modules()
 
+# 3D pose model used by Infer3D, part of the stage cache key for pose outputs
+POSE3D_MODEL = 'human3d'
+
+@dataclass
+class KeypointsOutput:
+    """Paths written by Infer3D for one video"""
+    folder: str
+    json_path: str
+    csv_path: str
+
+    @classmethod
+    def for_video(cls, output_base_folder, video_name):
+        """Where Infer3D writes the keypoints of video_name"""
+        folder = os.path.join(output_base_folder, video_name)
+        return cls(
+            folder,
+            os.path.join(folder, f"{video_name}_keypoints.json"),
+            os.path.join(folder, f"{video_name}_keypoints.csv")
+        )
+
+    @property
+    def source_path(self):
+        """Sidecar recording the digest of the video the keypoints came from"""
+        return os.path.splitext(self.json_path)[0] + '.source'
+
+    def is_current(self, video_path):
+        """
+        True if keypoints exist for this exact video content. Outputs without
+        a recorded source digest cannot be checked and count as stale.
+        """
+        if not os.path.exists(self.json_path) or not os.path.exists(self.source_path):
+            return False
+        with open(self.source_path) as f:
+            return f.read().strip() == file_digest(video_path)
+
 class Infer3D:
-    def __init__(self, device='cuda'):
-        """Initialize with specific threading and warning handling"""
+    def __init__(self, device='cuda', inferencer=None):
+        """
+        Initialize with specific threading and warning handling
+
+        inferencer: Ready-made inferencer to use instead of loading
+            MMPoseInferencer, called like one (e.g. a benchmark stub)
+        """
+        if inferencer is not None:
+            self.inferencer = inferencer
+            self.device = device if device != 'cuda' or torch.cuda.is_available() else 'cpu'
+            return
+
         # Check if CUDA is available
         if device == 'cuda' and not torch.cuda.is_available():
-            print("WARNING: CUDA is not available, falling back to CPU")
+            logger.warning("CUDA is not available, falling back to CPU")
             device = 'cpu'
         
         # Print device information
         if device == 'cuda':
             gpu_name = torch.cuda.get_device_name(0)
-            print(f"\nUsing GPU: {gpu_name}")
-            print(f"CUDA Version: {torch.version.cuda}")
             
             # Get available GPU memory
             total_mem = torch.cuda.get_device_properties(0).total_memory / (1024 ** 3)  # GB
             free_mem = torch.cuda.memory_reserved(0) / (1024 ** 3)  # GB
-            print(f"GPU Memory: {total_mem:.2f} GB total, {free_mem:.2f} GB reserved")
+            logger.info("Using GPU: %s (CUDA %s), %.2f GB total, %.2f GB reserved",
+                        gpu_name, torch.version.cuda, total_mem, free_mem)
         else:
-            print("\nUsing CPU for inference (this will be slower)")
+            logger.info("Using CPU for inference (this will be slower)")
         
+        start = time.perf_counter()
         with threading_lock:
-            self.inferencer = MMPoseInferencer(pose3d='human3d', device=device)
+            self.inferencer = MMPoseInferencer(pose3d=POSE3D_MODEL, device=device)
+        if metrics:
+            metrics.inc('penalty_model_loads_total', model='pose3d')
+            metrics.observe('penalty_model_load_seconds', time.perf_counter() - start, model='pose3d')
             
         self.device = device
         
-    def infer_frame(self, frame, frame_idx, output_folder, return_vis=False, save_vis=False):
+    def infer_frame(self, frame, frame_idx, output_folder, return_vis=False, save_vis=False, vis_frames=None):
         """
         Infer keypoints on a single frame with better error handling
+
+        If vis_frames is a list, the BGR visualization is appended to it
+        instead of (or as well as) being written to disk
         """
+        start = time.perf_counter()
         try:
             with threading_lock:
                 result_generator = self.inferencer(frame, return_vis=return_vis)
                 result = next(result_generator)
+            if metrics:
+                metrics.observe('penalty_pose_frame_seconds', time.perf_counter() - start)
+                metrics.inc('penalty_pose_frames_total', result='ok')
 
             # Access the predictions for the current frame
             predictions = result.get('predictions', [])[0]
             
-            if save_vis and return_vis:
+            if return_vis and (save_vis or vis_frames is not None):
                 visualization = result.get('visualization', [None])[0]
                 if visualization is not None:
+                    visualization = cv2.cvtColor(visualization, cv2.COLOR_RGB2BGR)
+                    if vis_frames is not None:
+                        vis_frames.append(visualization)
+                if visualization is not None and save_vis:
                     vis_path = os.path.join(output_folder, f"frame_{frame_idx:04d}.jpg")
                     # Use try-except for visualization saving
                     try:
-                        cv2.imwrite(vis_path, cv2.cvtColor(visualization, cv2.COLOR_RGB2BGR))
+                        cv2.imwrite(vis_path, visualization)
                     except Exception as e:
-                        print(f"Warning: Could not save visualization for frame {frame_idx}: {e}")
+                        logger.warning("Could not save visualization for frame %d: %s", frame_idx, e)
 
             return predictions
             
         except Exception as e:
-            print(f"Warning: Error processing frame {frame_idx}: {e}")
+            logger.warning("Error processing frame %d: %s", frame_idx, e)
+            if metrics:
+                metrics.inc('penalty_pose_frames_total', result='failed')
             return None
 
-    def process_video(self, video_path, output_base_folder, return_vis=True, save_vis=False):
-        """Process a single video with improved error handling"""
+    def process_video(self, video_path, output_base_folder, return_vis=True, save_vis=False, progress=None):
+        """
+        Process a single video with improved error handling.
+        Returns a KeypointsOutput, or None on failure. progress, if given,
+        is called as progress(frames_done, total_frames) after each frame.
+        """
         video_name = os.path.splitext(os.path.basename(video_path))[0]
-        video_output_folder = os.path.join(output_base_folder, video_name)
+        output = KeypointsOutput.for_video(output_base_folder, video_name)
+        video_output_folder = output.folder
         
-        # Check if video was already processed
-        json_path = os.path.join(video_output_folder, f"{video_name}_keypoints.json")
-        if os.path.exists(json_path):
-            print(f"Video {video_name} already processed. Skipping.")
-            return video_output_folder
+        # Check if this exact video was already processed
+        if output.is_current(video_path):
+            logger.info("Video %s already processed. Skipping.", video_name)
+            return output
+        if os.path.exists(output.json_path):
+            logger.info("Keypoints of video %s are stale or unverified. Reprocessing.", video_name)
             
         os.makedirs(video_output_folder, exist_ok=True)
 
         cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
-            print(f"Error: Could not open video {video_path}")
+            logger.error("Could not open video %s", video_path)
             return None
 
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        try:
+            keypoints_list = self._infer_frames(
+                _read_frames(cap), total_frames, video_name, video_output_folder,
+                return_vis=return_vis, save_vis=save_vis, progress=progress
+            )
+        finally:
+            cap.release()
+
+        return self._save_keypoints(keypoints_list, video_output_folder, video_name,
+                                    source_digest=file_digest(video_path))
+
+    def process_frames(self, frames, video_name, output_base_folder, return_vis=True, save_vis=False, vis_frames=None,
+                       progress=None):
+        """
+        Process frames that are already decoded in memory, e.g. the 26 frames
+        picked by the in-process pipeline. Keypoints are saved the same way as
+        process_video. Returns (KeypointsOutput, keypoints list); both are
+        None if inference stopped before the last frame or saving failed.
+        """
+        video_output_folder = os.path.join(output_base_folder, video_name)
+        os.makedirs(video_output_folder, exist_ok=True)
+
+        keypoints_list = self._infer_frames(
+            iter(frames), len(frames), video_name, video_output_folder,
+            return_vis=return_vis, save_vis=save_vis, vis_frames=vis_frames, progress=progress
+        )
+        # A partial sequence would be padded and classified as if it were complete
+        if len(keypoints_list) != len(frames):
+            logger.error("Inference stopped after %d of %d frames of %s",
+                         len(keypoints_list), len(frames), video_name)
+            return None, None
+        return self._save_keypoints(keypoints_list, video_output_folder, video_name), keypoints_list
+
+    def _infer_frames(self, frames, total_frames, video_name, video_output_folder, return_vis=True, save_vis=False, vis_frames=None,
+                      progress=None):
+        """Run inference over an iterator of frames and collect 17 keypoints per frame"""
         frame_idx = 0
         keypoints_list = []
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
-        print(f"\nProcessing {video_name} ({total_frames} frames)")
+        logger.info("Processing %s (%d frames)", video_name, total_frames)
         start_time = time.time()
+        next_progress_log = start_time
         
         try:
-            while cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
-                    break
-
-                # Show progress with time estimate
-                if frame_idx % 5 == 0:  # Update progress every 5 frames
+            for frame in frames:
+                # Log progress with time estimate, at most every couple of seconds
+                if frame_idx and time.time() >= next_progress_log and logger.isEnabledFor(logging.INFO):
+                    next_progress_log = time.time() + 2.0
                     elapsed = time.time() - start_time
                     frames_per_second = frame_idx / elapsed if elapsed > 0 else 0
                     remaining_frames = total_frames - frame_idx
@@ -113,14 +232,16 @@ class Infer3D:
                     minutes, seconds = divmod(eta_seconds, 60)
                     hours, minutes = divmod(minutes, 60)
                     
-                    progress = (frame_idx / total_frames) * 100
+                    percent = (frame_idx / total_frames) * 100
                     eta_str = f"{int(hours):02d}:{int(minutes):02d}:{int(seconds):02d}"
                     
-                    print(f"\rProgress: {progress:.1f}% (Frame {frame_idx}/{total_frames}) | FPS: {frames_per_second:.1f} | ETA: {eta_str}", end="")
+                    logger.info("Progress: %.1f%% (Frame %d/%d) | FPS: %.1f | ETA: %s",
+                                percent, frame_idx, total_frames, frames_per_second, eta_str)
 
                 # Infer on the frame
                 predictions = self.infer_frame(
-                    frame, frame_idx, video_output_folder, return_vis=return_vis, save_vis=save_vis
+                    frame, frame_idx, video_output_folder, return_vis=return_vis, save_vis=save_vis,
+                    vis_frames=vis_frames
                 )
 
                 # Process keypoints
@@ -132,28 +253,43 @@ class Infer3D:
                 
                 keypoints_list.append(frame_keypoints)
                 frame_idx += 1
+                if progress:
+                    progress(frame_idx, total_frames)
                 
                 # Clear CUDA cache periodically to prevent memory leaks
                 if self.device == 'cuda' and frame_idx % 10 == 0:
                     torch.cuda.empty_cache()
 
         except Exception as e:
-            print(f"\nError processing video {video_name}: {e}")
+            logger.error("Error processing video %s: %s", video_name, e)
         finally:
-            cap.release()
             total_time = time.time() - start_time
-            print(f"\nFinished processing {frame_idx} frames in {total_time:.2f} seconds ({frame_idx/total_time:.1f} FPS)")
+            logger.info("Finished processing %d frames in %.2f seconds (%.1f FPS)",
+                        frame_idx, total_time, frame_idx / total_time if total_time > 0 else 0)
 
-        # Save keypoints
+        return keypoints_list
+
+    def _save_keypoints(self, keypoints_list, video_output_folder, video_name, source_digest=None):
+        """
+        Save keypoints as JSON and CSV in video_output_folder, plus the source
+        video digest when known; returns a KeypointsOutput
+        """
+        output = KeypointsOutput.for_video(os.path.dirname(video_output_folder), video_name)
+        json_path, csv_path = output.json_path, output.csv_path
         try:
             with open(json_path, 'w') as f:
                 json.dump(keypoints_list, f, indent=2)
 
-            csv_path = os.path.join(video_output_folder, f"{video_name}_keypoints.csv")
             df = pd.DataFrame(keypoints_list)
             df.to_csv(csv_path, index=False)
 
-            print(f"Saved keypoints to {video_output_folder}")
+            if source_digest:
+                with open(output.source_path, 'w') as f:
+                    f.write(source_digest)
+            elif os.path.exists(output.source_path):
+                os.remove(output.source_path)
+
+            logger.info("Saved keypoints to %s", video_output_folder)
             
             # Force garbage collection
             keypoints_list = None
@@ -162,12 +298,20 @@ class Infer3D:
             if self.device == 'cuda':
                 torch.cuda.empty_cache()
                 
-            return video_output_folder
+            return output
 
         except Exception as e:
-            print(f"Error saving keypoints for {video_name}: {e}")
+            logger.error("Error saving keypoints for %s: %s", video_name, e)
             return None
 
+def _read_frames(cap):
+    """Yield frames from an open capture until it runs out"""
+    while cap.isOpened():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield frame
+
 def process_all_videos(input_folder, output_base_folder, return_vis=True, save_vis=False):
     """Process all videos with better progress tracking"""
     infer3d = Infer3D()
@@ -177,7 +321,7 @@ def process_all_videos(input_folder, output_base_folder, return_vis=True, save_v
     videos = []
     already_processed = []
     
-    print("\nScanning for videos...")
+    logger.info("Scanning for videos in %s", input_folder)
     for root, _, files in os.walk(input_folder):
         for file in files:
             if file.endswith(('.mp4', '.avi', '.mov')):
@@ -185,11 +329,10 @@ def process_all_videos(input_folder, output_base_folder, return_vis=True, save_v
                 rel_path = os.path.relpath(root, input_folder)
                 video_name = os.path.splitext(file)[0]
                 
-                # Check if output exists
+                # Check if output exists for this exact video content
                 video_output_base = os.path.join(output_base_folder, rel_path)
-                json_path = os.path.join(video_output_base, video_name, f"{video_name}_keypoints.json")
                 
-                if os.path.exists(json_path):
+                if KeypointsOutput.for_video(video_output_base, video_name).is_current(video_path):
                     already_processed.append((root, file))
                 else:
                     videos.append((root, file))
@@ -197,28 +340,27 @@ def process_all_videos(input_folder, output_base_folder, return_vis=True, save_v
     total_new = len(videos)
     total_processed = len(already_processed)
     
-    print(f"\nFound {total_new + total_processed} videos:")
-    print(f"- {total_new} new videos to process")
-    print(f"- {total_processed} already processed")
+    logger.info("Found %d videos: %d new, %d already processed",
+                total_new + total_processed, total_new, total_processed)
     
     # Process new videos
     for idx, (root, file) in enumerate(videos, 1):
-        print(f"\nProcessing video {idx}/{total_new}: {file}")
+        logger.info("Processing video %d/%d: %s", idx, total_new, file)
         
         video_path = os.path.join(root, file)
         rel_path = os.path.relpath(root, input_folder)
         video_output_base = os.path.join(output_base_folder, rel_path)
         os.makedirs(video_output_base, exist_ok=True)
         
-        output_folder = infer3d.process_video(
+        keypoints_output = infer3d.process_video(
             video_path, 
             video_output_base,
             return_vis=return_vis,
             save_vis=save_vis
         )
         
-        if output_folder:
-            processed_folders.append(output_folder)
+        if keypoints_output:
+            processed_folders.append(keypoints_output.folder)
     
     # Add already processed folders to the list
     for root, file in already_processed:
@@ -230,6 +372,7 @@ def process_all_videos(input_folder, output_base_folder, return_vis=True, save_v
     return processed_folders
 
 def main():
+    configure_logging()
     # Example usage
     input_folder = "Results"  # Your Results folder containing all processed videos
     output_base_folder = "Keypoints"  # Where keypoint data will be saved
@@ -1,6 +1,66 @@
+import os
+import json
+import shutil
+import tempfile
 import cv2
 import numpy as np
-from GoalkeeperAnimation import GoalkeeperAnimator
+from concurrent.futures import ProcessPoolExecutor
+from GoalkeeperAnimation import GoalkeeperAnimator, animation_sources
+from log_utils import configure_logging
+
+# Goalkeeper animation settings used for every rendered video
+ANIMATION_SPEED = 0.50
+Y_OFFSET_PERCENTAGE = 0.3
+ANIMATIONS_FOLDER = "Fbx Animations"
+# Bump when detect_goal changes so cached goal tracks are recomputed
+GOAL_DETECTOR = 'cieluv-contours-1'
+# Processes the pipeline renders a visualization with; more than 1 renders
+# chunks in parallel
+RENDER_WORKERS = int(os.environ.get('PENALTY_RENDER_WORKERS', 1))
+
+def visualization_settings():
+    """
+    Settings that change the rendered output, used as stage cache
+    parameters. They include the state of the animation frames, so
+    replacing sprites renders anew.
+    """
+    return {
+        'animation_speed': ANIMATION_SPEED,
+        'y_offset_percentage': Y_OFFSET_PERCENTAGE,
+        'animations_folder': ANIMATIONS_FOLDER,
+        'animations': animation_sources(ANIMATIONS_FOLDER)
+    }
+
+def detect_goal_track(frames):
+    """
+    Detect the goal box on every frame. Returns one (x1, y1, x2, y2) box or
+    None per frame; the track does not depend on the prediction, so it can
+    be computed while pose inference and prediction run.
+    """
+    visualizer = GoalVisualizer()
+    return [visualizer.detect_goal(frame) for frame in frames]
+
+def detect_goal_track_video(video_path):
+    """detect_goal_track over a video file, decoding it frame by frame"""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Could not open video file {video_path}")
+        return None
+    try:
+        return detect_goal_track(_read_frames(cap))
+    finally:
+        cap.release()
+
+def save_goal_track(goal_boxes, path):
+    """Write a goal box track as JSON"""
+    with open(path, 'w') as f:
+        json.dump([list(box) if box is not None else None for box in goal_boxes], f)
+    return path
+
+def load_goal_track(path):
+    """Read a goal box track written by save_goal_track"""
+    with open(path) as f:
+        return [tuple(box) if box is not None else None for box in json.load(f)]
 
 class GoalVisualizer:
 
@@ -8,7 +68,7 @@ class GoalVisualizer:
         """
         Initialize the goal visualizer
         """
-        self.goalkeeper = GoalkeeperAnimator(animations_folder="Fbx Animations")
+        self.goalkeeper = GoalkeeperAnimator(animations_folder=ANIMATIONS_FOLDER)
 
     def cieluv(self, img, target):
         """
@@ -93,12 +153,23 @@ class GoalVisualizer:
 
         return frame
 
-def process_video(video_path, output_path, prediction, delay=100):
+def process_video(video_path, output_path, prediction, delay=100, show=True, workers=1, goal_boxes=None,
+                  progress=None):
     """
     Process video with goalkeeper animation based on prediction
     Args:
         prediction: 'left', 'center', or 'right'
+        show: Display frames in a window while rendering
+        workers: Number of processes; more than 1 renders chunks in parallel
+        goal_boxes: Precomputed per-frame goal boxes from detect_goal_track;
+            when given, frames are only composited, not searched for the goal
+        progress: Called as progress(frames_done, total_frames) while
+            rendering; in parallel, as each chunk finishes
     """
+    if workers > 1:
+        return process_video_parallel(video_path, output_path, prediction, workers=workers, goal_boxes=goal_boxes,
+                                      progress=progress)
+
     visualizer = GoalVisualizer()
     
     # Get total frames in the video
@@ -116,20 +187,40 @@ def process_video(video_path, output_path, prediction, delay=100):
     visualizer.goalkeeper.set_animation(
         prediction, 
         total_frames,
-        animation_speed=0.50,  # Play only 50% of the animation
-        y_offset_percentage=0.3  # Position 25% lower
+        animation_speed=ANIMATION_SPEED,  # Play only 50% of the animation
+        y_offset_percentage=Y_OFFSET_PERCENTAGE  # Position 25% lower
     )
     
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
     out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
     
+    _render_loop(visualizer, _read_frames(cap), out, show, delay, goal_boxes, progress, total_frames)
+    
+    cap.release()
+    out.release()
+    if show:
+        cv2.destroyAllWindows()
+
+def _read_frames(cap):
+    """Yield frames from an open capture until it runs out"""
     while cap.isOpened():
         ret, frame = cap.read()
         if not ret:
             break
-            
+        yield frame
+
+def _render_loop(visualizer, frames, out, show=False, delay=1, goal_boxes=None, progress=None, total_frames=None):
+    """
+    Detect the goal, draw the regions and overlay the goalkeeper on each
+    frame. With goal_boxes the detection is skipped and the box for each
+    frame is taken from the track; frames past its end get no overlay.
+    """
+    for frame_idx, frame in enumerate(frames):
         # Detect goal and create visualization
-        goal_box = visualizer.detect_goal(frame)
+        if goal_boxes is None:
+            goal_box = visualizer.detect_goal(frame)
+        else:
+            goal_box = goal_boxes[frame_idx] if frame_idx < len(goal_boxes) else None
         if goal_box is not None:
             # Add goal visualization
             frame = visualizer.divide_goal_area(frame, goal_box)
@@ -137,16 +228,176 @@ def process_video(video_path, output_path, prediction, delay=100):
             frame = visualizer.goalkeeper.overlay_frame(frame, goal_box)
             
         out.write(frame)
+        if progress:
+            progress(frame_idx + 1, total_frames)
+        if not show:
+            continue
         cv2.imshow('Goal Analysis', frame)
         
         if cv2.waitKey(delay) & 0xFF == ord('q'):
             break
-    
+
+# Per-process visualizer used by the chunk-parallel renderer
+_worker_visualizer = None
+
+def _init_chunk_worker():
+    """Create one GoalVisualizer per worker process"""
+    global _worker_visualizer
+    _worker_visualizer = GoalVisualizer()
+
+def _open_at(video_path, start_frame):
+    """
+    Open a video positioned at start_frame. Frames are skipped with grab()
+    instead of CAP_PROP_POS_FRAMES, which is not frame-accurate for mp4v.
+    """
+    cap = cv2.VideoCapture(video_path)
+    for _ in range(start_frame):
+        if not cap.grab():
+            break
+    return cap
+
+def _detect_chunk(video_path, start_frame, end_frame):
+    """Detect the goal box for every frame in [start_frame, end_frame)"""
+    cap = _open_at(video_path, start_frame)
+    goal_boxes = []
+    frame_idx = start_frame
+    while cap.isOpened() and (end_frame is None or frame_idx < end_frame):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        goal_boxes.append(_worker_visualizer.detect_goal(frame))
+        frame_idx += 1
+    cap.release()
+    return goal_boxes
+
+def _render_chunk(video_path, segment_path, prediction, total_frames, start_frame, end_frame, goal_boxes,
+                  animation_offset):
+    """
+    Render the frames in [start_frame, end_frame) into a lossless segment
+    using precomputed goal boxes; frames past the end of goal_boxes get no
+    overlay, as in _render_loop
+    """
+    visualizer = _worker_visualizer
+    visualizer.goalkeeper.set_animation(
+        prediction,
+        total_frames,
+        animation_speed=ANIMATION_SPEED,
+        y_offset_percentage=Y_OFFSET_PERCENTAGE,
+        start_frame=animation_offset
+    )
+
+    cap = _open_at(video_path, start_frame)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+
+    # FFV1 is lossless, so the final mp4v encode sees exactly the serial frames
+    fourcc = cv2.VideoWriter_fourcc(*'FFV1')
+    out = cv2.VideoWriter(segment_path, fourcc, fps, (width, height))
+
+    frames_written = 0
+    while end_frame is None or start_frame + frames_written < end_frame:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        goal_box = goal_boxes[frames_written] if frames_written < len(goal_boxes) else None
+        if goal_box is not None:
+            frame = visualizer.divide_goal_area(frame, goal_box)
+            frame = visualizer.goalkeeper.overlay_frame(frame, goal_box)
+        out.write(frame)
+        frames_written += 1
+
     cap.release()
     out.release()
-    cv2.destroyAllWindows()
+    return frames_written
+
+def process_video_parallel(video_path, output_path, prediction, workers=None, goal_boxes=None, progress=None):
+    """
+    Render the visualization by splitting the frame range into chunks, one
+    per worker process. Output is frame-identical to process_video.
+
+    The animation only advances on frames where a goal is detected, so a
+    first parallel pass detects goal boxes per chunk to work out each
+    chunk's animation offset; with goal_boxes from detect_goal_track that
+    pass is skipped. A second pass renders every chunk to a lossless
+    segment and the segments are concatenated into output_path. progress
+    is called as progress(frames_done, total_frames) as chunks finish.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Could not open video file {video_path}")
+        return
+
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, total_frames)
+    if workers <= 1:
+        return process_video(video_path, output_path, prediction, delay=1, show=False, goal_boxes=goal_boxes,
+                             progress=progress)
+
+    # Chunk boundaries; the last chunk reads until the end of the stream in
+    # case CAP_PROP_FRAME_COUNT is slightly off
+    chunk_size = total_frames // workers
+    starts = [i * chunk_size for i in range(workers)]
+    ends = starts[1:] + [None]
+
+    segment_folder = tempfile.mkdtemp(prefix="goal_viz_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_chunk_worker) as pool:
+            # Pass 1: goal boxes per chunk, unless the track is given
+            if goal_boxes is None:
+                box_chunks = list(pool.map(_detect_chunk, [video_path] * workers, starts, ends))
+            else:
+                box_chunks = [goal_boxes[start:end] for start, end in zip(starts, ends)]
+
+            # Animation offset of each chunk = number of frames with a goal
+            # box before it, which is how far the serial animator would be
+            offsets = []
+            detected = 0
+            for goal_boxes in box_chunks:
+                offsets.append(min(detected, total_frames))
+                detected += sum(1 for box in goal_boxes if box is not None)
+
+            # Pass 2: render segments
+            segment_paths = [os.path.join(segment_folder, f"segment_{i:03d}.avi") for i in range(workers)]
+            frames_done = 0
+            for frames_written in pool.map(
+                _render_chunk,
+                [video_path] * workers,
+                segment_paths,
+                [prediction] * workers,
+                [total_frames] * workers,
+                starts,
+                ends,
+                box_chunks,
+                offsets
+            ):
+                frames_done += frames_written
+                if progress:
+                    progress(frames_done, total_frames)
+
+        # Concatenate segments with a single encode
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        for segment_path in segment_paths:
+            segment = cv2.VideoCapture(segment_path)
+            while True:
+                ret, frame = segment.read()
+                if not ret:
+                    break
+                out.write(frame)
+            segment.release()
+        out.release()
+    finally:
+        shutil.rmtree(segment_folder, ignore_errors=True)
 
 if __name__ == "__main__":
+    configure_logging()
     # Test with each direction
     videos = [
         ("020.mp4", "020_viz.mp4", "right")
@@ -1,6 +1,251 @@
+import argparse
+import json
+import logging
 import cv2
 import numpy as np
 import os
+from collections import OrderedDict
+from log_utils import configure_logging, sample_every
+
+logger = logging.getLogger(__name__)
+
+
+ANIMATION_DIRECTIONS = ('left', 'center', 'right')
+ATLAS_DATA_FILE = 'atlas.bin'
+ATLAS_INDEX_FILE = 'atlas.json'
+ATLAS_ALIGNMENT = 64
+
+# Animations already loaded in this process and the sources they were
+# loaded from, keyed by absolute folder path
+_loaded_animations = {}
+
+
+def load_png_sequence(folder_path):
+    """Load every PNG in folder_path, in name order, keeping the alpha channel"""
+    logger.debug("Loading animation from: %s", folder_path)
+    frames = []
+    if not os.path.exists(folder_path):
+        logger.warning("Animation folder not found: %s", folder_path)
+        return frames
+
+    for file in sorted(os.listdir(folder_path)):
+        if not file.lower().endswith('.png'):
+            continue
+        img = cv2.imread(os.path.join(folder_path, file), cv2.IMREAD_UNCHANGED)
+        if img is not None:
+            frames.append(img)
+        else:
+            logger.error("Failed to load image: %s", file)
+
+    if not frames:
+        logger.warning("No PNG files found in %s", folder_path)
+    else:
+        logger.debug("Loaded %d animation frames from %s", len(frames), folder_path)
+    return frames
+
+
+def animation_sources(animations_folder):
+    """
+    Count, total size and newest modification time of the dive_* PNG
+    frames, which change whenever a frame is added, removed or replaced
+    """
+    files = size = 0
+    newest = 0.0
+    for direction in ANIMATION_DIRECTIONS:
+        folder = os.path.join(animations_folder, f'dive_{direction}')
+        if not os.path.isdir(folder):
+            continue
+        for file in os.listdir(folder):
+            if not file.lower().endswith('.png'):
+                continue
+            stat = os.stat(os.path.join(folder, file))
+            files += 1
+            size += stat.st_size
+            newest = max(newest, stat.st_mtime)
+    return {'files': files, 'bytes': size, 'mtime': newest}
+
+
+def build_animation_atlas(animations_folder):
+    """
+    Pack the dive_* PNG sequences into a single raw atlas file plus a JSON
+    frame index, both written into animations_folder.
+
+    Frames are stored uncompressed and 64-byte aligned so the runtime can
+    memory-map them; every process mapping the atlas shares the same page
+    cache copy.
+    """
+    # The frames the atlas is built from, to tell when it is out of date
+    index = {'format': 1, 'dtype': 'uint8', 'sequences': {}, 'sources': animation_sources(animations_folder)}
+    data_path = os.path.join(animations_folder, ATLAS_DATA_FILE)
+    index_path = os.path.join(animations_folder, ATLAS_INDEX_FILE)
+
+    offset = 0
+    with open(data_path + '.tmp', 'wb') as f:
+        for direction in ANIMATION_DIRECTIONS:
+            entries = []
+            for frame in load_png_sequence(os.path.join(animations_folder, f'dive_{direction}')):
+                frame = np.ascontiguousarray(frame, dtype=np.uint8)
+                padding = -offset % ATLAS_ALIGNMENT
+                f.write(b'\0' * padding)
+                offset += padding
+                entries.append([offset] + list(frame.shape))
+                f.write(frame.tobytes())
+                offset += frame.nbytes
+            index['sequences'][direction] = entries
+
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    # Data first, so a reader never sees an index pointing past the data
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(index_path + '.tmp', index_path)
+
+    counts = ", ".join(f"{d}({len(index['sequences'][d])})" for d in ANIMATION_DIRECTIONS)
+    logger.info("Animation atlas written to %s: %s, %.1f MB", data_path, counts, offset / (1024 * 1024))
+    return data_path
+
+
+def load_animation_atlas(animations_folder):
+    """
+    Memory-map an atlas built by build_animation_atlas. Returns a dict of
+    direction -> list of read-only frame views, or None when the folder has
+    no usable atlas.
+    """
+    data_path = os.path.join(animations_folder, ATLAS_DATA_FILE)
+    index_path = os.path.join(animations_folder, ATLAS_INDEX_FILE)
+    if not (os.path.exists(data_path) and os.path.exists(index_path)):
+        return None
+
+    with open(index_path) as f:
+        index = json.load(f)
+
+    # Fall back to the PNGs if any was added, removed or overwritten after
+    # the atlas was built. A folder's mtime misses frames overwritten in place.
+    sources = animation_sources(animations_folder)
+    if 'sources' in index:
+        stale = index['sources'] != sources
+    else:  # Atlas from before sources were recorded
+        stale = sources['mtime'] > os.path.getmtime(index_path)
+    if stale:
+        logger.warning("Animation atlas in %s is older than its PNG frames; ignoring it", animations_folder)
+        return None
+    data = np.memmap(data_path, dtype=np.uint8, mode='r')
+
+    animations = {}
+    for direction in ANIMATION_DIRECTIONS:
+        frames = []
+        for offset, *shape in index['sequences'].get(direction, []):
+            size = int(np.prod(shape))
+            frames.append(np.asarray(data[offset:offset + size]).reshape(shape))
+        animations[direction] = frames
+    logger.debug("Memory-mapped animation atlas %s", data_path)
+    return animations
+
+
+def load_animations(animations_folder):
+    """
+    Load the dive animations once per process, from the atlas when one is
+    available and from the PNG sequences otherwise
+    """
+    key = os.path.abspath(animations_folder)
+    # Reloaded when frames change, so warm workers render what
+    # Goal_Viz.visualization_settings keys the renders on
+    sources = animation_sources(animations_folder)
+    loaded = _loaded_animations.get(key)
+    if loaded is None or loaded[0] != sources:
+        if not os.path.exists(animations_folder):
+            logger.error("Animations folder '%s' not found (full path: %s)", animations_folder, key)
+        animations = load_animation_atlas(animations_folder)
+        if animations is None:
+            animations = {
+                direction: load_png_sequence(os.path.join(animations_folder, f'dive_{direction}'))
+                for direction in ANIMATION_DIRECTIONS
+            }
+        _loaded_animations[key] = loaded = (sources, animations)
+    return loaded[1]
+
+
+def composite_premultiplied(roi, premultiplied, inv_alpha):
+    """
+    Blend a premultiplied sprite onto roi in place:
+    roi = premultiplied + round(roi * inv_alpha / 255)
+
+    All three channels are blended at once with saturating uint8 cv2
+    arithmetic writing straight into roi, so no per-frame image buffers
+    are allocated and there is no float round trip.
+
+    Args:
+        roi: uint8 (H, W, 3) view into the background frame
+        premultiplied: uint8 (H, W, 3) sprite colour already multiplied by alpha
+        inv_alpha: uint8 (H, W, 3) holding 255 - alpha for every channel
+    """
+    cv2.multiply(roi, inv_alpha, dst=roi, scale=1 / 255.0)
+    cv2.add(roi, premultiplied, dst=roi)
+
+
+class SpriteCache:
+    """
+    LRU cache of animation frames pre-scaled to a goal width.
+
+    Entries are keyed by (direction, animation frame index, quantized width)
+    and hold a (premultiplied BGR, inverse alpha) pair, so steady-state
+    overlay does no resizing and no per-pixel alpha multiply of the sprite.
+    """
+
+    def __init__(self, max_entries=64, width_step=8):
+        """
+        Args:
+            max_entries: Number of scaled sprites kept before evicting the
+                least recently used one
+            width_step: Goal widths are rounded to a multiple of this many
+                pixels so small detection jitter reuses the same sprite
+        """
+        self.max_entries = max_entries
+        self.width_step = width_step
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def quantize_width(self, width):
+        """Round a target width to the cache's width step"""
+        return max(self.width_step, int(round(width / self.width_step)) * self.width_step)
+
+    def get(self, direction, frame_idx, anim_frame, target_width):
+        """Return (premultiplied, inv_alpha) for anim_frame scaled to target_width"""
+        key = (direction, frame_idx, self.quantize_width(target_width))
+        sprite = self._entries.get(key)
+        if sprite is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return sprite
+
+        self.misses += 1
+        sprite = self._prepare(anim_frame, key[2])
+        self._entries[key] = sprite
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return sprite
+
+    def stats(self):
+        """Hit/miss counters and current size"""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def clear(self):
+        self._entries.clear()
+
+    @staticmethod
+    def _prepare(anim_frame, width):
+        """Resize a BGRA frame and premultiply its colour by alpha"""
+        height = int(anim_frame.shape[0] * width / anim_frame.shape[1])
+        scaled = cv2.resize(anim_frame, (width, height))
+        if scaled.ndim != 3 or scaled.shape[2] != 4:
+            logger.warning("Animation frame has no alpha channel, shape: %s", anim_frame.shape)
+            return scaled, None
+
+        alpha = scaled[:, :, 3:4].astype(np.uint16)
+        premultiplied = ((scaled[:, :, :3] * alpha + 127) // 255).astype(np.uint8)
+        inv_alpha = np.repeat(255 - scaled[:, :, 3:4], 3, axis=2)
+        return premultiplied, inv_alpha
+
 
 class GoalkeeperAnimator:
     def __init__(self, animations_folder="Fbx Animations"):
@@ -11,86 +256,31 @@ class GoalkeeperAnimator:
         - dive_center/
         - dive_right/
         Each folder containing PNG sequence of the animation
+
+        If the folder also holds an atlas built with build_animation_atlas,
+        the sequences are memory-mapped from it instead of decoded from PNG.
+        Loaded animations are shared by every animator in the process.
         """
-        # Print current working directory to debug
-        print(f"[DEBUG] GoalkeeperAnimator: Initializing with folder '{animations_folder}'")
-        print(f"[DEBUG] Current working directory: {os.getcwd()}")
-        
-        # Check if the animations folder exists
-        if not os.path.exists(animations_folder):
-            print(f"[ERROR] Animations folder '{animations_folder}' not found!")
-            print(f"[ERROR] Full path: {os.path.abspath(animations_folder)}")
-        else:
-            print(f"[DEBUG] Found animations folder: {os.path.abspath(animations_folder)}")
-            # List contents of the folder
-            print(f"[DEBUG] Contents of {animations_folder}:")
-            for item in os.listdir(animations_folder):
-                item_path = os.path.join(animations_folder, item)
-                if os.path.isdir(item_path):
-                    print(f"[DEBUG]   - {item}/ (directory with {len(os.listdir(item_path))} files)")
-                else:
-                    print(f"[DEBUG]   - {item} (file)")
-        
-        print(f"[DEBUG] Loading animations from {animations_folder}...")
-        self.animations = {
-            'left': self._load_animation(os.path.join(animations_folder, 'dive_left')),
-            'center': self._load_animation(os.path.join(animations_folder, 'dive_center')),
-            'right': self._load_animation(os.path.join(animations_folder, 'dive_right'))
-        }
-        print(f"[DEBUG] Loaded animations: left({len(self.animations['left'])}), center({len(self.animations['center'])}), right({len(self.animations['right'])})")
+        self.animations = load_animations(animations_folder)
+        logger.debug("Loaded animations from '%s': left(%d), center(%d), right(%d)", animations_folder,
+                     len(self.animations['left']), len(self.animations['center']), len(self.animations['right']))
         
+        self.current_direction = None
         self.current_animation = None
         self.current_frame = 0
         self.total_video_frames = 0
         self.current_video_frame = 0
         self.animation_speed = 0.60  # Play only 50% of the animation
         self.y_offset_percentage = 0.30  # Move animation 25% lower
-        print(f"[DEBUG] GoalkeeperAnimator initialized successfully")
+        self.sprite_cache = SpriteCache()
+        # Per-frame debug logging, resolved once per animation in set_animation
+        self._debug_every = 0
     
     def _load_animation(self, folder_path):
         """Load PNG sequence from folder"""
-        print(f"[DEBUG] Loading animation from: {folder_path}")
-        frames = []
-        if not os.path.exists(folder_path):
-            print(f"[WARNING] Animation folder not found: {folder_path}")
-            return frames
-
-        # List all files in the folder to debug
-        print(f"[DEBUG] Contents of {folder_path}:")
-        file_count = 0
-        for file in sorted(os.listdir(folder_path)):
-            file_path = os.path.join(folder_path, file)
-            file_size = os.path.getsize(file_path) / 1024  # Size in KB
-            print(f"[DEBUG]   - {file} ({file_size:.1f} KB)")
-            file_count += 1
-            if file_count > 10:
-                print(f"[DEBUG]   ... and {len(os.listdir(folder_path)) - 10} more files")
-                break
-            
-            # Check if it's a PNG with correct case
-            if file.lower().endswith('.png'):
-                img_path = os.path.join(folder_path, file)
-                print(f"[DEBUG] Attempting to load image: {file}")
-                img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-                if img is not None:
-                    print(f"[DEBUG]    Successfully loaded image: {file} (shape: {img.shape})")
-                    frames.append(img)
-                else:
-                    print(f"[ERROR]    Failed to load image: {file}")
-        
-        if not frames:
-            print(f"[WARNING] No PNG files found in {folder_path}")
-            # Check for case sensitivity issues
-            png_files = [f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.PNG'))]
-            if png_files:
-                print(f"[DEBUG]  However, found these potential PNG files: {png_files}")
-                print(f"[DEBUG]  Check file extensions - they should be lowercase .png")
-        else:
-            print(f"[DEBUG] Loaded {len(frames)} animation frames from {folder_path}")
-            
-        return frames
+        return load_png_sequence(folder_path)
 
-    def set_animation(self, direction, total_video_frames=None, animation_speed=0.5, y_offset_percentage=0.25):
+    def set_animation(self, direction, total_video_frames=None, animation_speed=0.5, y_offset_percentage=0.25, start_frame=0):
         """
         Set current animation based on prediction and video length
         
@@ -99,35 +289,41 @@ class GoalkeeperAnimator:
             total_video_frames: Total number of frames in the video
             animation_speed: Speed factor (0.5 = play 50% of animation)
             y_offset_percentage: How much lower to position the animation (0.25 = 25% lower)
+            start_frame: Number of overlaid frames already rendered, used when
+                rendering a video in chunks
         """
-        print(f"[DEBUG] Setting animation to '{direction}' with {total_video_frames} frames")
         if direction not in self.animations:
-            print(f"[WARNING] Unknown direction '{direction}'. Using 'center'")
+            logger.warning("Unknown direction '%s'. Using 'center'", direction)
             direction = 'center'
             
+        self.current_direction = direction
         self.current_animation = self.animations[direction]
-        self.current_frame = 0
-        self.current_video_frame = 0
+        self.current_frame = start_frame
+        self.current_video_frame = start_frame
         self.animation_speed = animation_speed
         self.y_offset_percentage = y_offset_percentage
         
         # Set total video frames if provided
         if total_video_frames is not None:
             self.total_video_frames = total_video_frames
-            print(f"[DEBUG] Animation will play at {animation_speed*100}% speed over {total_video_frames} video frames")
-            print(f"[DEBUG] Animation will be positioned {y_offset_percentage*100}% lower")
         
-        print(f"[DEBUG] Set animation to '{direction}' ({len(self.current_animation)} frames)")
+        # Hot-path debug messages are sampled, and skipped entirely with one
+        # integer check per frame when DEBUG is disabled
+        self._debug_every = sample_every() if logger.isEnabledFor(logging.DEBUG) else 0
+        logger.debug("Set animation to '%s' (%d frames) over %s video frames, %.0f%% speed, %.0f%% lower",
+                     direction, len(self.current_animation), total_video_frames,
+                     animation_speed * 100, y_offset_percentage * 100)
     
     def overlay_frame(self, background, goal_box):
         """
         Overlay current animation frame on background, with adjusted position and speed
         """
+        debug = self._debug_every and self.current_video_frame % self._debug_every == 0
         if (self.current_animation is None or 
             not self.current_animation or 
             self.current_video_frame >= self.total_video_frames):
-            if self.current_video_frame >= self.total_video_frames:
-                print(f"[DEBUG] Reached end of animation: frame {self.current_video_frame}/{self.total_video_frames}")
+            if debug and self.current_video_frame >= self.total_video_frames:
+                logger.debug("Reached end of animation: frame %d/%d", self.current_video_frame, self.total_video_frames)
             return background
             
         # Calculate which animation frame to use based on video progress and speed
@@ -137,20 +333,23 @@ class GoalkeeperAnimator:
             frame_idx = min(int(animation_progress * len(self.current_animation)), 
                            len(self.current_animation) - 1)
             
-            # Print debug info every 5 frames
-            if self.current_video_frame % 5 == 0:
-                print(f"[DEBUG] Overlay frame {self.current_video_frame}/{self.total_video_frames}, " 
-                      f"animation frame {frame_idx}/{len(self.current_animation)-1}, "
-                      f"progress: {animation_progress:.2f}")
+            if debug:
+                logger.debug("Overlay frame %d/%d, animation frame %d/%d, progress: %.2f",
+                             self.current_video_frame, self.total_video_frames,
+                             frame_idx, len(self.current_animation) - 1, animation_progress)
                 
             anim_frame = self.current_animation[frame_idx]
         else:
             # Fallback to sequential playback if total_video_frames not set
             if self.current_frame >= len(self.current_animation):
-                print(f"[DEBUG] Reached end of sequential animation: frame {self.current_frame}/{len(self.current_animation)}")
+                if debug:
+                    logger.debug("Reached end of sequential animation: frame %d/%d",
+                                 self.current_frame, len(self.current_animation))
                 return background
-            anim_frame = self.current_animation[self.current_frame]
-            print(f"[DEBUG] Sequential overlay: frame {self.current_frame}/{len(self.current_animation)-1}")
+            frame_idx = self.current_frame
+            anim_frame = self.current_animation[frame_idx]
+            if debug:
+                logger.debug("Sequential overlay: frame %d/%d", frame_idx, len(self.current_animation) - 1)
             self.current_frame += 1
         
         # Calculate goalkeeper position relative to goal
@@ -158,20 +357,16 @@ class GoalkeeperAnimator:
         goal_center_x = (x1 + x2) // 2
         goal_bottom = y2
         
-        # Scale animation to match goal size
+        # Fetch the animation frame pre-scaled to the goal width
         goal_width = x2 - x1
-        scale_factor = goal_width / anim_frame.shape[1]
-        scaled_width = int(anim_frame.shape[1] * scale_factor)
-        scaled_height = int(anim_frame.shape[0] * scale_factor)
-        
         try:
-            print(f"[DEBUG] Scaling animation: {anim_frame.shape} -> ({scaled_width}, {scaled_height})")
-            scaled_frame = cv2.resize(anim_frame, (scaled_width, scaled_height))
-            print(f"[DEBUG] Scaling successful")
+            sprite = self.sprite_cache.get(self.current_direction, frame_idx, anim_frame, goal_width)
         except Exception as e:
-            print(f"[ERROR] Error scaling animation: {e}")
+            logger.error("Error scaling animation: %s", e)
             self.current_video_frame += 1
             return background
+        premultiplied, inv_alpha = sprite
+        scaled_height, scaled_width = premultiplied.shape[:2]
         
         # Calculate position to place goalkeeper with Y-offset
         gk_x = goal_center_x - scaled_width // 2
@@ -180,41 +375,50 @@ class GoalkeeperAnimator:
         y_offset = int(scaled_height * self.y_offset_percentage)
         gk_y = goal_bottom - scaled_height + y_offset
         
-        print(f"[DEBUG] Positioning at ({gk_x}, {gk_y}) with goal box {goal_box}")
+        if debug:
+            logger.debug("Positioning at (%d, %d) with goal box %s", gk_x, gk_y, goal_box)
         
         # Ensure coordinates are within image bounds
+        top, left = 0, 0
         if gk_y < 0:
-            print(f"[DEBUG] Y-coordinate out of bounds, adjusting...")
-            scaled_frame = scaled_frame[-gk_y:, :]
+            top = -gk_y
             gk_y = 0
         if gk_x < 0:
-            print(f"[DEBUG] X-coordinate out of bounds, adjusting...")
-            scaled_frame = scaled_frame[:, -gk_x:]
+            left = -gk_x
             gk_x = 0
             
         # Clip dimensions to fit within background
-        if gk_y + scaled_frame.shape[0] > background.shape[0]:
-            print(f"[DEBUG] Frame extends beyond bottom of background, clipping...")
-            scaled_frame = scaled_frame[:background.shape[0] - gk_y, :]
-        if gk_x + scaled_frame.shape[1] > background.shape[1]:
-            print(f"[DEBUG] Frame extends beyond right of background, clipping...")
-            scaled_frame = scaled_frame[:, :background.shape[1] - gk_x]
+        bottom = min(scaled_height, top + background.shape[0] - gk_y)
+        right = min(scaled_width, left + background.shape[1] - gk_x)
+        if debug and (top or left or bottom < scaled_height or right < scaled_width):
+            logger.debug("Clipping sprite to rows %d:%d, columns %d:%d of %dx%d",
+                         top, bottom, left, right, scaled_width, scaled_height)
         
         # Overlay animation frame with alpha channel
         try:
-            print(f"[DEBUG] Overlaying frame with shape {scaled_frame.shape} at ({gk_x}, {gk_y})")
-            if scaled_frame.shape[2] == 4:  # With alpha channel
-                alpha = scaled_frame[:, :, 3] / 255.0
-                for c in range(3):
-                    background[gk_y:gk_y+scaled_frame.shape[0], gk_x:gk_x+scaled_frame.shape[1], c] = \
-                        (1 - alpha) * background[gk_y:gk_y+scaled_frame.shape[0], gk_x:gk_x+scaled_frame.shape[1], c] + \
-                        alpha * scaled_frame[:, :, c]
-                print(f"[DEBUG] Overlay successful")
-            else:
-                print(f"[WARNING] Frame has no alpha channel, shape: {scaled_frame.shape}")
+            if inv_alpha is not None and bottom > top and right > left:
+                premultiplied = premultiplied[top:bottom, left:right]
+                inv_alpha = inv_alpha[top:bottom, left:right]
+                roi = background[gk_y:gk_y + premultiplied.shape[0], gk_x:gk_x + premultiplied.shape[1]]
+                composite_premultiplied(roi, premultiplied, inv_alpha)
+                if debug:
+                    logger.debug("Overlaid sprite %s at (%d, %d)", premultiplied.shape, gk_x, gk_y)
         except Exception as e:
-            print(f"[ERROR] Error overlaying animation: {e}")
+            logger.error("Error overlaying animation: %s", e)
         
         # Increment video frame counter
         self.current_video_frame += 1
-        return background 
\ No newline at end of file
+        return background
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Goalkeeper animation assets")
+    parser.add_argument("--build-atlas", metavar="FOLDER", nargs="?", const="Fbx Animations",
+                        help="Pack the dive_* PNG sequences in FOLDER into a memory-mappable atlas")
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.build_atlas:
+        build_animation_atlas(args.build_atlas)
+    else:
+        parser.print_help()
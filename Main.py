@@ -3,8 +3,10 @@ from Classified_Clips.FrameClipper26 import clip26frames
 from Classified_Clips.Augmentation_script import augment_clips
 from Classified_Clips.MMpose import process_all_videos
 from Classified_Clips.Check26Frames import check_video_frames
+from log_utils import configure_logging
 
 def main():
+    configure_logging()
     # Step 1: Define your input folders
     input_folders = {
         "left": "Classified_Clips/Left_Kicks",
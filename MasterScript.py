@@ -1,18 +1,37 @@
 import os
 import sys
+import json
 import shutil
 import glob
 import cv2
 import numpy as np
 import subprocess
 import time
+import multiprocessing
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 # Import required modules
-from Classified_Clips.FrameClipper26 import clip26frames
-from Classified_Clips.MMpose import process_all_videos
-from Goal_Viz import process_video
-from skeleton import predict_direction  # Import the prediction function
+from Classified_Clips.FrameClipper26 import extract_26_frames, select_frame_indices
+from Classified_Clips.MMpose import Infer3D, KeypointsOutput, POSE3D_MODEL
+from Goal_Viz import (
+    process_video, visualization_settings, GOAL_DETECTOR, ANIMATIONS_FOLDER, RENDER_WORKERS,
+    detect_goal_track, detect_goal_track_video, save_goal_track, load_goal_track
+)
+from skeleton import predict_direction, predict_keypoints, load_model  # Import the prediction functions
+from GoalkeeperAnimation import load_animations
+from log_utils import configure_logging, RateLimiter
+from batch_report import write_batch_csv, print_batch_table
+from manifest import PipelineManifest
+from stage_cache import StageCache, file_digest, get_default_cache, model_version
+from profiling import StageProfiler, hotpath_profile
+from progress import PipelineProgress
+from job_store import open_job_store
+import metrics
+
+logger = logging.getLogger(__name__)
 
 def create_folder(folder_path):
     """Create folder if it doesn't exist"""
@@ -21,19 +40,19 @@ def create_folder(folder_path):
 
 def create_keypoints_animation(keypoints_folder, output_video_path, fps=30):
     """Create a video from keypoints images"""
-    print(f"\nCreating keypoints animation video...")
+    logger.info("Creating keypoints animation video...")
     
     # Find all visualization images
     image_files = sorted(glob.glob(os.path.join(keypoints_folder, "frame_*.jpg")))
     
     if not image_files:
-        print(f"No keypoint visualization images found in {keypoints_folder}")
+        logger.warning("No keypoint visualization images found in %s", keypoints_folder)
         return None
     
     # Read the first image to get dimensions
     first_image = cv2.imread(image_files[0])
     if first_image is None:
-        print(f"Error: Could not read image {image_files[0]}")
+        logger.error("Could not read image %s", image_files[0])
         return None
     
     height, width, _ = first_image.shape
@@ -43,19 +62,236 @@ def create_keypoints_animation(keypoints_folder, output_video_path, fps=30):
     video_writer = cv2.VideoWriter(output_video_path, fourcc, fps, (width, height))
     
     # Add each image to the video
+    progress_limiter = RateLimiter(interval=2.0)
     for i, image_file in enumerate(image_files):
-        print(f"\rAdding frame {i+1}/{len(image_files)} to keypoints animation", end="")
+        if progress_limiter.ready():
+            logger.debug("Adding frame %d/%d to keypoints animation", i + 1, len(image_files))
         img = cv2.imread(image_file)
         if img is not None:
             video_writer.write(img)
     
     video_writer.release()
-    print(f"\nKeypoints animation saved to: {output_video_path}")
+    logger.info("Keypoints animation saved to: %s", output_video_path)
     return output_video_path
 
-def process_single_video(video_path, output_base_folder=None, model_path='penalty_conv3d_model.h5'):
-    """Process a single video through all steps"""
-    start_time = time.time()
+def video_frame_count(video_path):
+    """Frame count from the video's header, 0 if it cannot be opened"""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        return int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if cap.isOpened() else 0
+    finally:
+        cap.release()
+
+def write_video(frames, output_video_path, fps=30):
+    """Encode frames to an mp4v video"""
+    if not frames:
+        return None
+    height, width = frames[0].shape[:2]
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    video_writer = cv2.VideoWriter(output_video_path, fourcc, fps, (width, height))
+    for frame in frames:
+        video_writer.write(frame)
+    video_writer.release()
+    return output_video_path
+
+def scan_video(video_path, detect_goal=False):
+    """
+    Decode a video keeping only the 26 frames select_frame_indices picks,
+    so memory does not grow with the length of the video. With detect_goal
+    the goal is detected on every frame in the same pass. The indices come
+    from the header's frame count; if the video has a different number of
+    frames, the clip frames are read once more with the real count.
+    Returns (frames, total_frames, fps, goal boxes or None).
+    """
+    total_frames = video_frame_count(video_path)
+    frames, frames_read, fps, goal_boxes = _scan_frames(video_path, total_frames, detect_goal)
+    if frames_read != total_frames:
+        logger.info("%s has %d frames, not %d as its header says", video_path, frames_read, total_frames)
+        frames, frames_read, fps, _ = _scan_frames(video_path, frames_read, False)
+    return frames, frames_read, fps, goal_boxes
+
+def _scan_frames(video_path, total_frames, detect_goal):
+    """One pass over video_path keeping the frames selected for total_frames; returns (frames, frames read, fps, goal boxes)"""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return [], 0, 0, None
+    selected = set(select_frame_indices(total_frames))
+    frames = []
+    frame_idx = 0
+    
+    def decoded():
+        nonlocal frame_idx
+        # grab() skips the frames that are neither kept nor searched for
+        # the goal without converting them
+        while cap.grab():
+            keep = frame_idx in selected
+            frame = None
+            if keep or detect_goal:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+            if keep:
+                frames.append(frame)
+            frame_idx += 1
+            if detect_goal:
+                yield frame
+    
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        if detect_goal:
+            goal_boxes = detect_goal_track(decoded())
+        else:
+            goal_boxes = None
+            for _ in decoded():
+                pass
+    finally:
+        cap.release()
+    return frames, frame_idx, fps, goal_boxes
+
+class VideoScan:
+    """
+    The one decode of the upload before rendering, shared by the goal track
+    and clip stages: whichever runs first scans the video and the other
+    reuses the result. A scan asked for the goal track also detects the
+    goal on every frame.
+    """
+    def __init__(self, video_path):
+        self.video_path = video_path
+        self._result = None
+        self._lock = threading.Lock()
+    
+    def run(self, detect_goal=False):
+        """scan_video's (frames, total_frames, fps, goal boxes) for the video"""
+        with self._lock:
+            if self._result is None or (detect_goal and self._result[3] is None):
+                self._result = scan_video(self.video_path, detect_goal)
+            return self._result
+
+def _cached_stage(cache, manifest, profiler, stage, key, outputs, compute):
+    """
+    Run one pipeline stage through the stage cache.
+    
+    outputs maps artifact names to the paths the stage writes. On a cache
+    hit the cached files are copied to those paths and the cached data dict
+    is returned without running compute(). On a miss compute() runs; it
+    returns a JSON-serializable dict, or None if the stage failed, and on
+    success its files and data are stored for next time. The stage is
+    profiled under its name, hit or miss, with the result in its record.
+    """
+    with profiler.stage(stage) as record:
+        entry = cache.get(stage, key) if cache else None
+        if entry is not None:
+            for name, path in outputs.items():
+                if name in entry['files']:
+                    cache.restore(entry, name, path)
+            manifest.stage_cache[stage] = record['cache'] = 'hit'
+            return entry['data']
+        
+        data = compute()
+        if data is None:
+            return None
+        if cache:
+            cache.put(stage, key, files=outputs, data=data)
+            manifest.stage_cache[stage] = record['cache'] = 'miss'
+        return data
+
+def _start_goal_track(background, cache, manifest, profiler, source_digest, detect):
+    """
+    Start the goal box track for the source video on the background
+    executor, so it runs while pose inference and prediction are going.
+    detect() returns the per-frame boxes. The future resolves to the track,
+    or None if detection failed, in which case rendering detects as before.
+    """
+    track_path = os.path.join(manifest.output_folder, f"{manifest.video_name}_goal_track.json")
+    
+    def compute():
+        goal_boxes = detect()
+        if not goal_boxes:
+            return None
+        save_goal_track(goal_boxes, track_path)
+        return {'frames': len(goal_boxes)}
+    
+    def run():
+        key = StageCache.key('goal_track', source_digest, {'detector': GOAL_DETECTOR})
+        if _cached_stage(cache, manifest, profiler, 'goal_track', key, {'goal_track': track_path}, compute) is None:
+            return None
+        manifest.goal_track = track_path
+        return load_goal_track(track_path)
+    
+    return background.submit(run)
+
+def _goal_track_result(future):
+    """Wait for the background goal track; None if it failed"""
+    try:
+        return future.result()
+    except Exception as e:
+        logger.warning("Goal detection pass failed, detecting while rendering: %s", e)
+        return None
+
+def _print_cache_report(manifest):
+    if manifest.stage_cache:
+        report = ", ".join(f"{stage}={result}" for stage, result in manifest.stage_cache.items())
+        print(f"Stage cache: {report}")
+
+# What process_single_video is given: the original video, the 26-frame clip
+# FrameClipper26 selects (e.g. made by the API client before uploading), or
+# the Infer3D keypoints of those frames as JSON
+INPUT_KINDS = ('video', 'clip', 'keypoints')
+
+def process_single_video(video_path, output_base_folder=None, model_path='penalty_conv3d_model.h5',
+                         streaming=False, write_intermediates=False, use_cache=True, infer3d=None,
+                         profile_hotpaths=None, model=None, progress_callback=None, render=True,
+                         input_kind='video', output_name=None):
+    """
+    Process a single video through all steps
+
+    Returns a PipelineManifest with the exact paths written (also saved as
+    manifest.json in the output folder), or False if a stage failed.
+
+    Stage outputs are cached by input video content, stage parameters and
+    model version (see stage_cache.py), so a rerun only recomputes stages
+    whose inputs changed, e.g. only prediction and rendering after the
+    classifier model is replaced. manifest.stage_cache shows hits/misses.
+
+    Every stage is profiled (wall and CPU time, peak RSS, bytes read and
+    written, see profiling.py) into <video>_profile.json next to the
+    outputs, linked from manifest.profile.
+
+    Goal detection on the original video does not depend on the
+    prediction, so it runs on a background thread alongside clipping, pose
+    inference and prediction; the render step then only composites onto the
+    detected boxes.
+
+    Args:
+        streaming: Feed the 26 selected frames to pose in memory instead of
+            going through an intermediate clip file
+        write_intermediates: In streaming mode, also write the 26-frame
+            clip and the per-frame pose images to the output folder
+        use_cache: Look up and store stage outputs in the stage cache
+        infer3d: Infer3D instance to reuse; by default the one loaded by
+            init_worker, or a new one when the pose stage is not cached
+        profile_hotpaths: 'cprofile' or 'pyinstrument' to also capture a
+            hot-path profile of the run (default: $PENALTY_PROFILE)
+        model: Loaded classifier to use instead of model_path (see
+            skeleton.predict_keypoints). The stage cache still keys the
+            prediction on model_path, so pass use_cache=False with it
+        progress_callback: Called with progress events (current stage,
+            frames done out of total, overall percent; see progress.py)
+            as the run goes, e.g. to update an API job record. The
+            prediction and confidence are sent as soon as the classifier
+            has run, before rendering
+        render: Render the goal visualization video. With render=False
+            the run stops after the prediction; a later run with
+            render=True picks up the cached stages and only renders
+        input_kind: One of INPUT_KINDS. A 'clip' skips the frame
+            selection and is rendered as it is; 'keypoints' (a JSON file,
+            as Infer3D saves) skips clipping and pose inference and has
+            nothing to render
+        output_name: Output folder under output_base_folder (default: the
+            video's name), e.g. to keep videos with the same name apart
+    """
+    cache = get_default_cache() if use_cache else None
+    infer3d = infer3d or _warm_infer3d
     
     # Get video filename without extension
     video_name = os.path.splitext(os.path.basename(video_path))[0]
@@ -63,211 +299,650 @@ def process_single_video(video_path, output_base_folder=None, model_path='penalt
     # Create output folder
     if output_base_folder is None:
         output_base_folder = "Processed_Videos"
-    
-    output_folder = create_folder(os.path.join(output_base_folder, video_name))
+    output_folder = create_folder(os.path.join(output_base_folder, output_name or video_name))
+    
+    run_start = time.perf_counter()
+    profiler = StageProfiler()
+    progress = PipelineProgress(progress_callback)
+    hotpath_base = os.path.join(output_folder, f"{video_name}_hotpaths")
+    with hotpath_profile(hotpath_base, profile_hotpaths) as hotpath_report:
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="goal-track") as background:
+            if input_kind == 'keypoints':
+                manifest = _process_keypoints(video_path, output_folder, model_path, cache, profiler, model, progress)
+            elif streaming:
+                manifest = _process_single_video_streaming(video_path, output_folder, model_path, write_intermediates,
+                                                           cache, background, infer3d, profiler, model, progress,
+                                                           render)
+            else:
+                manifest = _process_single_video_file(video_path, output_folder, model_path,
+                                                      cache, background, infer3d, profiler, model, progress, render,
+                                                      clipped=input_kind == 'clip')
+    
+    profile_path = profiler.save(os.path.join(output_folder, f"{video_name}_profile.json"))
+    profiler.print_report()
+    metrics.observe('penalty_pipeline_seconds', time.perf_counter() - run_start)
+    metrics.inc('penalty_pipeline_runs_total', result='ok' if manifest else 'failed')
+    if not manifest:
+        return False
+    manifest.profile = profile_path
+    manifest.hotpath_profile = hotpath_report
+    manifest.stage_times = profiler.wall_times()
+    manifest.save()
+    progress.done()
+    return manifest
+
+def _process_single_video_file(video_path, output_folder, model_path, cache, background, infer3d, profiler, model,
+                               progress, render, clipped=False):
+    """
+    Pipeline over intermediate video files: FrameClipper26, Infer3D.process_video, Goal_Viz.process_video.
+    A clipped video of 26 frames is used as the clip as it is; any other
+    length is clipped like a full video.
+    """
+    start_time = time.time()
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+    manifest = PipelineManifest(video_name=video_name, source_video=video_path, output_folder=output_folder)
+    source_digest = file_digest(video_path) if cache else None
     print(f"\n{'='*50}")
     print(f"Processing video: {video_path}")
     print(f"Output folder: {output_folder}")
     print(f"{'='*50}")
     
-    # Step 1: Convert to 26 frames using FrameClipper26
-    print("\nStep 1: Converting to 26 frames...")
-    temp_folder = create_folder(os.path.join(output_folder, "temp"))
-    
-    # Copy the original video to temp folder with a unique name to avoid conflicts
-    temp_original = os.path.join(temp_folder, f"{video_name}_original.mp4")
-    shutil.copy2(video_path, temp_original)
+    goal_track = _start_goal_track(background, cache, manifest, profiler, source_digest,
+                                   lambda: detect_goal_track_video(video_path)) if render else None
     
-    # Run frame clipper
-    clip26frames(temp_folder)
-    
-    # Find the clipped video - check multiple possible locations
-    clipped_videos = []
+    # Step 1: Convert to 26 frames using FrameClipper26, straight into the output folder
+    print("\nStep 1: Converting to 26 frames...")
+    progress.stage('clip')
+    clipped_video_path = os.path.join(output_folder, f"{video_name}_26frames.mp4")
+    
+    def clip():
+        if clipped and video_frame_count(video_path) == 26:
+            shutil.copyfile(video_path, clipped_video_path)
+        elif not extract_26_frames(video_path, output_folder, output_filename=os.path.basename(clipped_video_path)):
+            return None
+        return {}
+    
+    clip_params = {'frames': 26, 'clipped': True} if clipped else {'frames': 26}
+    if _cached_stage(cache, manifest, profiler, 'clip', StageCache.key('clip', source_digest, clip_params),
+                     {'clipped_video': clipped_video_path}, clip) is None:
+        print(f"Error: Could not create clipped video for {video_name}")
+        return False
+    manifest.clipped_video = clipped_video_path
+    print(f"Clipped video written to: {clipped_video_path}")
     
-    # Check in the standard Results folder
-    clipped_videos.extend(glob.glob(os.path.join("Classified_Clips", "Results", "**", f"{video_name}*.mp4"), recursive=True))
+    # Step 2 and 3: Run MMPose inference and create the keypoints animation
+    print("\nStep 2: Running MMPose inference...")
+    progress.stage('pose')
+    keypoints_base_folder = create_folder(os.path.join(output_folder, "keypoints"))
+    keypoints_output = KeypointsOutput.for_video(keypoints_base_folder, f"{video_name}_26frames")
+    keypoints_video_path = os.path.join(output_folder, f"{video_name}_keypoints.mp4")
     
-    # Check in the output folder's Results folder
-    clipped_videos.extend(glob.glob(os.path.join(output_folder, "Results", "**", f"{video_name}*.mp4"), recursive=True))
+    def pose():
+        if not (infer3d or Infer3D()).process_video(clipped_video_path, keypoints_base_folder, return_vis=True, save_vis=True,
+                                                        progress=progress.frames):
+            return None
+        print("\nStep 3: Creating keypoints animation...")
+        with profiler.stage('animation'):
+            if not create_keypoints_animation(keypoints_output.folder, keypoints_video_path):
+                print("Warning: Could not create keypoints animation")
+        return {}
+    
+    pose_params = {'frames': 26, 'input': 'clipped_video', 'pose3d': POSE3D_MODEL}
+    pose_key = StageCache.key('pose', source_digest, pose_params)
+    os.makedirs(keypoints_output.folder, exist_ok=True)
+    if _cached_stage(cache, manifest, profiler, 'pose', pose_key, {
+        'keypoints_json': keypoints_output.json_path,
+        'keypoints_csv': keypoints_output.csv_path,
+        'keypoints_video': keypoints_video_path
+    }, pose) is None:
+        print("Error: MMPose processing failed")
+        return False
     
-    # Check in the temp folder's Results folder
-    clipped_videos.extend(glob.glob(os.path.join(temp_folder, "Results", "**", f"{video_name}*.mp4"), recursive=True))
+    manifest.keypoints_folder = keypoints_output.folder
+    manifest.keypoints_json = keypoints_output.json_path
+    manifest.keypoints_csv = keypoints_output.csv_path
+    manifest.keypoints_video = keypoints_video_path if os.path.exists(keypoints_video_path) else None
+    print(f"Keypoints generated in: {keypoints_output.folder}")
     
-    # Check in the current directory's Results folder
-    clipped_videos.extend(glob.glob(os.path.join("Results", "**", f"{video_name}*.mp4"), recursive=True))
+    # Step 4: Run prediction model on keypoints data
+    print("\nStep 4: Running prediction model...")
+    progress.stage('predict')
     
-    # Check for any MP4 file with the video name in the Results folders
-    clipped_videos.extend(glob.glob(os.path.join("**", "Results", "**", f"{video_name}*.mp4"), recursive=True))
+    def predict():
+        if not os.path.exists(keypoints_output.csv_path):
+            print(f"Error: Keypoints CSV file not found: {keypoints_output.csv_path}")
+            return None
+        # Run the prediction model
+        return _prediction_data(*predict_direction(keypoints_output.csv_path, model_path, model))
     
-    if not clipped_videos:
-        print(f"Error: Could not find clipped video for {video_name}")
-        print("Searched in:")
-        print(f"  - {os.path.join('Classified_Clips', 'Results', '**', f'{video_name}*.mp4')}")
-        print(f"  - {os.path.join(output_folder, 'Results', '**', f'{video_name}*.mp4')}")
-        print(f"  - {os.path.join(temp_folder, 'Results', '**', f'{video_name}*.mp4')}")
-        print(f"  - {os.path.join('Results', '**', f'{video_name}*.mp4')}")
-        print(f"  - {os.path.join('**', 'Results', '**', f'{video_name}*.mp4')}")
-        
-        # Last resort: try to find any MP4 file in the Results folders
-        any_results = glob.glob(os.path.join("**", "Results", "**", "*.mp4"), recursive=True)
-        if any_results:
-            print("Found these videos in Results folders:")
-            for video in any_results:
-                print(f"  - {video}")
-        
-        return False
+    result = _cached_stage(cache, manifest, profiler, 'predict',
+                           StageCache.key('predict', pose_key, version=model_version(model_path) if cache else None),
+                           {}, predict)
+    prediction = _record_prediction(manifest, progress, result)
     
-    clipped_video_path = clipped_videos[0]
-    print(f"Clipped video found: {clipped_video_path}")
+    # Step 5: Goal visualization, unless rendering is left for a later run
+    if render:
+        print("\nStep 5: Creating goal visualization...")
+        _visualize(video_path, prediction, goal_track, cache, manifest, profiler, progress, source_digest)
+    else:
+        print("\nStep 5: Skipped, rendering left for a later run")
     
-    # Copy the clipped video to our output folder
-    clipped_video_output = os.path.join(output_folder, f"{video_name}_26frames.mp4")
-    shutil.copy2(clipped_video_path, clipped_video_output)
+    # Final summary
+    end_time = time.time()
+    processing_time = end_time - start_time
     
-    # Step 2: Run MMPose inference
-    print("\nStep 2: Running MMPose inference...")
-    keypoints_base_folder = create_folder(os.path.join(output_folder, "keypoints"))
+    print(f"\n{'='*50}")
+    print(f"Processing complete for: {video_name}")
+    print(f"Total processing time: {processing_time:.2f} seconds")
+    _print_cache_report(manifest)
+    print(f"Output files in: {output_folder}")
+    print(f"{'='*50}")
     
-    # Create a temporary folder just for this video to avoid processing other videos
-    mmpose_input_folder = create_folder(os.path.join(output_folder, "mmpose_input"))
-    temp_clipped_path = os.path.join(mmpose_input_folder, os.path.basename(clipped_video_output))
-    shutil.copy2(clipped_video_output, temp_clipped_path)
-    
-    # Process the clipped video with MMPose
-    processed_folders = process_all_videos(
-        input_folder=mmpose_input_folder,
-        output_base_folder=keypoints_base_folder,
-        return_vis=True,
-        save_vis=True
-    )
+    return manifest
+
+def _process_keypoints(keypoints_path, output_folder, model_path, cache, profiler, model, progress):
+    """
+    Prediction from keypoints made elsewhere, e.g. by the API client: the
+    Infer3D keypoints of the 26 frames as a JSON list. Clipping and pose
+    inference were done there, and there is no video to render onto.
+    """
+    start_time = time.time()
+    video_name = os.path.splitext(os.path.basename(keypoints_path))[0]
+    manifest = PipelineManifest(video_name=video_name, source_video=keypoints_path, output_folder=output_folder)
+    print(f"\n{'='*50}")
+    print(f"Processing keypoints: {keypoints_path}")
+    print(f"Output folder: {output_folder}")
+    print(f"{'='*50}")
     
-    if not processed_folders:
-        print("Error: MMPose processing failed")
+    try:
+        with open(keypoints_path) as f:
+            keypoints_list = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not read keypoints from {keypoints_path}: {e}")
         return False
     
-    # Find the keypoints folder
-    keypoints_folder = None
-    for folder in processed_folders:
-        if os.path.basename(folder).startswith(video_name):
-            keypoints_folder = folder
-            break
-    
-    if not keypoints_folder:
-        print(f"Error: Could not find keypoints folder for {video_name}")
-        # Try to find it manually
-        possible_folders = glob.glob(os.path.join(keypoints_base_folder, "**", video_name + "*"), recursive=True)
-        if possible_folders:
-            keypoints_folder = possible_folders[0]
-            print(f"Found potential keypoints folder: {keypoints_folder}")
-        else:
-            return False
-    
-    print(f"Keypoints generated in: {keypoints_folder}")
+    # Kept where the pose stage would have written them
+    keypoints_output = KeypointsOutput.for_video(os.path.join(output_folder, "keypoints"), f"{video_name}_26frames")
+    os.makedirs(keypoints_output.folder, exist_ok=True)
+    shutil.copyfile(keypoints_path, keypoints_output.json_path)
+    manifest.keypoints_folder = keypoints_output.folder
+    manifest.keypoints_json = keypoints_output.json_path
+    print("\nSteps 1-3: Skipped, keypoints were uploaded")
     
-    # Step 3: Create keypoints animation video
-    print("\nStep 3: Creating keypoints animation...")
-    keypoints_video_path = os.path.join(output_folder, f"{video_name}_keypoints.mp4")
-    keypoints_animation = create_keypoints_animation(keypoints_folder, keypoints_video_path)
+    print("\nStep 4: Running prediction model...")
+    progress.stage('predict')
     
-    if not keypoints_animation:
-        print("Warning: Could not create keypoints animation")
+    def predict():
+        return _prediction_data(*predict_keypoints(keypoints_list, model_path, model))
     
-    # Step 4: Run prediction model on keypoints data
-    print("\nStep 4: Running prediction model...")
+    source_digest = file_digest(keypoints_path) if cache else None
+    result = _cached_stage(cache, manifest, profiler, 'predict',
+                           StageCache.key('predict', source_digest, {'input': 'keypoints'},
+                                          version=model_version(model_path) if cache else None),
+                           {}, predict)
+    _record_prediction(manifest, progress, result)
+    print("\nStep 5: Skipped, no video to render")
     
-    # Find the keypoints CSV file - search in multiple possible locations
-    keypoints_csv = None
-    possible_csv_paths = [
-        os.path.join(keypoints_folder, f"{video_name}_keypoints.csv"),
-        os.path.join(keypoints_folder, f"{video_name}_26frames_keypoints.csv"),
-        os.path.join(keypoints_folder, f"{os.path.basename(keypoints_folder)}_keypoints.csv")
-    ]
-    
-    # Also search recursively
-    csv_files = glob.glob(os.path.join(keypoints_folder, "**", "*_keypoints.csv"), recursive=True)
-    possible_csv_paths.extend(csv_files)
-    
-    for csv_path in possible_csv_paths:
-        if os.path.exists(csv_path):
-            keypoints_csv = csv_path
-            print(f"Found keypoints CSV: {keypoints_csv}")
-            break
-    
-    if not keypoints_csv:
-        print(f"Error: Keypoints CSV file not found. Searched in:")
-        for path in possible_csv_paths:
-            print(f"  - {path}")
-        prediction = "center"  # Default prediction
-    else:
-        # Run the prediction model
-        prediction, confidence = predict_direction(keypoints_csv, model_path)
-        if prediction is None:
-            print("Warning: Prediction failed, using default 'center'")
-            prediction = "center"
-        else:
-            print(f"Prediction: {prediction} (confidence: {confidence:.2f})")
+    print(f"\n{'='*50}")
+    print(f"Processing complete for: {video_name}")
+    print(f"Total processing time: {time.time() - start_time:.2f} seconds")
+    _print_cache_report(manifest)
+    print(f"Output files in: {output_folder}")
+    print(f"{'='*50}")
     
-    # Save prediction to a text file for reference
-    prediction_file = os.path.join(output_folder, f"{video_name}_prediction.txt")
+    return manifest
+
+def _prediction_data(prediction, confidence):
+    """
+    Predict stage data from the classifier's (prediction, confidence), or
+    None if it failed. Failures are not cached, so a fixed model or
+    keypoints file is retried.
+    """
+    if prediction is None:
+        return None
+    return {'prediction': prediction, 'confidence': float(confidence)}
+
+def _record_prediction(manifest, progress, result):
+    """
+    Save the predict stage result next to the outputs, record it in the
+    manifest and report it; a failed prediction is recorded as 'center'
+    without a confidence. Returns the prediction.
+    """
+    if result is None:
+        print("Warning: Prediction failed, using default 'center'")
+        result = {'prediction': "center", 'confidence': None}
+    prediction, confidence = result['prediction'], result['confidence']
+    if confidence is not None:
+        print(f"Prediction: {prediction} (confidence: {confidence:.2f})")
+    prediction_file = os.path.join(manifest.output_folder, f"{manifest.video_name}_prediction.txt")
     with open(prediction_file, 'w') as f:
         f.write(prediction)
+    manifest.prediction = prediction
+    manifest.confidence = confidence
+    manifest.prediction_file = prediction_file
+    progress.result(prediction, confidence)
+    return prediction
+
+def _process_single_video_streaming(video_path, output_folder, model_path, write_intermediates, cache, background,
+                                    infer3d, profiler, model, progress, render):
+    """
+    In-process pipeline: the 26 selected frames go to MMPose in memory,
+    without an intermediate clip file. Only those frames are kept; the
+    frame selection and goal detection share one pass over the upload and
+    rendering makes the only other, both frame by frame, so memory does not
+    grow with the length or resolution of the upload. The video is only
+    decoded by the stages that miss the cache. Clipped videos go through
+    the same 26-frame selection, which keeps a clip of exactly 26 frames as
+    it is.
+    """
+    start_time = time.time()
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+    manifest = PipelineManifest(video_name=video_name, source_video=video_path, output_folder=output_folder)
+    source_digest = file_digest(video_path) if cache else None
+    print(f"\n{'='*50}")
+    print(f"Processing video (streaming): {video_path}")
+    print(f"Output folder: {output_folder}")
+    print(f"{'='*50}")
     
-    # Step 5: Run Goal Visualization
-    print("\nStep 5: Creating goal visualization...")
-    visualization_path = os.path.join(output_folder, f"{video_name}_visualization.mp4")
+    scan = VideoScan(video_path)
+    goal_track = _start_goal_track(background, cache, manifest, profiler, source_digest,
+                                   lambda: scan.run(detect_goal=True)[3]) if render else None
     
-    # Process the original video with Goal_Viz
-    process_video(
-        video_path=video_path,
-        output_path=visualization_path,
-        prediction=prediction,
-        delay=1  # Fast processing
-    )
+    # Steps 1-3: pick the 26 frames, run MMPose on them in memory and
+    # write the keypoints animation straight from the visualizations
+    print("\nStep 1: Selecting 26 frames and running MMPose inference...")
+    progress.stage('clip')
+    keypoints_base_folder = create_folder(os.path.join(output_folder, "keypoints"))
+    keypoints_output = KeypointsOutput.for_video(keypoints_base_folder, f"{video_name}_26frames")
+    keypoints_video_path = os.path.join(output_folder, f"{video_name}_keypoints.mp4")
     
-    print(f"Visualization created: {visualization_path}")
+    def pose():
+        # Decoding and frame selection count as the clip stage
+        with profiler.stage('clip'):
+            # The clip frames come out of the goal track's pass; when that
+            # stage hits the cache, the scan runs here without detection
+            if goal_track is not None:
+                _goal_track_result(goal_track)
+            clip_frames, total_frames, fps, _ = scan.run()
+            if clip_frames:
+                print(f"Selected {len(clip_frames)} of {total_frames} frames")
+                if write_intermediates:
+                    clipped_video_output = os.path.join(output_folder, f"{video_name}_26frames.mp4")
+                    manifest.clipped_video = write_video(clip_frames, clipped_video_output, fps)
+                    print(f"Clipped video written to: {clipped_video_output}")
+        if not clip_frames:
+            print(f"Error: Could not decode video {video_path}")
+            return None
+        
+        progress.stage('pose')
+        vis_frames = []
+        output, _ = (infer3d or Infer3D()).process_frames(
+            clip_frames,
+            f"{video_name}_26frames",
+            keypoints_base_folder,
+            return_vis=True,
+            save_vis=write_intermediates,
+            vis_frames=vis_frames,
+            progress=progress.frames
+        )
+        if not output:
+            return None
+        
+        with profiler.stage('animation'):
+            animation_written = write_video(vis_frames, keypoints_video_path)
+        if animation_written:
+            logger.info("Keypoints animation saved to: %s", keypoints_video_path)
+        else:
+            print("Warning: Could not create keypoints animation")
+        return {}
+    
+    pose_params = {'frames': 26, 'input': 'decoded_frames', 'pose3d': POSE3D_MODEL}
+    pose_key = StageCache.key('pose', source_digest, pose_params)
+    os.makedirs(keypoints_output.folder, exist_ok=True)
+    if _cached_stage(cache, manifest, profiler, 'pose', pose_key, {
+        'keypoints_json': keypoints_output.json_path,
+        'keypoints_csv': keypoints_output.csv_path,
+        'keypoints_video': keypoints_video_path
+    }, pose) is None:
+        print("Error: MMPose processing failed")
+        return False
     
-    # Clean up temporary folders
-    try:
-        shutil.rmtree(mmpose_input_folder)
-        print(f"Cleaned up temporary MMPose input folder")
-    except Exception as e:
-        print(f"Warning: Could not clean up temporary folder: {e}")
+    manifest.keypoints_folder = keypoints_output.folder
+    manifest.keypoints_json = keypoints_output.json_path
+    manifest.keypoints_csv = keypoints_output.csv_path
+    manifest.keypoints_video = keypoints_video_path if os.path.exists(keypoints_video_path) else None
+    print(f"Keypoints generated in: {keypoints_output.folder}")
     
-    # Final summary
-    end_time = time.time()
-    processing_time = end_time - start_time
+    # Step 4: Prediction on the keypoints
+    print("\nStep 4: Running prediction model...")
+    progress.stage('predict')
+    
+    def predict():
+        with open(keypoints_output.json_path) as f:
+            keypoints_list = json.load(f)
+        return _prediction_data(*predict_keypoints(keypoints_list, model_path, model))
+    
+    result = _cached_stage(cache, manifest, profiler, 'predict',
+                           StageCache.key('predict', pose_key, version=model_version(model_path) if cache else None),
+                           {}, predict)
+    prediction = _record_prediction(manifest, progress, result)
+    
+    # Step 5: Goal visualization, unless rendering is left for a later run
+    if render:
+        print("\nStep 5: Creating goal visualization...")
+        _visualize(video_path, prediction, goal_track, cache, manifest, profiler, progress, source_digest)
+    else:
+        print("\nStep 5: Skipped, rendering left for a later run")
     
+    processing_time = time.time() - start_time
     print(f"\n{'='*50}")
     print(f"Processing complete for: {video_name}")
     print(f"Total processing time: {processing_time:.2f} seconds")
+    _print_cache_report(manifest)
     print(f"Output files in: {output_folder}")
     print(f"{'='*50}")
     
-    return True
+    return manifest
+
+def _visualize(video_path, prediction, goal_track, cache, manifest, profiler, progress, source_digest):
+    """
+    Render the goal visualization of video_path onto the background goal
+    track, through the stage cache, with RENDER_WORKERS processes
+    """
+    progress.stage('visualize')
+    visualization_path = os.path.join(manifest.output_folder, f"{manifest.video_name}_visualization.mp4")
+    
+    def visualize():
+        process_video(video_path, visualization_path, prediction, delay=1, show=False, workers=RENDER_WORKERS,
+                      goal_boxes=_goal_track_result(goal_track), progress=progress.frames)
+        return {}
+    
+    visualize_params = dict(visualization_settings(), prediction=prediction)
+    _cached_stage(cache, manifest, profiler, 'visualize', StageCache.key('visualize', source_digest, visualize_params),
+                  {'visualization': visualization_path}, visualize)
+    manifest.visualization = visualization_path
+    print(f"Visualization created: {visualization_path}")
+
+def render_manifest(manifest_path, use_cache=True, progress_callback=None):
+    """
+    Render the goal visualization of a run made with render=False, from
+    its saved manifest. The recorded prediction is drawn onto the source
+    video, so neither pose inference nor the classifier runs again,
+    whatever the stage cache holds. Returns the manifest, updated with the
+    visualization, or False if the run has no video or prediction.
+    """
+    manifest = PipelineManifest.load(manifest_path)
+    video_path = manifest.source_video
+    if not manifest.prediction or not video_path or not os.path.exists(video_path):
+        print(f"Error: Nothing to render for {manifest_path}")
+        return False
+    cache = get_default_cache() if use_cache else None
+    source_digest = file_digest(video_path) if cache else None
+    profiler = StageProfiler()
+    progress = PipelineProgress(progress_callback)
+    print(f"Rendering {video_path} with prediction {manifest.prediction}")
+    
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="goal-track") as background:
+        goal_track = _start_goal_track(background, cache, manifest, profiler, source_digest,
+                                       lambda: detect_goal_track_video(video_path))
+        _visualize(video_path, manifest.prediction, goal_track, cache, manifest, profiler, progress, source_digest)
+    
+    profiler.save(os.path.join(manifest.output_folder, f"{manifest.video_name}_render_profile.json"))
+    profiler.print_report()
+    manifest.stage_times.update(profiler.wall_times())
+    manifest.save()
+    progress.done()
+    return manifest
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+BATCH_STAGES = ('clip', 'pose', 'animation', 'predict', 'goal_track', 'visualize')
+# Columns of the batch results table (see batch_report)
+BATCH_FIELDS = ('video', 'status', 'prediction', 'confidence')
+BATCH_TIMINGS = ('total',) + BATCH_STAGES
+
+def collect_videos(inputs):
+    """
+    Expand batch inputs into video paths: directories are searched
+    recursively, .txt files list one video path per line, anything else is
+    taken as a video file
+    """
+    videos = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                videos.extend(os.path.join(root, file) for file in sorted(files)
+                              if file.lower().endswith(VIDEO_EXTENSIONS))
+        elif item.lower().endswith('.txt'):
+            with open(item) as f:
+                videos.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+        else:
+            videos.append(item)
+    # Keep the first occurrence of videos listed more than once
+    return list(dict.fromkeys(videos))
+
+# Pose inferencer kept warm by init_worker for every run in this process
+_warm_infer3d = None
+
+def init_worker(model_path='penalty_conv3d_model.h5'):
+    """
+    Load MMPose, the classifier and the goalkeeper animations once in a
+    worker process (batch mode, API workers); later process_single_video
+    calls in the process reuse them
+    """
+    global _warm_infer3d
+    configure_logging()
+    _warm_infer3d = Infer3D()
+    if os.path.exists(model_path):
+        load_model(model_path)
+    load_animations(ANIMATIONS_FOLDER)
+
+# Job store this worker process reports job progress to, opened on first use
+_progress_store = None
+
+def _job_progress(task_id, prefix=''):
+    """Progress callback that writes each event into the job's record, with keys prefixed"""
+    global _progress_store
+    if _progress_store is None:
+        _progress_store = open_job_store()
+    return lambda event: _progress_store.update(task_id, **{prefix + key: value for key, value in event.items()})
+
+def result_params():
+    """Pipeline settings, besides the classifier model, that results depend on"""
+    return {'frames': 26, 'pose3d': POSE3D_MODEL, 'goal_detector': GOAL_DETECTOR,
+            'visualization': visualization_settings()}
+
+def progress_target(job):
+    """
+    (job id, key prefix) a job's progress is recorded under: a background
+    render job reports on the upload's job record as render_stage,
+    render_progress etc.
+    """
+    if job.get('kind') == 'render':
+        return job['parent_id'], 'render_'
+    return job['task_id'], ''
+
+def process_job(job, progress_callback=None, **options):
+    """
+    Run a job record from the API job store through the streaming pipeline.
+    job['render'] False stops after the prediction; job['input'] is the
+    upload's kind (see INPUT_KINDS). A background render job only renders
+    the finished run in job['manifest_file'] (see render_manifest).
+    Progress goes to the job store (see
+    progress_target) unless progress_callback is given, e.g. by a worker
+    on another host (worker.py). options are passed on to
+    process_single_video, e.g. stub models (benchmarks/stub_server.py).
+    """
+    if progress_callback is None:
+        progress_callback = _job_progress(*progress_target(job))
+    try:
+        if job.get('kind') == 'render':
+            return render_manifest(job['manifest_file'], use_cache=options.get('use_cache', True),
+                                   progress_callback=progress_callback)
+        return process_single_video(job['video_path'], job['output_folder'], streaming=True,
+                                    progress_callback=progress_callback, render=job.get('render', True),
+                                    input_kind=job.get('input', 'video'), **options)
+    finally:
+        # Pool processes exit without running atexit handlers; publish after every job
+        metrics.flush()
+
+def _batch_process_one(video_path, output_base_folder, model_path, streaming, output_name=None):
+    """Run one clip of a batch; never raises, failures become the row's error"""
+    start_time = time.time()
+    row = {'video': video_path, 'status': 'failed'}
+    try:
+        if not os.path.exists(video_path):
+            raise FileNotFoundError(f"Video file {video_path} not found")
+        manifest = process_single_video(video_path, output_base_folder, model_path, streaming=streaming,
+                                        output_name=output_name)
+        if manifest:
+            row.update(status='ok', prediction=manifest.prediction, confidence=manifest.confidence,
+                       output_folder=manifest.output_folder)
+            row.update({f"{stage}_s": seconds for stage, seconds in manifest.stage_times.items()})
+        else:
+            row['error'] = "Pipeline step failed"
+    except Exception as e:
+        logger.exception("Batch clip %s failed", video_path)
+        row['error'] = f"{type(e).__name__}: {e}"
+    row['total_s'] = round(time.time() - start_time, 3)
+    return row
+
+def _batch_output_names(videos):
+    """
+    Output folder name per video: its name, with _2, _3, ... added for
+    later videos with the same name, so parallel workers never share a folder
+    """
+    names = [os.path.splitext(os.path.basename(video))[0] for video in videos]
+    taken = set(names)
+    output_names = {}
+    seen = set()
+    for video, name in zip(videos, names):
+        output_name = name
+        if name in seen:
+            suffix = 2
+            while f"{name}_{suffix}" in taken:
+                suffix += 1
+            output_name = f"{name}_{suffix}"
+            taken.add(output_name)
+            print(f"Note: {video} has the name of an earlier video, its outputs go to {output_name}")
+        seen.add(name)
+        output_names[video] = output_name
+    return output_names
+
+def process_batch(inputs, output_base_folder=None, model_path='penalty_conv3d_model.h5', workers=1,
+                  streaming=True, results_path=None):
+    """
+    Process many videos with the models loaded once per worker.
+
+    Args:
+        inputs: Directories, .txt file lists and/or video paths
+        workers: Number of worker processes; 1 runs in this process. Each
+            worker holds its own MMPose inferencer and Keras model
+        streaming: Use the single-decode pipeline for each clip
+        results_path: CSV results table, by default batch_results.csv in
+            the output folder
+
+    Returns the result rows, one per video in input order. A failing clip
+    is recorded with its error and does not stop the batch.
+    """
+    if output_base_folder is None:
+        output_base_folder = "Processed_Videos"
+    create_folder(output_base_folder)
+    if results_path is None:
+        results_path = os.path.join(output_base_folder, "batch_results.csv")
+
+    videos = collect_videos(inputs)
+    output_names = _batch_output_names(videos)
+
+    start_time = time.time()
+    print(f"Batch: {len(videos)} videos, {workers} worker(s)")
+    rows = []
+    if workers <= 1:
+        init_worker(model_path)
+        for idx, video_path in enumerate(videos, 1):
+            print(f"\n[{idx}/{len(videos)}] {video_path}")
+            rows.append(_batch_process_one(video_path, output_base_folder, model_path, streaming,
+                                           output_names[video_path]))
+    else:
+        # spawn so each worker initializes CUDA itself
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=init_worker, initargs=(model_path,)) as pool:
+            futures = {
+                pool.submit(_batch_process_one, video_path, output_base_folder, model_path, streaming,
+                            output_names[video_path]): video_path
+                for video_path in videos
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                video_path = futures[future]
+                try:
+                    row = future.result()
+                except Exception as e:
+                    # The worker process itself died
+                    row = {'video': video_path, 'status': 'failed', 'total_s': 0.0,
+                           'error': f"{type(e).__name__}: {e}"}
+                print(f"[{done}/{len(videos)}] {video_path}: {row['status']}")
+                rows.append(row)
+        order = {video_path: idx for idx, video_path in enumerate(videos)}
+        rows.sort(key=lambda row: order[row['video']])
+
+    write_batch_csv(rows, results_path, BATCH_FIELDS, BATCH_TIMINGS)
+    succeeded = sum(1 for row in rows if row['status'] == 'ok')
+    print(f"\n{'='*50}")
+    print_batch_table(rows, BATCH_TIMINGS)
+    print(f"\n{succeeded}/{len(rows)} videos processed in {time.time() - start_time:.2f} seconds")
+    print(f"Results table: {results_path}")
+    print(f"{'='*50}")
+    return rows
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python MasterScript.py <video_file.mp4> [output_folder] [model_path]")
+    configure_logging()
+    # Flags may appear anywhere; the rest are positional. Options take --name=value
+    flags = {arg.split('=', 1)[0] for arg in sys.argv[1:] if arg.startswith('--')}
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) < 1:
+        print("Usage: python MasterScript.py <video_file.mp4> [output_folder] [model_path] [--streaming] [--write-intermediates] [--no-cache] [--input=clip|keypoints]")
+        print("       python MasterScript.py --batch <folder|list.txt|video>... [--output=FOLDER] [--model=PATH] [--workers=N] [--file-mode]")
         return
     
-    video_path = sys.argv[1]
+    if '--batch' in flags:
+        process_batch(
+            args,
+            options.get('output'),
+            options.get('model', 'penalty_conv3d_model.h5'),
+            workers=int(options.get('workers', 1)),
+            streaming='--file-mode' not in flags
+        )
+        return
+    
+    video_path = args[0]
+    input_kind = options.get('input', 'video')
+    if input_kind not in INPUT_KINDS:
+        print(f"Error: --input must be one of {', '.join(INPUT_KINDS)}")
+        return
     
     if not os.path.exists(video_path):
         print(f"Error: Video file {video_path} not found")
         return
     
     output_folder = None
-    if len(sys.argv) >= 3:
-        output_folder = sys.argv[2]
+    if len(args) >= 2:
+        output_folder = args[1]
     
     model_path = 'penalty_conv3d_model.h5'
-    if len(sys.argv) >= 4:
-        model_path = sys.argv[3]
+    if len(args) >= 3:
+        model_path = args[2]
     
     if not os.path.exists(model_path):
         print(f"Warning: Model file {model_path} not found. Make sure it's in the correct location.")
     
-    process_single_video(video_path, output_folder, model_path)
+    process_single_video(
+        video_path, output_folder, model_path,
+        streaming='--streaming' in flags,
+        write_intermediates='--write-intermediates' in flags,
+        use_cache='--no-cache' not in flags,
+        input_kind=input_kind
+    )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
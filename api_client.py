@@ -3,67 +3,350 @@
 Football Penalty Analysis API Client
 
 This script allows you to send videos to the Football Penalty Analysis API server,
-check processing status, and download the results.
+check processing status, and download the results. Batch mode sends many
+videos (files, folders or .txt lists of paths) with several in flight at
+once over one pooled connection, and writes a summary table.
+
+On slow links, --send clip uploads only the 26 frames the pipeline uses
+(FrameClipper26's selection, made here with OpenCV), and --send keypoints
+only their pose keypoints (needs MMPose installed here); the server skips
+the stages already done. Videos shorter than 26 frames are sent whole.
 
 Usage:
     python api_client.py --video path/to/video.mp4 --server http://192.168.18.10
+    python api_client.py --batch session_clips/ --concurrency 4 --server http://192.168.18.10
+    python api_client.py --video path/to/video.mp4 --send clip --server http://192.168.18.10
 """
 
 import argparse
+import hashlib
+import json
 import os
 import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from batch_report import write_batch_csv, print_batch_table
+
+# Bytes per chunk for resumable uploads, and attempts per chunk before giving up
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_RETRIES = 5
+# Upload sessions in progress, so an interrupted upload resumes on the next run
+UPLOAD_STATE_FILE = '.penalty_uploads.json'
+# Batch uploads in flight read and write the state file from several threads
+_upload_state_lock = threading.Lock()
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+# What is uploaded for a video: the video, its 26 selected frames as a video,
+# or their keypoints as JSON (the server's upload inputs)
+SEND_MODES = ('video', 'clip', 'keypoints')
+# Where reduced uploads are prepared; kept so an interrupted upload resumes
+PREPARED_FOLDER = '.penalty_prepared'
+
+def _load_upload_state():
+    try:
+        with open(UPLOAD_STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_upload_state(state):
+    with open(UPLOAD_STATE_FILE, 'w') as f:
+        json.dump(state, f, indent=2)
+
+def _set_upload_state(key, upload_id):
+    """Remember (or, with upload_id None, forget) the upload session of a file"""
+    with _upload_state_lock:
+        state = _load_upload_state()
+        if upload_id:
+            state[key] = upload_id
+        else:
+            state.pop(key, None)
+        _save_upload_state(state)
+
+def _upload_key(server_url, video_path):
+    """Identifies one version of a file uploaded to one server"""
+    stat = os.stat(video_path)
+    return f"{server_url}|{os.path.abspath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+class _ChunkBody:
+    """
+    Request body of length bytes from f, read in blocks that advance the
+    progress bar as they are sent. Having a length makes requests send a
+    Content-Length instead of a chunked transfer encoding.
+    """
+
+    def __init__(self, f, length, pbar, block_size=256 * 1024):
+        self.f = f
+        self.length = length
+        self.pbar = pbar
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        remaining = self.length
+        while remaining > 0:
+            block = self.f.read(min(self.block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+            self.pbar.update(len(block))
+
+def _wait_retry_after(response, attempt):
+    delay = int(response.headers.get('Retry-After', 0) or 0) if response is not None else 0
+    time.sleep(max(delay, min(2 ** attempt, 30)))
+
+# Pose inferencer for --send keypoints, loaded on first use and shared by batch threads
+_infer3d = None
+_infer3d_lock = threading.Lock()
 
-def send_video(server_url, video_path):
-    """Upload a video to the API server for processing"""
+def _infer_keypoints(video_path):
+    """Infer3D keypoints of the 26 frames FrameClipper26 selects from video_path, as the server's pose stage makes them"""
+    global _infer3d
+    import cv2
+    from Classified_Clips.FrameClipper26 import select_frame_indices
+    from Classified_Clips.MMpose import Infer3D
+    
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while cap.isOpened():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        return None
+    clip_frames = [frames[i] for i in select_frame_indices(len(frames))]
+    with _infer3d_lock:
+        if _infer3d is None:
+            _infer3d = Infer3D()
+        with tempfile.TemporaryDirectory() as output_folder:
+            _, keypoints_list = _infer3d.process_frames(clip_frames, 'clip', output_folder, return_vis=False)
+    return keypoints_list
+
+def _clip_frame_count(clip_path):
+    """Frame count from a prepared clip's header, as the server checks it"""
+    import cv2
+    cap = cv2.VideoCapture(clip_path)
+    try:
+        return int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if cap.isOpened() else 0
+    finally:
+        cap.release()
+
+def prepare_upload(video_path, send='video'):
+    """
+    The file to upload for video_path with the given send mode (one of
+    SEND_MODES): the video itself, its 26 selected frames as an mp4, or
+    their keypoints as compact JSON. Prepared files are reused while the
+    video is unchanged. A video too short for a 26-frame clip is sent as
+    it is. Returns (path, send mode used), or (None, send) if preparing
+    failed.
+    """
+    if send == 'video' or not os.path.exists(video_path):
+        return video_path, 'video'
+    base_name = os.path.splitext(os.path.basename(video_path))[0]
+    # One folder per source video, so videos with the same name do not collide
+    folder = os.path.join(PREPARED_FOLDER, hashlib.sha1(os.path.abspath(video_path).encode()).hexdigest()[:12])
+    prepared_path = os.path.join(folder, base_name + ('.json' if send == 'keypoints' else '.mp4'))
+    if os.path.exists(prepared_path) and os.path.getmtime(prepared_path) >= os.path.getmtime(video_path):
+        return _checked_upload(video_path, prepared_path, send)
+    
+    print(f"Preparing {send} of {os.path.basename(video_path)}...")
+    try:
+        if send == 'clip':
+            from Classified_Clips.FrameClipper26 import extract_26_frames
+            if not extract_26_frames(video_path, folder, output_filename=os.path.basename(prepared_path)):
+                raise RuntimeError("Could not select the 26 frames")
+        else:
+            keypoints_list = _infer_keypoints(video_path)
+            if not keypoints_list:
+                raise RuntimeError("Could not decode the video")
+            os.makedirs(folder, exist_ok=True)
+            with open(prepared_path + '.tmp', 'w') as f:
+                json.dump(keypoints_list, f, separators=(',', ':'))
+            os.replace(prepared_path + '.tmp', prepared_path)
+    except Exception as e:
+        print(f"Error preparing {send} upload: {e}")
+        if os.path.exists(prepared_path):
+            os.remove(prepared_path)
+        return None, send
+    
+    upload_path, send = _checked_upload(video_path, prepared_path, send)
+    if upload_path == prepared_path:
+        reduction = os.path.getsize(video_path) / max(1, os.path.getsize(prepared_path))
+        print(f"Prepared {prepared_path}: {os.path.getsize(prepared_path)} bytes, {reduction:.0f}x smaller than the video")
+    return upload_path, send
+
+def _checked_upload(video_path, prepared_path, send):
+    """
+    (path, send mode) for a prepared upload. The server only takes clips of
+    exactly 26 frames, which a shorter video cannot give, so those are
+    replaced by the video.
+    """
+    if send == 'clip':
+        frames = _clip_frame_count(prepared_path)
+        if frames != 26:
+            print(f"Note: the clip of {os.path.basename(video_path)} has {frames} frames, not 26; "
+                  f"uploading the video instead")
+            return video_path, 'video'
+    return prepared_path, send
+
+def send_video(server_url, video_path, session=None, render=None, progress=True, send=None):
+    """
+    Upload a video to the API server for processing, in resumable chunks.
+    render is the server's render mode ('background', 'inline' or 'none';
+    default: the server's, which answers with the prediction first).
+    A chunk that fails is retried from the offset the server reports, and
+    an upload interrupted in an earlier run resumes where it stopped.
+    Falls back to a single multipart upload on servers without the
+    chunked upload API. progress False hides the progress bar. send is
+    what video_path holds when it was made by prepare_upload ('clip' or
+    'keypoints').
+    """
     if not os.path.exists(video_path):
         print(f"Error: Video file not found at {video_path}")
         return None
     
+    http = session or requests
     print(f"Uploading video: {os.path.basename(video_path)}")
-    upload_url = f"{server_url}/api/process_video"
-    
-    # Get file size for progress bar
     file_size = os.path.getsize(video_path)
+    key = _upload_key(server_url, video_path)
+    with _upload_state_lock:
+        state = _load_upload_state()
     
     try:
-        with open(video_path, 'rb') as video_file:
-            # Create a progress bar for upload
-            with tqdm(total=file_size, unit='B', unit_scale=True, desc="Uploading") as pbar:
-                files = {'video': (os.path.basename(video_path), video_file, 'video/mp4')}
-                
-                # Use a custom monitor to track upload progress
-                def upload_progress(monitor):
-                    pbar.update(monitor.bytes_read - pbar.n)
+        # Resume an earlier session for this file if the server still has it
+        upload = None
+        if key in state:
+            response = http.get(f"{server_url}/api/uploads/{state[key]}", timeout=30)
+            if response.status_code == 200:
+                upload = response.json()
+                print(f"Resuming upload at {upload['offset']} of {file_size} bytes")
+        if upload is None:
+            # The server turns new uploads away while its queue is full
+            for attempt in range(UPLOAD_RETRIES + 1):
+                body = {'filename': os.path.basename(video_path), 'size': file_size}
+                if send:
+                    body['input'] = send
+                response = http.post(f"{server_url}/api/uploads", json=body, timeout=30)
+                if response.status_code != 429:
+                    break
+                print(f"Server busy, retrying in {response.headers.get('Retry-After', '?')} seconds")
+                _wait_retry_after(response, attempt)
+            if response.status_code == 404:
+                return _send_video_multipart(server_url, video_path, http, render, progress, send)
+            if response.status_code not in (200, 201):
+                print(f"Error uploading video: {response.status_code}")
+                print(response.text)
+                return None
+            upload = response.json()
+            _set_upload_state(key, upload['upload_id'])
+        
+        upload_url = f"{server_url}/api/uploads/{upload['upload_id']}"
+        offset = upload['offset']
+        attempt = 0
+        with open(video_path, 'rb') as video_file, \
+                tqdm(total=file_size, initial=offset, unit='B', unit_scale=True, desc="Uploading",
+                     disable=not progress) as pbar:
+            while offset < file_size:
+                length = min(UPLOAD_CHUNK_SIZE, file_size - offset)
+                video_file.seek(offset)
+                headers = {
+                    'Content-Range': f"bytes {offset}-{offset + length - 1}/{file_size}",
+                    'Content-Type': 'application/octet-stream'
+                }
+                response = None
+                try:
+                    response = http.put(upload_url, data=_ChunkBody(video_file, length, pbar),
+                                        headers=headers, timeout=120)
+                    if response.status_code == 200:
+                        offset = response.json()['offset']
+                        attempt = 0
+                        continue
+                except requests.RequestException as e:
+                    print(f"\nChunk upload interrupted: {e}")
                 
-                response = requests.post(
-                    upload_url, 
-                    files=files,
-                    timeout=600  # 10 minute timeout for large videos
-                )
+                attempt += 1
+                if attempt > UPLOAD_RETRIES:
+                    print("Error uploading video: too many failed attempts, run again to resume")
+                    return None
+                if response is not None and response.status_code not in (409, 429) and response.status_code < 500:
+                    print(f"Error uploading video: {response.status_code}")
+                    print(response.text)
+                    return None
+                _wait_retry_after(response, attempt)
                 
+                # Ask the server how much it actually has and continue from there
+                try:
+                    status = http.get(upload_url, timeout=30)
+                    if status.status_code == 200:
+                        offset = status.json()['offset']
+                except requests.RequestException:
+                    pass
+                pbar.n = offset
+                pbar.refresh()
+        
+        # Queue the complete upload, waiting while the server is busy
+        options = {name: value for name, value in (('render', render), ('input', send)) if value}
+        for attempt in range(UPLOAD_RETRIES + 1):
+            response = http.post(f"{upload_url}/complete", json=options or None, timeout=60)
+            if response.status_code != 429:
+                break
+            print(f"Server busy, retrying in {response.headers.get('Retry-After', '?')} seconds")
+            _wait_retry_after(response, attempt)
+        
         if response.status_code != 200:
             print(f"Error uploading video: {response.status_code}")
             print(response.text)
             return None
-            
+        
+        _set_upload_state(key, None)
+        
         result = response.json()
         task_id = result.get('task_id')
         print(f"✅ Upload successful! Task ID: {task_id}")
+        if result.get('cached'):
+            print("This video was processed before, results are ready")
         return task_id
         
     except Exception as e:
         print(f"Error uploading video: {e}")
         return None
 
-def check_status(server_url, task_id):
+def _send_video_multipart(server_url, video_path, http, render=None, progress=True, send=None):
+    """Single-request upload for servers without /api/uploads"""
+    file_size = os.path.getsize(video_path)
+    options = {name: value for name, value in (('render', render), ('input', send)) if value}
+    content_type = 'application/json' if send == 'keypoints' else 'video/mp4'
+    with open(video_path, 'rb') as video_file:
+        with tqdm(total=file_size, unit='B', unit_scale=True, desc="Uploading", disable=not progress) as pbar:
+            files = {'video': (os.path.basename(video_path), video_file, content_type)}
+            response = http.post(f"{server_url}/api/process_video", files=files, data=options or None, timeout=600)
+            pbar.update(file_size)
+    
+    if response.status_code != 200:
+        print(f"Error uploading video: {response.status_code}")
+        print(response.text)
+        return None
+    
+    task_id = response.json().get('task_id')
+    print(f"✅ Upload successful! Task ID: {task_id}")
+    return task_id
+
+def check_status(server_url, task_id, session=None):
     """Check the processing status of a video"""
+    http = session or requests
     status_url = f"{server_url}/api/status/{task_id}"
     
     try:
-        response = requests.get(status_url)
+        response = http.get(status_url, timeout=30)
         if response.status_code != 200:
             print(f"Error checking status: {response.status_code}")
             print(response.text)
@@ -75,28 +358,157 @@ def check_status(server_url, task_id):
         print(f"Error checking status: {e}")
         return None
 
-def download_file(url, output_path):
-    """Download a file with progress bar"""
+# Seconds to wait for a status change in one long poll
+STATUS_WAIT = 25
+
+def _read_events(response):
+    """
+    Parse a Server-Sent Events response into (event id, event type, data)
+    tuples; keep-alive comments come through as type None
+    """
+    event_id, event_type, data = None, 'message', []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield event_id, event_type, '\n'.join(data)
+            event_type, data = 'message', []
+        elif line.startswith(':'):
+            yield event_id, None, None
+        else:
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if field == 'id':
+                event_id = value
+            elif field == 'event':
+                event_type = value
+            elif field == 'data':
+                data.append(value)
+
+def _rendering(status_data):
+    """True while the visualization is still to come from a background render"""
+    return status_data.get('render_status') in ('pending', 'rendering')
+
+def _is_finished(status_data):
+    return status_data.get('status') in ('completed', 'error') and not _rendering(status_data)
+
+def watch_status(server_url, task_id, session=None, timeout=None):
+    """
+    Yield the job status each time it changes until it completes or fails.
+    Follows the server's /api/events stream, reconnecting where it left
+    off; falls back to long-polling /api/status on servers without it, and
+    to plain polling on servers without long polls. Stops after timeout
+    seconds, if given.
+    """
+    http = session or requests
+    deadline = time.time() + timeout if timeout else None
+    version = None
+    use_events = True
+    failures = 0
+    while deadline is None or time.time() < deadline:
+        try:
+            if use_events:
+                headers = {'Accept': 'text/event-stream'}
+                if version:
+                    headers['Last-Event-ID'] = version
+                with http.get(f"{server_url}/api/events/{task_id}", headers=headers, stream=True,
+                              timeout=(10, 60)) as response:
+                    if response.status_code == 404 and 'text/event-stream' not in response.headers.get('Content-Type', ''):
+                        # Old server, or the task is gone: the status endpoint tells which
+                        use_events = False
+                        continue
+                    response.raise_for_status()
+                    for event_id, event_type, data in _read_events(response):
+                        failures = 0
+                        if deadline and time.time() >= deadline:
+                            return
+                        if event_type is None:
+                            continue
+                        if event_type == 'deleted':
+                            return
+                        status_data = json.loads(data)
+                        version = event_id or status_data.get('version')
+                        yield status_data
+                        if _is_finished(status_data):
+                            return
+                continue
+            
+            params = {'wait': STATUS_WAIT, 'version': version} if version else {}
+            response = http.get(f"{server_url}/api/status/{task_id}", params=params, timeout=STATUS_WAIT + 30)
+            if response.status_code != 200:
+                print(f"Error checking status: {response.status_code}")
+                print(response.text)
+                return
+            failures = 0
+            status_data = response.json()
+            if 'version' not in status_data:
+                # No long polls on this server
+                time.sleep(5)
+            elif status_data['version'] == version:
+                continue
+            version = status_data.get('version')
+            yield status_data
+            if _is_finished(status_data):
+                return
+        except (requests.RequestException, ValueError) as e:
+            failures += 1
+            if failures > 5:
+                print(f"Error checking status: {e}")
+                return
+            time.sleep(min(2 ** failures, 30))
+
+def _describe_progress(status_data):
+    if status_data.get('status') == 'completed' and _rendering(status_data):
+        if status_data.get('render_frames_total'):
+            return f"rendering {status_data.get('render_frames_done', 0)}/{status_data['render_frames_total']} frames"
+        return f"rendering {status_data['render_status']}"
+    stage = status_data.get('stage') or status_data.get('status')
+    if status_data.get('status') == 'queued' and status_data.get('queue_position'):
+        return f"queued, position {status_data['queue_position']}"
+    if status_data.get('frames_total'):
+        return f"{stage} {status_data.get('frames_done', 0)}/{status_data['frames_total']} frames"
+    return stage
+
+def download_file(url, output_path, session=None, progress=True):
+    """
+    Download a file with progress bar. Bytes go to <output_path>.part
+    first; if that exists from an interrupted download, only the rest is
+    requested with a Range header.
+    """
+    http = session or requests
+    partial_path = output_path + '.part'
     try:
-        response = requests.get(url, stream=True)
-        if response.status_code != 200:
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        response = http.get(url, stream=True, headers=headers, timeout=(10, 120))
+        if response.status_code == 416:
+            # Nothing left to fetch: the partial file is the whole file
+            response = None
+        elif response.status_code == 200:
+            # Range not honoured, start over
+            offset = 0
+        elif response.status_code != 206:
             print(f"Error downloading file: {response.status_code}")
             return False
         
-        # Get file size if available
-        total_size = int(response.headers.get('content-length', 0))
-        
         # Create directory if it doesn't exist
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
-        # Download with progress bar
-        with open(output_path, 'wb') as f:
-            with tqdm(total=total_size, unit='B', unit_scale=True, desc=f"Downloading {os.path.basename(output_path)}") as pbar:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        pbar.update(len(chunk))
+        if response is not None:
+            # Get file size if available
+            total_size = offset + int(response.headers.get('content-length', 0))
+            
+            # Download with progress bar
+            with open(partial_path, 'ab' if offset else 'wb') as f:
+                with tqdm(total=total_size, initial=offset, unit='B', unit_scale=True,
+                          desc=f"Downloading {os.path.basename(output_path)}", disable=not progress) as pbar:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        if chunk:
+                            f.write(chunk)
+                            pbar.update(len(chunk))
         
+        os.replace(partial_path, output_path)
         print(f"✅ Downloaded: {output_path}")
         return True
         
@@ -104,11 +516,197 @@ def download_file(url, output_path):
         print(f"Error downloading file: {e}")
         return False
 
+def download_results(server_url, task_id, video_path, output_dir, render=None, session=None, progress=True):
+    """
+    Download a finished task's visualization (or the processed clip if
+    there is none) and keypoints video into output_dir; returns
+    {file type: path} of the files downloaded
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    base_filename = os.path.splitext(os.path.basename(video_path))[0]
+    downloaded = {}
+    
+    def fetch(file_type):
+        url = f"{server_url}/api/download/{task_id}/{file_type}"
+        path = os.path.join(output_dir, f"{base_filename}_{file_type}.mp4")
+        if download_file(url, path, session=session, progress=progress):
+            downloaded[file_type] = path
+            return True
+        return False
+    
+    # Download visualization file
+    if render == 'none' or not fetch('visualization'):
+        print("Trying alternative visualization file names...")
+        fetch('processed')
+    
+    # Download keypoints file
+    fetch('keypoints')
+    return downloaded
+
+def cleanup_task(server_url, task_id, session=None):
+    """Delete a task's upload and results on the server"""
+    http = session or requests
+    try:
+        response = http.delete(f"{server_url}/api/cleanup/{task_id}", timeout=30)
+        if response.status_code == 200:
+            print("✅ Cleanup successful!")
+            return True
+        print(f"⚠️ Warning: Cleanup failed with status code {response.status_code}")
+    except Exception as e:
+        print(f"⚠️ Warning: Cleanup error: {e}")
+    return False
+
+def collect_videos(inputs):
+    """
+    Expand batch inputs into video paths: directories are searched
+    recursively, .txt files list one video path per line, anything else is
+    taken as a video file
+    """
+    videos = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                videos.extend(os.path.join(root, file) for file in sorted(files)
+                              if file.lower().endswith(VIDEO_EXTENSIONS))
+        elif item.lower().endswith('.txt'):
+            with open(item) as f:
+                videos.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+        else:
+            videos.append(item)
+    # Keep the first occurrence of videos listed more than once
+    return list(dict.fromkeys(videos))
+
+def make_session(pool_size=1):
+    """Session that keeps up to pool_size connections to the server open for reuse"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def run_batch_item(server_url, video_path, output_root, render=None, timeout=None, session=None, send='video'):
+    """
+    Prepare (see prepare_upload), upload, wait for, download and clean up
+    one video of a batch. Never raises; returns a summary row with the
+    result, timings in seconds and any error.
+    """
+    start_time = time.time()
+    row = {'video': video_path, 'status': 'failed'}
+    try:
+        upload_path, send = prepare_upload(video_path, send)
+        row['prepare_s'] = time.time() - start_time
+        if not upload_path:
+            row['error'] = f"Could not prepare the {send} upload"
+            return row
+        if os.path.exists(upload_path):
+            row['upload_bytes'] = os.path.getsize(upload_path)
+        upload_start = time.time()
+        task_id = send_video(server_url, upload_path, session=session, render=render, progress=False,
+                             send=send if send != 'video' else None)
+        row['upload_s'] = time.time() - upload_start
+        if not task_id:
+            row['error'] = 'Upload failed'
+            return row
+        row['task_id'] = task_id
+        
+        uploaded_at = time.time()
+        final = None
+        for status_data in watch_status(server_url, task_id, session=session, timeout=timeout):
+            if status_data.get('prediction') and 'prediction_s' not in row:
+                row['prediction_s'] = time.time() - uploaded_at
+            final = status_data
+        row['processing_s'] = time.time() - uploaded_at
+        if final is None or not _is_finished(final):
+            row['error'] = 'Processing did not complete in time'
+            return row
+        row['prediction'] = final.get('prediction')
+        row['confidence'] = final.get('confidence')
+        if final['status'] == 'error':
+            row['error'] = final.get('error')
+            return row
+        if final.get('render_status') == 'error':
+            row['error'] = f"Rendering failed: {final.get('render_error')}"
+        
+        if send != 'keypoints':
+            # Keypoints uploads have nothing to download besides the prediction
+            download_start = time.time()
+            row['output_folder'] = os.path.join(output_root, f"task_{task_id}")
+            downloaded = download_results(server_url, task_id, video_path, row['output_folder'], render,
+                                          session=session, progress=False)
+            row['download_s'] = time.time() - download_start
+            if 'keypoints' not in downloaded:
+                row['error'] = row.get('error') or 'Download failed'
+                return row
+        cleanup_task(server_url, task_id, session=session)
+        row['status'] = 'ok'
+    except Exception as e:
+        row['error'] = str(e)
+    finally:
+        row['total_s'] = time.time() - start_time
+        for timing in BATCH_TIMINGS:
+            if f"{timing}_s" in row:
+                row[f"{timing}_s"] = round(row[f"{timing}_s"], 3)
+    return row
+
+# Columns of the batch summary table (see batch_report)
+BATCH_FIELDS = ('video', 'task_id', 'status', 'prediction', 'confidence', 'upload_bytes')
+BATCH_TIMINGS = ('prepare', 'upload', 'prediction', 'processing', 'download', 'total')
+
+def run_batch(server_url, inputs, output_root, concurrency=4, render=None, timeout=None, results_path=None,
+              send='video'):
+    """
+    Send every video in inputs (see collect_videos) with up to concurrency
+    of them in flight, over one session with a connection pool of that
+    size, as send (one of SEND_MODES). Prints and writes (results_path,
+    CSV) a summary table; returns its rows in input order.
+    """
+    videos = collect_videos(inputs)
+    if not videos:
+        print("No videos found")
+        return []
+    session = make_session(concurrency)
+    start_time = time.time()
+    print(f"Batch: {len(videos)} videos, {concurrency} at a time")
+    
+    rows = [None] * len(videos)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(run_batch_item, server_url, video, output_root, render, timeout, session, send): index
+                   for index, video in enumerate(videos)}
+        for done, future in enumerate(as_completed(futures), 1):
+            row = rows[futures[future]] = future.result()
+            outcome = row.get('prediction') or row.get('error') or '-'
+            print(f"[{done}/{len(videos)}] {os.path.basename(row['video'])}: {row['status']} ({outcome}), "
+                  f"{row['total_s']:.1f} s")
+    
+    elapsed = time.time() - start_time
+    print()
+    print_batch_table(rows, BATCH_TIMINGS)
+    succeeded = sum(row['status'] == 'ok' for row in rows)
+    print(f"\n{succeeded}/{len(rows)} videos succeeded in {elapsed:.1f} s "
+          f"({len(rows) / elapsed * 60:.1f} videos/min)")
+    if results_path:
+        print(f"Summary written to {write_batch_csv(rows, results_path, BATCH_FIELDS, BATCH_TIMINGS)}")
+    return rows
+
 def main():
     parser = argparse.ArgumentParser(description="Football Penalty Analysis API Client")
-    parser.add_argument("--video", required=True, help="Path to the video file to upload")
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument("--video", help="Path to the video file to upload")
+    inputs.add_argument("--batch", nargs="+", metavar="PATH",
+                        help="Videos, folders of videos or .txt files listing video paths to send as a batch")
     parser.add_argument("--server", default="http://192.168.18.10", help="API server URL (default: http://192.168.18.10)")
     parser.add_argument("--output", default="./results", help="Directory to save downloaded results (default: ./results)")
+    parser.add_argument("--render", choices=["background", "inline", "none"],
+                        help="When the server renders the goal visualization: after answering with the "
+                             "prediction (background, server default), before answering (inline) or never (none)")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="Seconds to wait for processing to finish (default: 600)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Batch videos in flight at once (default: 4)")
+    parser.add_argument("--results", help="Batch summary CSV (default: <output>/batch_results.csv)")
+    parser.add_argument("--send", choices=SEND_MODES, default="video",
+                        help="Upload the whole video (default), only the 26 frames the pipeline uses (clip), "
+                             "or only their pose keypoints (keypoints, needs MMPose installed here)")
     
     args = parser.parse_args()
     
@@ -117,8 +715,22 @@ def main():
     
     print(f"🚀 Connecting to server: {server_url}")
     
-    # Step 1: Upload video
-    task_id = send_video(server_url, args.video)
+    if args.batch:
+        rows = run_batch(server_url, args.batch, args.output, max(1, args.concurrency), args.render, args.timeout,
+                         args.results or os.path.join(args.output, 'batch_results.csv'), args.send)
+        if not rows or any(row['status'] != 'ok' for row in rows):
+            sys.exit(1)
+        return
+    
+    # One connection kept alive for the upload, status and downloads
+    session = make_session()
+    
+    # Step 1: Upload video, or the part of it the server needs
+    upload_path, send = prepare_upload(args.video, args.send)
+    if not upload_path:
+        sys.exit(1)
+    task_id = send_video(server_url, upload_path, session=session, render=args.render,
+                         send=send if send != 'video' else None)
     if not task_id:
         sys.exit(1)
     
@@ -126,90 +738,54 @@ def main():
     print("\n⏳ Checking processing status...")
     
     completed = False
-    max_checks = 60  # Check for up to 5 minutes (5 seconds between checks)
-    check_count = 0
+    prediction_shown = False
     
     with tqdm(total=100, desc="Processing") as pbar:
-        last_progress = 0
-        
-        while not completed and check_count < max_checks:
-            status_data = check_status(server_url, task_id)
-            
-            if not status_data:
-                print("Failed to get status. Retrying...")
-                time.sleep(5)
-                check_count += 1
-                continue
-                
+        for status_data in watch_status(server_url, task_id, session=session, timeout=args.timeout):
             status = status_data.get('status')
-            progress = status_data.get('progress', 0)
+            if status_data.get('prediction') and not prediction_shown:
+                # Arrives before the visualization is rendered
+                confidence = status_data.get('confidence')
+                confidence_text = f" (confidence: {confidence:.2f})" if confidence is not None else ""
+                tqdm.write(f"🎯 Prediction: {status_data['prediction']}{confidence_text}")
+                prediction_shown = True
             
-            # Update progress bar
-            if progress > last_progress:
-                pbar.update(progress - last_progress)
-                last_progress = progress
+            if status == 'completed' and _rendering(status_data):
+                pbar.set_description("Rendering")
+                pbar.n = status_data.get('render_progress') or 0
+            else:
+                pbar.n = status_data.get('progress') or 0
+            pbar.set_postfix_str(_describe_progress(status_data))
             
-            if status == 'completed':
-                pbar.update(100 - last_progress)  # Ensure we reach 100%
-                completed = True
-                print("✅ Processing completed successfully!")
-            elif status == 'error':
+            if status == 'error':
                 print(f"❌ Processing error: {status_data.get('error')}")
                 sys.exit(1)
-            else:
-                # Wait before checking again
-                time.sleep(5)
-                check_count += 1
+            elif _is_finished(status_data):
+                pbar.n = 100  # Ensure we reach 100%
+                pbar.refresh()
+                completed = True
+                print("✅ Processing completed successfully!")
+                if status_data.get('render_status') == 'error':
+                    print(f"⚠️ Warning: Rendering failed: {status_data.get('render_error')}")
+                break
     
     if not completed:
         print("❌ Processing did not complete within the expected time.")
         sys.exit(1)
     
-    # Step 3: Download result files
-    print("\n📥 Downloading result files...")
-    
-    # Create output directory
+    # Step 3: Download result files; a keypoints upload has only the prediction
     output_dir = os.path.join(args.output, f"task_{task_id}")
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Get the base filename from the original video
-    base_filename = os.path.splitext(os.path.basename(args.video))[0]
-    
-    # Get status data to check available files
-    status_data = check_status(server_url, task_id)
-    download_urls = status_data.get('download_urls', {})
-    
-    # Download visualization file
-    print("Attempting to download visualization file...")
-    viz_url = f"{server_url}/api/download/{task_id}/visualization"
-    viz_path = os.path.join(output_dir, f"{base_filename}_visualization.mp4")
-    viz_success = download_file(viz_url, viz_path)
-    
-    if not viz_success:
-        print("Trying alternative visualization file names...")
-        alt_viz_url = f"{server_url}/api/download/{task_id}/processed"
-        alt_viz_path = os.path.join(output_dir, f"{base_filename}_processed.mp4")
-        download_file(alt_viz_url, alt_viz_path)
-    
-    # Download keypoints file
-    print("Attempting to download keypoints file...")
-    keypoints_url = f"{server_url}/api/download/{task_id}/keypoints"
-    keypoints_path = os.path.join(output_dir, f"{base_filename}_keypoints.mp4")
-    download_file(keypoints_url, keypoints_path)
+    if send != 'keypoints':
+        print("\n📥 Downloading result files...")
+        download_results(server_url, task_id, args.video, output_dir, args.render, session=session)
     
     # Step 4: Clean up on server
     print("\n🧹 Cleaning up server resources...")
-    cleanup_url = f"{server_url}/api/cleanup/{task_id}"
-    
-    try:
-        response = requests.delete(cleanup_url)
-        if response.status_code == 200:
-            print("✅ Cleanup successful!")
-        else:
-            print(f"⚠️ Warning: Cleanup failed with status code {response.status_code}")
-    except Exception as e:
-        print(f"⚠️ Warning: Cleanup error: {e}")
+    cleanup_task(server_url, task_id, session=session)
     
+    if send == 'keypoints':
+        print("\n✨ All done!")
+        return
     print("\n✨ All done! Your processed videos are available in:")
     print(f"   {os.path.abspath(output_dir)}")
 
@@ -1,31 +1,246 @@
 import os
+import hmac
+import json
 import time
 import uuid
 import shutil
-from flask import Flask, request, jsonify, send_file
+import mimetypes
+from urllib.parse import quote
+from flask import Flask, Response, request, jsonify, send_file
 import subprocess
-import threading
 from werkzeug.utils import secure_filename
 
 # Import MasterScript for direct calling
-from MasterScript import process_single_video
+from MasterScript import process_job, init_worker, result_params, progress_target, video_frame_count, INPUT_KINDS
+from manifest import PipelineManifest
+from log_utils import configure_logging
+from job_queue import JobScheduler, QueueFull
+from job_store import open_job_store, MemoryJobStore, QUEUED, PROCESSING, COMPLETED, ERROR
+from upload_sessions import UploadSessions, UploadError
+from result_cache import open_result_cache, save_stream
+from janitor import Janitor, janitor_settings, remove_job_files
+import metrics
 
 app = Flask(__name__)
+configure_logging()
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
+UPLOAD_SESSIONS_FOLDER = os.path.join(UPLOAD_FOLDER, 'sessions')
 PROCESSED_FOLDER = 'Processed_Videos'
 ALLOWED_EXTENSIONS = {'mp4', 'mov', 'avi'}
+# Classifier used by the workers (MasterScript.process_job default)
+MODEL_PATH = 'penalty_conv3d_model.h5'
 MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100 MB max upload
+# Suggested chunk size for resumable uploads; any size up to MAX_CONTENT_LENGTH works
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+# Pipeline worker processes (jobs running at once) and jobs allowed to wait.
+# With 0 worker processes, jobs run only on worker hosts (see worker.py).
+WORKER_PROCESSES = int(os.environ.get('PENALTY_WORKER_PROCESSES', 1))
+MAX_QUEUED_JOBS = int(os.environ.get('PENALTY_MAX_QUEUED_JOBS', 8))
+# Set to 0 on servers that should only accept uploads and serve results
+RUN_WORKERS = os.environ.get('PENALTY_RUN_WORKERS', '1') != '0'
+# Shared secret worker hosts send as X-Worker-Token. The /api/worker
+# endpoints are disabled unless it is set.
+WORKER_TOKEN = os.environ.get('PENALTY_WORKER_TOKEN')
+# Internal nginx location that serves PROCESSED_FOLDER (see nginx.sh). When
+# set, downloads are handed to nginx with X-Accel-Redirect instead of being
+# streamed by a Python worker.
+ACCEL_REDIRECT_PREFIX = os.environ.get('PENALTY_ACCEL_REDIRECT')
+# Job status pushes: store poll interval, SSE keep-alive and longest long-poll, in seconds
+STATUS_POLL_INTERVAL = 0.25
+EVENTS_HEARTBEAT = 15
+MAX_STATUS_WAIT = 30
+# How the goal visualization of an upload is rendered: 'background' (default)
+# answers with the prediction first and renders in a lower priority job,
+# 'inline' renders before the job completes, 'none' skips it
+RENDER_MODES = ('background', 'inline', 'none')
+RENDER_PRIORITY = -1
+# File types accepted per upload input (MasterScript.INPUT_KINDS): besides
+# the video, clients can send only the 26 selected frames as a video, or
+# their keypoints as JSON (api_client --send), and the stages already done
+# are skipped. Keypoints have no video to render, so render mode is 'none'.
+INPUT_EXTENSIONS = {'video': ALLOWED_EXTENSIONS, 'clip': ALLOWED_EXTENSIONS, 'keypoints': {'json'}}
 
 # Create necessary folders
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+upload_sessions = UploadSessions(UPLOAD_SESSIONS_FOLDER, MAX_CONTENT_LENGTH)
 
-# Track processing status
-processing_status = {}
+# Job records shared by every server process (PENALTY_JOB_STORE, default sqlite:///jobs.db)
+job_store = open_job_store()
+if isinstance(job_store, MemoryJobStore) and RUN_WORKERS and WORKER_PROCESSES > 0:
+    # Pool processes would each open an empty store and their progress would be lost
+    raise ValueError("PENALTY_JOB_STORE=memory:// only works without local worker processes "
+                     "(PENALTY_WORKER_PROCESSES=0); use sqlite:///path")
+# Results of earlier uploads by video content and model (PENALTY_RESULT_CACHE, see result_cache.py)
+result_cache = open_result_cache(MODEL_PATH, result_params)
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def render_job_id(task_id):
+    return f"{task_id}-render"
+
+def job_kind(job):
+    return job.get('kind', 'pipeline')
+
+def mark_processing(job):
+    metrics.observe('penalty_queue_wait_seconds', time.time() - job['created_at'], kind=job_kind(job))
+    # The worker reports real progress from here on (see progress.py)
+    job_store.update(job['task_id'], stage='starting', progress=0)
+    if job.get('kind') == 'render':
+        job_store.update(job['parent_id'], render_status='rendering')
+
+def mark_error(job, error):
+    fields = {'error': str(error)}
+    if job.get('kind') != 'render' and job.get('render_status') == 'pending':
+        # No render job follows a failed run; the job is finished
+        fields['render_status'] = 'skipped'
+    # Only the worker still holding the job may fail it; a requeued job is someone else's now
+    if not job_store.transition(job['task_id'], (PROCESSING,), ERROR, worker_id=job['claimed_by'], **fields):
+        print(f"Dropped error of job {job['task_id']}, it is no longer claimed by {job['claimed_by']}")
+        return
+    metrics.observe('penalty_job_seconds', time.time() - job['claimed_at'], kind=job_kind(job), status=ERROR)
+    if job.get('kind') == 'render':
+        # The prediction stands; only the visualization is missing
+        job_store.update(job['parent_id'], render_status='error', render_error=str(error))
+    print(f"Error processing video: {error}")
+
+def finish_render(job, manifest):
+    """Attach the visualization from a background render job to its upload's job"""
+    if not job_store.transition(job['task_id'], (PROCESSING,), COMPLETED, worker_id=job['claimed_by'],
+                                progress=100, completed_at=time.time(), visualization_file=manifest.visualization):
+        return False
+    job_store.update(job['parent_id'], visualization_file=manifest.visualization, render_status='completed',
+                     render_progress=100)
+    parent = job_store.get(job['parent_id'])
+    # A failed prediction (no confidence) is not cached, so the next upload retries it
+    if result_cache and parent and parent.get('upload_digest') and parent.get('confidence') is not None:
+        result_cache.store(parent['upload_digest'], parent, parent.get('input', INPUT_KINDS[0]))
+    return True
+
+def complete_job(job, manifest):
+    """Record the results of a finished upload job; returns False if the job is no longer this worker's"""
+    # Per-stage timings and resource usage of this run
+    with open(manifest.profile) as f:
+        profile = json.load(f)
+    
+    # The manifest lists exactly what this run produced, no searching needed
+    results = {
+        'visualization_file': manifest.visualization,
+        'keypoints_file': manifest.keypoints_video,
+        'processed_file': manifest.clipped_video,
+        'prediction': manifest.prediction,
+        'confidence': manifest.confidence
+    }
+    if not job_store.transition(
+        job['task_id'], (PROCESSING,), COMPLETED,
+        worker_id=job['claimed_by'],
+        manifest_file=manifest.path,
+        profile=profile,
+        progress=100,
+        completed_at=time.time(),
+        **results
+    ):
+        return False
+    
+    if job.get('render_mode') == 'background':
+        # The prediction is out; render the visualization when no upload is waiting
+        # The render job draws the recorded prediction from the manifest; pose
+        # and the classifier do not run again
+        try:
+            scheduler.submit(render_job_id(job['task_id']), {
+                'kind': 'render',
+                'parent_id': job['task_id'],
+                'manifest_file': manifest.path,
+                'original_filename': job.get('original_filename')
+            }, priority=RENDER_PRIORITY)
+        except Exception as e:
+            # The job is already complete; without a render job it must not stay pending
+            job_store.update(job['task_id'], render_status='error', render_error=f"Could not queue the render: {e}")
+    elif result_cache and job.get('upload_digest') and manifest.visualization and manifest.confidence is not None:
+        # Later uploads of the same video are answered from the cache; a
+        # failed prediction (no confidence) is not
+        result_cache.store(job['upload_digest'], results, job.get('input', INPUT_KINDS[0]))
+    return True
+
+def process_video_task(job, manifest):
+    """Record a finished pipeline run from its manifest"""
+    try:
+        if not manifest:
+            raise RuntimeError('Video processing failed')
+        # Only the worker still holding the job may complete it; a requeued job is someone else's now
+        if job.get('kind') == 'render':
+            completed = finish_render(job, manifest)
+        else:
+            completed = complete_job(job, manifest)
+        if not completed:
+            print(f"Dropped result of job {job['task_id']}, it is no longer claimed by {job['claimed_by']}")
+            return
+        metrics.observe('penalty_job_seconds', time.time() - job['claimed_at'], kind=job_kind(job), status=COMPLETED)
+        
+    except Exception as e:
+        # Update status on error
+        mark_error(job, e)
+
+# Uploads are queued in the job store and run on warm worker processes, of
+# this host or of worker hosts claiming through /api/worker. One server
+# process per host runs the pool and requeues jobs of workers that stopped
+# sending heartbeats; the others only enqueue.
+scheduler = JobScheduler(
+    job_store,
+    process_job,
+    workers=WORKER_PROCESSES,
+    max_queued=MAX_QUEUED_JOBS,
+    initializer=init_worker,
+    on_start=mark_processing,
+    on_done=process_video_task,
+    on_error=mark_error,
+    lock_path=getattr(job_store, 'path', None) and job_store.path + '.workers.lock'
+)
+if RUN_WORKERS:
+    scheduler.start()
+
+# Removes finished jobs past their retention or over the disk quota, least
+# recently downloaded first, and stale upload sessions (see janitor.py).
+# One server process per host runs it.
+janitor = Janitor(
+    job_store,
+    UPLOAD_FOLDER,
+    PROCESSED_FOLDER,
+    upload_sessions,
+    lock_path=getattr(job_store, 'path', None) and job_store.path + '.janitor.lock',
+    stats_path=getattr(job_store, 'path', None) and job_store.path + '.janitor.json',
+    related_jobs=lambda task_id: [render_job_id(task_id)],
+    **janitor_settings()
+)
+janitor.start()
+
+def queue_full_response(retry_after):
+    response = jsonify({'error': 'Server is busy, try again later', 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def allowed_file(filename, input_kind=INPUT_KINDS[0]):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in INPUT_EXTENSIONS[input_kind]
+
+def file_type_error_response(input_kind):
+    extensions = ", ".join(sorted(INPUT_EXTENSIONS[input_kind]))
+    return jsonify({'error': f'File type not allowed for {input_kind} uploads. Supported types: {extensions}'}), 400
+
+def upload_options(values):
+    """
+    (render mode, input kind, error response or None) from the form or
+    JSON body of an upload
+    """
+    input_kind = values.get('input', INPUT_KINDS[0])
+    if input_kind not in INPUT_EXTENSIONS:
+        return None, None, (jsonify({'error': f'Invalid input. Use one of: {", ".join(INPUT_KINDS)}'}), 400)
+    render_mode = values.get('render', 'none' if input_kind == 'keypoints' else RENDER_MODES[0])
+    if render_mode not in RENDER_MODES:
+        return None, None, invalid_render_mode_response()
+    if input_kind == 'keypoints' and render_mode != 'none':
+        return None, None, (jsonify({'error': 'Keypoints uploads have no video to render; use render mode none'}), 400)
+    return render_mode, input_kind, None
 
 @app.route('/api/process_video', methods=['POST'])
 def process_video():
@@ -39,120 +254,374 @@ def process_video():
     if file.filename == '':
         return jsonify({'error': 'Empty filename'}), 400
     
-    if not allowed_file(file.filename):
-        return jsonify({'error': f'File type not allowed. Supported types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
+    render_mode, input_kind, error = upload_options(request.form)
+    if error:
+        return error
+    if not allowed_file(file.filename, input_kind):
+        return file_type_error_response(input_kind)
     
-    # Generate a unique ID for this processing task
-    task_id = str(uuid.uuid4())
+    # Turn the upload away before writing it to disk if there is no room
+    if scheduler.is_full():
+        return queue_full_response(scheduler.retry_after())
     
-    # Create unique filename to avoid conflicts
-    original_filename = secure_filename(file.filename)
+    # Save the uploaded file and queue it
+    task_id = str(uuid.uuid4())
+    file_path = upload_path(file.filename, task_id, input_kind)
+    digest = save_stream(file.stream, file_path)
+    metrics.inc('penalty_uploads_total', method='multipart')
+    metrics.inc('penalty_upload_bytes_total', os.path.getsize(file_path))
+    return queue_upload(task_id, file_path, file.filename, digest, render_mode, input_kind)
+
+def invalid_render_mode_response():
+    return jsonify({'error': f'Invalid render mode. Use one of: {", ".join(RENDER_MODES)}'}), 400
+
+def upload_path(filename, task_id, input_kind=INPUT_KINDS[0]):
+    """Unique path in the upload folder for an upload named filename"""
+    base_name = os.path.splitext(secure_filename(filename))[0]
+    extension = '.json' if input_kind == 'keypoints' else '.mp4'
+    return os.path.join(UPLOAD_FOLDER, f"{base_name}_{task_id}{extension}")
+
+def valid_keypoints(path):
+    """True if path holds keypoints as Infer3D saves them: a JSON list with one entry per frame"""
+    try:
+        with open(path) as f:
+            keypoints = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return isinstance(keypoints, list) and 0 < len(keypoints) <= 26 and all(isinstance(frame, list) for frame in keypoints)
+
+def queue_upload(task_id, file_path, filename, upload_digest=None, render_mode=RENDER_MODES[0],
+                 input_kind=INPUT_KINDS[0]):
+    """
+    Queue a saved upload for processing; the response carries the task ID.
+    An upload whose content (upload_digest, SHA-256) was processed before
+    becomes a completed job straight away. render_mode is one of
+    RENDER_MODES, input_kind one of INPUT_KINDS.
+    """
+    if input_kind == 'keypoints' and not valid_keypoints(file_path):
+        os.remove(file_path)
+        return jsonify({'error': 'Keypoints must be a JSON list of up to 26 frames of keypoints'}), 400
+    if input_kind == 'clip' and video_frame_count(file_path) != 26:
+        # A full video belongs in a 'video' upload, which selects the 26 frames
+        os.remove(file_path)
+        return jsonify({'error': 'A clip must be a video of exactly 26 frames'}), 400
+
+    original_filename = secure_filename(filename)
     base_name = os.path.splitext(original_filename)[0]
-    unique_filename = f"{base_name}_{task_id}.mp4"
-    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-    
-    # Save the uploaded file
-    file.save(file_path)
-    
-    # Update status
-    processing_status[task_id] = {
-        'status': 'uploading',
+    job = {
         'progress': 0,
         'original_filename': original_filename,
-        'unique_filename': unique_filename,
+        'unique_filename': os.path.basename(file_path),
+        'video_path': file_path,
+        'input': input_kind,
+        'output_folder': os.path.join(PROCESSED_FOLDER, base_name),
+        # Where process_single_video puts this task's results
+        'result_folder': os.path.join(PROCESSED_FOLDER, base_name, os.path.splitext(os.path.basename(file_path))[0]),
+        'upload_digest': upload_digest,
+        'render_mode': render_mode,
+        'render': render_mode == 'inline',
+        'render_status': {'background': 'pending', 'none': 'skipped'}.get(render_mode),
         'started_at': time.time()
     }
     
-    # Start processing in a separate thread
-    thread = threading.Thread(target=process_video_task, args=(task_id, file_path, base_name))
-    thread.start()
+    cached = result_cache.lookup(upload_digest, job['result_folder'], input_kind) if result_cache and upload_digest else None
+    if cached:
+        os.remove(file_path)
+        if cached.get('visualization_file') and render_mode == 'background':
+            job['render_status'] = 'completed'
+        job_store.enqueue(task_id, dict(job, progress=100, cached=True, completed_at=time.time(), **cached),
+                          status=COMPLETED)
+        return jsonify({
+            'task_id': task_id,
+            'cached': True,
+            'message': 'Video already processed, results are ready'
+        })
+    
+    # Queue the pipeline run on the worker pool
+    try:
+        position = scheduler.submit(task_id, job)
+    except QueueFull as e:
+        # Filled up while the upload was being saved
+        os.remove(file_path)
+        return queue_full_response(e.retry_after)
     
     # Return the task ID so the client can check status
     return jsonify({
         'task_id': task_id,
-        'message': 'Video uploaded and processing started'
+        'queue_position': position,
+        'message': 'Video uploaded and queued for processing'
     })
 
-def process_video_task(task_id, video_path, base_name):
+def upload_error_response(error):
+    body = {'error': str(error)}
+    if error.offset is not None:
+        body['offset'] = error.offset
+    return jsonify(body), error.status
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """
+    Start a resumable upload. Body: {"filename": ..., "size": bytes,
+    "input": one of INPUT_KINDS, default video}. Then PUT the bytes to
+    /api/uploads/<upload_id> in one or more chunks with Content-Range:
+    bytes start-end/size, and POST /api/uploads/<upload_id>/complete to
+    queue the video.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    if not filename:
+        return jsonify({'error': 'Empty filename'}), 400
+    input_kind = data.get('input', INPUT_KINDS[0])
+    if input_kind not in INPUT_EXTENSIONS:
+        return jsonify({'error': f'Invalid input. Use one of: {", ".join(INPUT_KINDS)}'}), 400
+    if not allowed_file(filename, input_kind):
+        return file_type_error_response(input_kind)
+    if scheduler.is_full():
+        return queue_full_response(scheduler.retry_after())
+    
     try:
-        # Update status
-        processing_status[task_id]['status'] = 'processing'
-        processing_status[task_id]['progress'] = 10
-        
-        # Process the video using MasterScript
-        output_folder = os.path.join(PROCESSED_FOLDER, base_name)
-        
-        # Option 1: Call process_single_video directly
-        process_single_video(video_path, output_folder)
-        
-        # Option 2: Run MasterScript.py as a subprocess (uncomment if preferred)
-        # process = subprocess.Popen(
-        #     ["python", "MasterScript.py", video_path, output_folder],
-        #     stdout=subprocess.PIPE,
-        #     stderr=subprocess.PIPE
-        # )
-        # stdout, stderr = process.communicate()
-        
-        # Update status
-        processing_status[task_id]['status'] = 'completed'
-        processing_status[task_id]['progress'] = 100
-        processing_status[task_id]['output_folder'] = output_folder
-        processing_status[task_id]['completed_at'] = time.time()
-        
-        # Find the output files - SEARCH MORE THOROUGHLY
-        visualization_file = None
-        keypoints_file = None
-        
-        # Look for files with these patterns
-        for root, dirs, files in os.walk(output_folder):
-            for file in files:
-                if '_visualization.mp4' in file:
-                    visualization_file = os.path.join(root, file)
-                elif '_keypoints.mp4' in file:
-                    keypoints_file = os.path.join(root, file)
-        
-        # If not found in expected location, search the entire output directory
-        if not visualization_file or not keypoints_file:
-            print(f"Warning: Files not found in expected location. Searching entire output directory...")
-            for root, dirs, files in os.walk(PROCESSED_FOLDER):
-                for file in files:
-                    if '_visualization.mp4' in file and not visualization_file:
-                        visualization_file = os.path.join(root, file)
-                    elif '_keypoints.mp4' in file and not keypoints_file:
-                        keypoints_file = os.path.join(root, file)
-        
-        # Log what we found
-        print(f"Visualization file: {visualization_file}")
-        print(f"Keypoints file: {keypoints_file}")
-        
-        processing_status[task_id]['visualization_file'] = visualization_file
-        processing_status[task_id]['keypoints_file'] = keypoints_file
-        
-    except Exception as e:
-        # Update status on error
-        processing_status[task_id]['status'] = 'error'
-        processing_status[task_id]['error'] = str(e)
-        print(f"Error processing video: {e}")
+        info = upload_sessions.create(filename, int(data.get('size') or 0))
+    except (UploadError, ValueError) as e:
+        return upload_error_response(e if isinstance(e, UploadError) else UploadError(str(e)))
+    info['chunk_size'] = UPLOAD_CHUNK_SIZE
+    return jsonify(info), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Bytes received so far; a client resumes from 'offset'"""
+    try:
+        return jsonify(upload_sessions.info(upload_id))
+    except UploadError as e:
+        return upload_error_response(e)
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def upload_chunk(upload_id):
+    """Stream one chunk to disk at the offset in its Content-Range header"""
+    try:
+        info = upload_sessions.write_chunk(
+            upload_id,
+            request.headers.get('Content-Range'),
+            request.stream,
+            request.content_length
+        )
+    except UploadError as e:
+        return upload_error_response(e)
+    metrics.inc('penalty_upload_bytes_total', request.content_length or 0)
+    return jsonify(info)
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """
+    Queue a fully received upload for processing. Optional JSON body:
+    {"render": one of RENDER_MODES, "input": one of INPUT_KINDS, as
+    given when the upload was started}.
+    """
+    render_mode, input_kind, error = upload_options(request.get_json(silent=True) or {})
+    if error:
+        return error
+    if scheduler.is_full():
+        # The session stays, so the client can retry completing it later
+        return queue_full_response(scheduler.retry_after())
+    
+    task_id = str(uuid.uuid4())
+    try:
+        info = upload_sessions.info(upload_id)
+        if not allowed_file(info['filename'], input_kind):
+            return file_type_error_response(input_kind)
+        file_path = upload_path(info['filename'], task_id, input_kind)
+        info = upload_sessions.finish(upload_id, file_path)
+    except UploadError as e:
+        return upload_error_response(e)
+    metrics.inc('penalty_uploads_total', method='chunked')
+    return queue_upload(task_id, file_path, info['filename'], info['sha256'], render_mode, input_kind)
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    try:
+        upload_sessions.abort(upload_id)
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify({'message': 'Upload aborted'})
+
+def job_status(task_id):
+    """
+    Job record as returned to clients, or None. 'version' changes whenever
+    anything in it does, including the queue position.
+    """
+    status = job_store.get(task_id)
+    if status is None:
+        return None
+    if status['status'] == QUEUED:
+        status['queue_position'] = scheduler.position(task_id)
+    status['version'] = f"{status['updated_at']:.6f}-{status.get('queue_position') or 0}"
+    return status
+
+def job_finished(status):
+    """True once nothing more will change: done or failed, with any background render over"""
+    return status['status'] in (COMPLETED, ERROR) and status.get('render_status') not in ('pending', 'rendering')
+
+def wait_for_status(task_id, version, timeout):
+    """
+    Job status once its version differs from version, the job has
+    finished, or timeout seconds have passed; None if the job is gone
+    """
+    deadline = time.time() + timeout
+    while True:
+        status = job_status(task_id)
+        if status is None or status['version'] != version or job_finished(status) or time.time() >= deadline:
+            return status
+        time.sleep(STATUS_POLL_INTERVAL)
 
 @app.route('/api/status/<task_id>', methods=['GET'])
 def get_status(task_id):
-    if task_id not in processing_status:
+    """
+    Job status. With ?wait=seconds&version=<version from the last
+    response> this is a long poll: it returns as soon as the job changes,
+    or after wait seconds (at most MAX_STATUS_WAIT) with the same version.
+    """
+    wait = min(request.args.get('wait', 0, type=float), MAX_STATUS_WAIT)
+    version = request.args.get('version')
+    if wait > 0 and version:
+        status = wait_for_status(task_id, version, wait)
+    else:
+        status = job_status(task_id)
+    if status is None:
+        return jsonify({'error': 'Task ID not found'}), 404
+    return jsonify(status)
+
+@app.route('/api/events/<task_id>', methods=['GET'])
+def job_events(task_id):
+    """
+    Server-Sent Events stream of the job status: one event with the full
+    status each time it changes (stage, frames done, progress, queue
+    position, the prediction once known), ending when the job and any
+    background render have finished. A reconnecting
+    client sends Last-Event-ID to skip the status it already has.
+    """
+    if job_store.get(task_id) is None:
         return jsonify({'error': 'Task ID not found'}), 404
     
-    return jsonify(processing_status[task_id])
+    def stream(version):
+        while True:
+            status = wait_for_status(task_id, version, EVENTS_HEARTBEAT)
+            if status is None:
+                yield "event: deleted\ndata: {}\n\n"
+                return
+            if status['version'] == version:
+                if job_finished(status):
+                    return
+                # Keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+            version = status['version']
+            yield f"id: {version}\ndata: {json.dumps(status)}\n\n"
+            if job_finished(status):
+                return
+    
+    return Response(stream(request.headers.get('Last-Event-ID')), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/queue', methods=['GET'])
+def queue_status():
+    stats = scheduler.stats()
+    stats['result_cache'] = result_cache.stats() if result_cache else None
+    stats['janitor'] = janitor.stats()
+    return jsonify(stats)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus text format: pipeline and upload metrics of every server
+    and worker process (see metrics.py), plus queue, result cache and
+    janitor state read now
+    """
+    counts = job_store.counts()
+    foreground = job_store.count(QUEUED, min_priority=0)
+    extra = [
+        ('penalty_jobs', 'gauge', 'Jobs in the job store by status',
+         {metrics.labels(status=status): counts.get(status, 0) for status in (QUEUED, PROCESSING, COMPLETED, ERROR)}),
+        ('penalty_queue_depth', 'gauge', 'Jobs waiting, uploads (foreground) and background renders',
+         {metrics.labels(priority='foreground'): foreground,
+          metrics.labels(priority='background'): counts.get(QUEUED, 0) - foreground}),
+        ('penalty_active_workers', 'gauge', 'Jobs running on worker processes', {(): counts.get(PROCESSING, 0)}),
+        ('penalty_worker_processes', 'gauge', 'Worker processes per host running the pool',
+         {(): scheduler.workers}),
+        ('penalty_queue_limit', 'gauge', 'Uploads allowed to wait', {(): scheduler.max_queued}),
+    ]
+    if result_cache:
+        cache_stats = result_cache.stats()
+        extra += [
+            ('penalty_result_cache_lookups_total', 'counter', 'Result cache lookups by outcome',
+             {metrics.labels(outcome='hit'): cache_stats['hits'], metrics.labels(outcome='miss'): cache_stats['misses']}),
+            ('penalty_result_cache_bytes', 'gauge', 'Result cache size', {(): cache_stats['bytes']}),
+        ]
+    janitor_stats = janitor.stats()
+    if janitor_stats:
+        extra += [
+            ('penalty_janitor_runs_total', 'counter', 'Janitor runs', {(): janitor_stats.get('runs', 0)}),
+            ('penalty_janitor_removed_jobs_total', 'counter', 'Jobs removed by the janitor, by reason',
+             {metrics.labels(reason='ttl'): janitor_stats.get('expired_jobs', 0),
+              metrics.labels(reason='quota'): janitor_stats.get('evicted_jobs', 0)}),
+            ('penalty_janitor_expired_sessions_total', 'counter', 'Stale upload sessions removed',
+             {(): janitor_stats.get('expired_sessions', 0)}),
+            ('penalty_janitor_freed_bytes_total', 'counter', 'Bytes freed by the janitor',
+             {(): janitor_stats.get('freed_bytes', 0)}),
+            ('penalty_disk_bytes', 'gauge', 'Uploads and results on disk at the last janitor run',
+             {(): janitor_stats.get('disk_bytes', 0)}),
+        ]
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+def path_inside(path, folder):
+    """True if path resolves to folder or a path inside it"""
+    real_path, real_folder = os.path.realpath(path), os.path.realpath(folder)
+    return real_path == real_folder or real_path.startswith(real_folder + os.sep)
+
+# PipelineManifest fields holding paths a run wrote; all must be in the job's result folder
+MANIFEST_OUTPUTS = ('output_folder', 'clipped_video', 'keypoints_folder', 'keypoints_json', 'keypoints_csv',
+                    'keypoints_video', 'prediction_file', 'goal_track', 'visualization', 'profile',
+                    'hotpath_profile')
+
+def manifest_path_error(manifest, result_folder):
+    """Error message if a manifest from a worker host points outside result_folder, else None"""
+    for name in MANIFEST_OUTPUTS:
+        path = getattr(manifest, name)
+        if path and not path_inside(path, result_folder):
+            return f"Worker results point outside the job's folder ({name})"
+    return None
+
+def send_result_file(file_path):
+    """
+    Send a result file as an attachment with Range and conditional request
+    support. Behind nginx (ACCEL_REDIRECT_PREFIX) only headers are returned
+    and nginx streams the file itself, so the worker is free at once.
+    """
+    processed_root = os.path.realpath(PROCESSED_FOLDER)
+    real_path = os.path.realpath(file_path)
+    # Only results are served, whatever path a job record holds
+    if not path_inside(real_path, processed_root):
+        return jsonify({'error': 'Result file not found'}), 404
+    if ACCEL_REDIRECT_PREFIX:
+        relative_path = os.path.relpath(real_path, processed_root).replace(os.sep, '/')
+        filename = os.path.basename(real_path)
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(relative_path)
+        response.headers['Content-Disposition'] = f'attachment; filename="{secure_filename(filename)}"'
+        return response
+    return send_file(real_path, as_attachment=True, conditional=True)
 
 @app.route('/api/download/<task_id>/<file_type>', methods=['GET'])
 def download_file(task_id, file_type):
-    if task_id not in processing_status:
+    task = job_store.get(task_id)
+    if task is None:
         return jsonify({'error': 'Task ID not found'}), 404
     
-    task = processing_status[task_id]
-    
     if task['status'] != 'completed':
         return jsonify({'error': 'Processing not yet complete', 'status': task['status']}), 400
     
     if file_type == 'visualization':
         file_path = task.get('visualization_file')
+        if task.get('render_status') in ('pending', 'rendering'):
+            return jsonify({'error': 'Visualization not rendered yet', 'render_status': task['render_status']}), 409
         if not file_path or not os.path.exists(file_path):
             return jsonify({'error': 'Visualization file not found'}), 404
     elif file_type == 'keypoints':
@@ -166,24 +635,132 @@ def download_file(task_id, file_type):
     else:
         return jsonify({'error': 'Invalid file type. Use "visualization", "keypoints", or "processed"'}), 400
     
-    # Return the file
-    return send_file(file_path, as_attachment=True)
+    # Recently downloaded results are the last the janitor evicts
+    job_store.update(task_id, last_downloaded_at=time.time())
+    return send_result_file(file_path)
+
+def worker_token_error():
+    """Error response if worker hosts are disabled or the request lacks the worker token, else None"""
+    if not WORKER_TOKEN:
+        return jsonify({'error': 'Worker hosts are disabled, set PENALTY_WORKER_TOKEN to enable them'}), 403
+    if not hmac.compare_digest(request.headers.get('X-Worker-Token', ''), WORKER_TOKEN):
+        return jsonify({'error': 'Invalid worker token'}), 403
+    return None
+
+def claimed_job(task_id, worker_id):
+    """The job if it is still processing under worker_id, else None"""
+    job = job_store.get(task_id)
+    if job is None or job['status'] != PROCESSING or job.get('claimed_by') != worker_id:
+        return None
+    return job
+
+def job_lost_response():
+    return jsonify({'error': 'Job is not running under this worker'}), 409
+
+@app.route('/api/worker/claim', methods=['POST'])
+def worker_claim():
+    """
+    Claim the next job for a worker host. Body: {"worker_id": ...}.
+    Returns the job record, or 204 if none waits. The worker then sends
+    heartbeats, progress and the result under the same worker_id; paths in
+    the job are relative to this server's working folder, which workers
+    share.
+    """
+    error = worker_token_error()
+    if error:
+        return error
+    worker_id = (request.get_json(silent=True) or {}).get('worker_id')
+    if not worker_id:
+        return jsonify({'error': 'No worker_id provided'}), 400
+    job = job_store.claim(worker_id)
+    if job is None:
+        return '', 204
+    mark_processing(job)
+    return jsonify(job)
+
+@app.route('/api/worker/jobs/<task_id>/heartbeat', methods=['POST'])
+def worker_heartbeat(task_id):
+    """Keep a claimed job from being requeued; 409 once it is no longer the worker's"""
+    error = worker_token_error()
+    if error:
+        return error
+    if not job_store.heartbeat(task_id, (request.get_json(silent=True) or {}).get('worker_id')):
+        return job_lost_response()
+    return jsonify({'message': 'ok'})
+
+@app.route('/api/worker/jobs/<task_id>/progress', methods=['POST'])
+def worker_progress(task_id):
+    """Record a progress event (see progress.py). Body: {"worker_id": ..., "event": {...}}"""
+    error = worker_token_error()
+    if error:
+        return error
+    data = request.get_json(silent=True) or {}
+    job = claimed_job(task_id, data.get('worker_id'))
+    if job is None:
+        return job_lost_response()
+    target_id, prefix = progress_target(job)
+    job_store.update(target_id, **{prefix + key: value for key, value in (data.get('event') or {}).items()})
+    return jsonify({'message': 'ok'})
+
+@app.route('/api/worker/jobs/<task_id>/complete', methods=['POST'])
+def worker_complete(task_id):
+    """
+    Record a job finished on a worker host. Body: {"worker_id": ...,
+    "manifest": path of the run's manifest under PROCESSED_FOLDER, or null
+    if the pipeline produced nothing}
+    """
+    error = worker_token_error()
+    if error:
+        return error
+    data = request.get_json(silent=True) or {}
+    job = claimed_job(task_id, data.get('worker_id'))
+    if job is None:
+        return job_lost_response()
+    manifest = None
+    if data.get('manifest'):
+        # A render job writes into its upload's results
+        owner = job_store.get(job['parent_id']) if job.get('kind') == 'render' else job
+        result_folder = (owner or {}).get('result_folder')
+        if not result_folder or not path_inside(data['manifest'], result_folder):
+            return jsonify({'error': "Manifest must be in the job's result folder"}), 400
+        try:
+            manifest = PipelineManifest.load(data['manifest'])
+        except (OSError, ValueError, TypeError) as e:
+            mark_error(job, f"Could not read the worker's results: {e}")
+            return jsonify({'message': 'Job failed'})
+        error = manifest_path_error(manifest, result_folder)
+        if error:
+            mark_error(job, error)
+            return jsonify({'message': 'Job failed'})
+    scheduler.job_done(job, manifest)
+    return jsonify({'message': 'Job completed'})
+
+@app.route('/api/worker/jobs/<task_id>/fail', methods=['POST'])
+def worker_fail(task_id):
+    """Record a job that failed on a worker host. Body: {"worker_id": ..., "error": message}"""
+    error = worker_token_error()
+    if error:
+        return error
+    data = request.get_json(silent=True) or {}
+    job = claimed_job(task_id, data.get('worker_id'))
+    if job is None:
+        return job_lost_response()
+    scheduler.job_failed(job, data.get('error') or 'Worker failed')
+    return jsonify({'message': 'Job failed'})
 
 @app.route('/api/cleanup/<task_id>', methods=['DELETE'])
 def cleanup(task_id):
-    if task_id not in processing_status:
-        return jsonify({'error': 'Task ID not found'}), 404
-    
     # Get task info
-    task = processing_status[task_id]
+    task = job_store.get(task_id)
+    if task is None:
+        return jsonify({'error': 'Task ID not found'}), 404
     
-    # Delete the original uploaded file if it exists
-    upload_path = os.path.join(UPLOAD_FOLDER, task.get('unique_filename', ''))
-    if os.path.exists(upload_path):
-        os.remove(upload_path)
+    # Delete the uploaded file and the task's results
+    remove_job_files(task, UPLOAD_FOLDER)
     
-    # Delete the task from status dictionary
-    del processing_status[task_id]
+    # Delete the task from the job store, and its background render if it has one
+    job_store.delete(task_id)
+    job_store.delete(render_job_id(task_id))
     
     return jsonify({'message': 'Cleanup completed'})
 
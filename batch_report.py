@@ -0,0 +1,41 @@
+"""
+Summary tables for batch runs, shared by MasterScript.py (local batches)
+and api_client.py (batches sent to the API server).
+
+A row is a dict with at least 'video' and 'status', optionally
+'prediction', 'confidence', 'output_folder', 'error' and a '<timing>_s'
+entry in seconds for each timing the batch records.
+"""
+
+import csv
+import os
+
+
+def write_batch_csv(rows, results_path, fields, timings):
+    """
+    Write rows as CSV: the fields columns, a <timing>_s column per timing,
+    then output_folder and error. Returns results_path.
+    """
+    fieldnames = list(fields) + [f"{timing}_s" for timing in timings] + ['output_folder', 'error']
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+    with open(results_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    return results_path
+
+
+def print_batch_table(rows, timings):
+    """Print one line per row with its status, prediction and timings, and its error below it"""
+    header = f"{'Video':<30} {'Status':<7} {'Prediction':<10} {'Conf':>5} " + \
+        " ".join(f"{timing + ' s':>12}" for timing in timings)
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        confidence = f"{row['confidence']:.2f}" if row.get('confidence') is not None else "-"
+        columns = " ".join(f"{row[f'{timing}_s']:>12.2f}" if f"{timing}_s" in row else f"{'-':>12}"
+                           for timing in timings)
+        print(f"{os.path.basename(row['video'])[:30]:<30} {row['status']:<7} {row.get('prediction') or '-':<10} "
+              f"{confidence:>5} {columns}")
+        if row.get('error'):
+            print(f"    error: {row['error']}")
@@ -0,0 +1,102 @@
+"""
+Microbenchmark: goalkeeper sprite compositing at 1080p
+
+Compares the original per-channel float loop from overlay_frame with
+composite_premultiplied, and reports time and traced allocations per call.
+
+Usage:
+    python benchmarks/bench_composite.py [--iterations 200] [--sprite-width 640]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from GoalkeeperAnimation import SpriteCache, composite_premultiplied
+
+
+def legacy_composite(background, scaled_frame, gk_x, gk_y):
+    """The per-channel float64 blend overlay_frame used before"""
+    alpha = scaled_frame[:, :, 3] / 255.0
+    for c in range(3):
+        background[gk_y:gk_y+scaled_frame.shape[0], gk_x:gk_x+scaled_frame.shape[1], c] = \
+            (1 - alpha) * background[gk_y:gk_y+scaled_frame.shape[0], gk_x:gk_x+scaled_frame.shape[1], c] + \
+            alpha * scaled_frame[:, :, c]
+
+
+def make_sprite(width, height, seed=0):
+    """Random BGRA sprite with a mix of transparent, opaque and partial alpha"""
+    rng = np.random.default_rng(seed)
+    sprite = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    sprite[: height // 3, :, 3] = 0
+    sprite[height // 3: 2 * height // 3, :, 3] = 255
+    return sprite
+
+
+def time_call(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def traced_bytes(fn):
+    """Peak bytes allocated by a single call, as seen by tracemalloc"""
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sprite compositing microbenchmark")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--sprite-width", type=int, default=640)
+    args = parser.parse_args()
+
+    width, height = 1920, 1080
+    sprite_width = args.sprite_width
+    sprite_height = sprite_width * 2 // 3
+    gk_x, gk_y = (width - sprite_width) // 2, height - sprite_height - 50
+
+    rng = np.random.default_rng(1)
+    frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    sprite = make_sprite(sprite_width, sprite_height)
+
+    premultiplied, inv_alpha = SpriteCache._prepare(sprite, sprite_width)
+
+    # Both routines must agree to within one level of rounding
+    legacy_frame = frame.copy()
+    legacy_composite(legacy_frame, sprite, gk_x, gk_y)
+    new_frame = frame.copy()
+    roi = new_frame[gk_y:gk_y + sprite_height, gk_x:gk_x + sprite_width]
+    composite_premultiplied(roi, premultiplied, inv_alpha)
+    max_diff = np.abs(legacy_frame.astype(np.int16) - new_frame.astype(np.int16)).max()
+
+    bench_frame = frame.copy()
+    roi = bench_frame[gk_y:gk_y + sprite_height, gk_x:gk_x + sprite_width]
+
+    def run_legacy():
+        legacy_composite(bench_frame, sprite, gk_x, gk_y)
+
+    def run_new():
+        composite_premultiplied(roi, premultiplied, inv_alpha)
+
+    legacy_time = time_call(run_legacy, args.iterations)
+    new_time = time_call(run_new, args.iterations)
+
+    print(f"Frame {width}x{height}, sprite {sprite_width}x{sprite_height}, {args.iterations} iterations")
+    print(f"{'Routine':<26} {'ms/frame':>10} {'alloc bytes':>12}")
+    print(f"{'legacy float loop':<26} {legacy_time * 1000:>10.3f} {traced_bytes(run_legacy):>12}")
+    print(f"{'composite_premultiplied':<26} {new_time * 1000:>10.3f} {traced_bytes(run_new):>12}")
+    print(f"Speedup: {legacy_time / new_time:.1f}x, max pixel difference: {max_diff}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Offline benchmark suite for the pipeline hot paths
+
+Generates a synthetic penalty video and goalkeeper animations in a scratch
+folder and times extract_26_frames, detect_goal, overlay_frame, keypoint
+parsing, chunk-parallel rendering and end-to-end process_single_video with
+stub pose and classifier models (see synthetic.py). Benchmarks whose
+modules cannot be imported (e.g. skeleton.py without TensorFlow) are
+reported as skipped. The parallel render benchmarks first check that the
+output is frame-identical to the serial render and fail if it is not.
+
+Results can be saved as a baseline and later runs compared against it:
+
+Usage:
+    python benchmarks/bench_pipeline.py [--width 1280 --height 720 --frames 90] [--repeats 5]
+    python benchmarks/bench_pipeline.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_pipeline.py --compare benchmarks/baseline.json [--threshold 1.2]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic import make_penalty_video, make_animations, make_keypoints, StubPoseInferencer, StubClassifier
+
+
+# Processes the parallel render benchmarks use
+RENDER_WORKERS = 2
+
+
+class Skip(Exception):
+    """Raised by a benchmark that cannot run in this environment"""
+
+
+@contextlib.contextmanager
+def _importable(what):
+    try:
+        yield
+    except ImportError as e:
+        raise Skip(f"{what} unavailable: {e}")
+
+
+def time_repeats(fn, repeats, setup=None):
+    """Seconds per call for each repeat; setup() runs untimed before each"""
+    times = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_extract_26_frames(ctx):
+    from Classified_Clips.FrameClipper26 import extract_26_frames
+    output_folder = os.path.join(ctx['workdir'], 'clip')
+    os.makedirs(output_folder, exist_ok=True)
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        return time_repeats(lambda: extract_26_frames(ctx['video'], output_folder), ctx['repeats']), 1
+
+
+def bench_detect_goal(ctx):
+    from Goal_Viz import GoalVisualizer
+    visualizer = GoalVisualizer()
+    frames = ctx['frames']
+    times = time_repeats(lambda: [visualizer.detect_goal(frame) for frame in frames], ctx['repeats'])
+    return times, len(frames)
+
+
+def bench_overlay_frame(ctx):
+    from Goal_Viz import GoalVisualizer
+    visualizer = GoalVisualizer()
+    goal_boxes = [visualizer.detect_goal(frame) for frame in ctx['frames']]
+    frames = [frame.copy() for frame in ctx['frames']]
+
+    def setup():
+        visualizer.goalkeeper.set_animation('left', len(frames))
+
+    def run():
+        for frame, goal_box in zip(frames, goal_boxes):
+            if goal_box is not None:
+                visualizer.goalkeeper.overlay_frame(frame, goal_box)
+
+    return time_repeats(run, ctx['repeats'], setup), len(frames)
+
+
+def bench_keypoint_parsing(ctx):
+    with _importable("skeleton"):
+        from skeleton import keypoints_to_array, _read_keypoints_csv
+    import pandas as pd
+    keypoints_list = make_keypoints(26)
+    csv_path = os.path.join(ctx['workdir'], 'keypoints.csv')
+    pd.DataFrame(keypoints_list).to_csv(csv_path, index=False)
+
+    def run():
+        _read_keypoints_csv(csv_path)
+        keypoints_to_array(keypoints_list)
+
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        return time_repeats(run, ctx['repeats']), 26
+
+
+def _read_video_frames(path):
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame.tobytes())
+    cap.release()
+    return frames
+
+
+def _bench_render_parallel(ctx, goal_track):
+    """
+    process_video with RENDER_WORKERS processes, detecting the goal in the
+    workers or, with goal_track, onto a precomputed track as the pipeline
+    renders. Raises if the output differs from the serial render.
+    """
+    from Goal_Viz import process_video, detect_goal_track
+    goal_boxes = detect_goal_track(ctx['frames']) if goal_track else None
+    serial_path = os.path.join(ctx['workdir'], 'render_serial.mp4')
+    parallel_path = os.path.join(ctx['workdir'], 'render_parallel.mp4')
+
+    def run():
+        process_video(ctx['video'], parallel_path, 'left', delay=1, show=False, workers=RENDER_WORKERS,
+                      goal_boxes=goal_boxes)
+
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        process_video(ctx['video'], serial_path, 'left', delay=1, show=False, goal_boxes=goal_boxes)
+        run()
+        if _read_video_frames(parallel_path) != _read_video_frames(serial_path):
+            raise RuntimeError("Parallel render differs from the serial render")
+        return time_repeats(run, ctx['repeats']), len(ctx['frames'])
+
+
+def _bench_process_single_video(ctx, streaming):
+    with _importable("MasterScript"):
+        from MasterScript import process_single_video
+        from Classified_Clips.MMpose import Infer3D
+    infer3d = Infer3D(device='cpu', inferencer=StubPoseInferencer())
+    model = StubClassifier()
+    output_base = os.path.join(ctx['workdir'], 'processed')
+
+    def run():
+        manifest = process_single_video(ctx['video'], output_base, streaming=streaming, use_cache=False,
+                                        infer3d=infer3d, model=model)
+        if not manifest:
+            raise RuntimeError("process_single_video failed")
+
+    def setup():
+        shutil.rmtree(output_base, ignore_errors=True)
+
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        return time_repeats(run, ctx['repeats'], setup), 1
+
+
+BENCHMARKS = {
+    'extract_26_frames': bench_extract_26_frames,
+    'detect_goal': bench_detect_goal,
+    'overlay_frame': bench_overlay_frame,
+    'keypoint_parsing': bench_keypoint_parsing,
+    'render_parallel': lambda ctx: _bench_render_parallel(ctx, goal_track=False),
+    'render_parallel_goal_track': lambda ctx: _bench_render_parallel(ctx, goal_track=True),
+    'process_single_video_streaming': lambda ctx: _bench_process_single_video(ctx, streaming=True),
+    'process_single_video_file': lambda ctx: _bench_process_single_video(ctx, streaming=False),
+}
+
+
+def run_suite(width, height, num_frames, repeats, only=None):
+    """Run the benchmarks in a scratch folder and return the results dict"""
+    workdir = tempfile.mkdtemp(prefix="penalty_bench_")
+    previous_cwd = os.getcwd()
+    results = {}
+    try:
+        # Goal_Viz loads "Fbx Animations" relative to the working directory
+        os.chdir(workdir)
+        make_animations(os.path.join(workdir, "Fbx Animations"))
+        video = make_penalty_video(os.path.join(workdir, 'penalty.mp4'), width, height, num_frames,
+                                   goal_missing_every=7)
+        cap = cv2.VideoCapture(video)
+        frames = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+
+        ctx = {'workdir': workdir, 'video': video, 'frames': frames, 'repeats': repeats}
+        for name, bench in BENCHMARKS.items():
+            if only and name not in only:
+                continue
+            try:
+                times, items = bench(ctx)
+            except Skip as e:
+                results[name] = {'skipped': str(e)}
+                continue
+            results[name] = {
+                'mean_s': statistics.mean(times),
+                'median_s': statistics.median(times),
+                'min_s': min(times),
+                'items_per_call': items,
+                'repeats': len(times)
+            }
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'config': {'width': width, 'height': height, 'frames': num_frames, 'repeats': repeats},
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'processor': platform.processor(), 'opencv': cv2.__version__},
+        'created_at': time.time(),
+        'results': results
+    }
+
+
+def print_results(report, baseline=None, threshold=1.2):
+    """Print the results table; with a baseline, add the ratio and flag regressions"""
+    regressions = []
+    header = f"{'Benchmark':<32} {'median ms':>10} {'min ms':>9} {'ms/item':>9}"
+    if baseline:
+        header += f" {'baseline':>9} {'ratio':>7}"
+    print(header)
+    for name, result in report['results'].items():
+        if 'skipped' in result:
+            print(f"{name:<32} skipped ({result['skipped']})")
+            continue
+        line = (f"{name:<32} {result['median_s'] * 1000:>10.2f} {result['min_s'] * 1000:>9.2f} "
+                f"{result['median_s'] * 1000 / result['items_per_call']:>9.3f}")
+        base = (baseline or {}).get('results', {}).get(name)
+        if base and 'median_s' in base:
+            ratio = result['median_s'] / base['median_s']
+            line += f" {base['median_s'] * 1000:>9.2f} {ratio:>6.2f}x"
+            if ratio > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    if baseline and baseline.get('config') != report['config']:
+        print(f"Warning: baseline config {baseline.get('config')} differs from this run {report['config']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline benchmark suite with synthetic data and stub models")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--frames", type=int, default=90)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write the results to this baseline file")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="Median slowdown vs the baseline reported as a regression (default: 1.2)")
+    args = parser.parse_args()
+
+    report = run_suite(args.width, args.height, args.frames, args.repeats, args.only)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print(f"{args.width}x{args.height}, {args.frames} frames, {args.repeats} repeats")
+    regressions = print_results(report, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
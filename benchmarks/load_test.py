@@ -0,0 +1,431 @@
+"""
+Load test for the API server: concurrent upload, status and download flows
+
+Each flow does what api_client does for one video: a chunked upload
+(send_video), following the job until it is finished (watch_status) and
+downloading a result (download_file). Flows run on --concurrency threads,
+either back to back (closed loop) or arriving at --rate flows per second
+(Poisson arrivals, waiting for a free thread when all are busy).
+
+By default a stub server (stub_server.py) is started for the run on a
+synthetic penalty video; --url targets a running server instead. Every
+flow uploads its own copy of the video with a few random bytes appended,
+so the result cache cannot answer it (--same-content turns that off).
+
+Reported per phase (upload, prediction, processing, download, total):
+p50/p95/p99 latency; overall: throughput, flow error rate, the share of
+HTTP responses that were 429, and the server's CPU and memory use (its
+whole process tree, read from /proc, so only for a local server). The
+report is saved as JSON and can be compared with an earlier one.
+
+Usage:
+    python benchmarks/load_test.py [--concurrency 4] [--flows 20 | --duration 60] [--rate 0.5]
+    python benchmarks/load_test.py --workers 4 --max-queued 16 --output load_w4.json --compare load_w2.json
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 [--server-pid PID]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import api_client
+from synthetic import make_penalty_video
+
+PHASES = ('upload', 'prediction', 'processing', 'download', 'total')
+PERCENTILES = (50, 95, 99)
+SAMPLE_INTERVAL = 0.5
+
+
+def percentile(values, p):
+    """p-th percentile of values, interpolating between the closest ranks"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def _proc_children():
+    """pid -> child pids for every process visible in /proc"""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # The command name may contain spaces; fields after it are fixed
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+    return children
+
+
+def _process_tree_usage(pid):
+    """(CPU seconds, RSS bytes) summed over pid and its descendants, or None if pid is gone"""
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    children = _proc_children()
+    pids, cpu, rss = [pid], 0.0, 0
+    found = False
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        found = True
+        # utime, stime and rss: fields 14, 15 and 24 of stat, the state field (3) being index 0
+        cpu += (int(fields[11]) + int(fields[12])) / clock_ticks
+        rss += int(fields[21]) * page_size
+        pids.extend(children.get(current, []))
+    return (cpu, rss) if found else None
+
+
+class ResourceSampler:
+    """Samples a server's process tree on a background thread"""
+
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.pid and os.path.isdir('/proc'):
+            self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            usage = _process_tree_usage(self.pid)
+            if usage:
+                self.samples.append((time.time(), *usage))
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def summary(self):
+        if len(self.samples) < 2:
+            return None
+        (start, cpu_start, _), (end, cpu_end, _) = self.samples[0], self.samples[-1]
+        rss_mb = [rss / (1024 * 1024) for _, _, rss in self.samples]
+        return {
+            'cpu_s': round(cpu_end - cpu_start, 2),
+            'cpu_percent': round(100 * (cpu_end - cpu_start) / (end - start), 1),
+            'rss_mean_mb': round(sum(rss_mb) / len(rss_mb), 1),
+            'rss_peak_mb': round(max(rss_mb), 1),
+            'samples': len(self.samples)
+        }
+
+
+class StatusCounter:
+    """requests response hook counting HTTP status codes across threads"""
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, response, *args, **kwargs):
+        with self._lock:
+            self.counts[response.status_code] = self.counts.get(response.status_code, 0) + 1
+
+
+def start_stub_server(port, workers, max_queued, workdir):
+    """Start stub_server.py in its own process group; returns the Popen once it answers"""
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, 'stub_server.py'), '--port', str(port), '--workers', str(workers),
+         '--max-queued', str(max_queued), '--workdir', os.path.join(workdir, 'server')],
+        stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Stub server exited, see {log.name}")
+        try:
+            if requests.get(f"{url}/api/queue", timeout=2).status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    stop_stub_server(process)
+    raise RuntimeError(f"Stub server did not start within 120 seconds, see {log.name}")
+
+
+def stop_stub_server(process):
+    # The pool workers are in the server's process group
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def wait_for_workers(url, timeout=120):
+    """Wait until the server has a pool running, so warm-up is not measured"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with contextlib.suppress(requests.RequestException, ValueError):
+            if requests.get(f"{url}/api/queue", timeout=5).json().get('runs_pool'):
+                return
+        time.sleep(0.5)
+
+
+def run_flow(url, video_path, workdir, index, render, same_content, status_counter, timeout):
+    """One upload, status and download flow; returns its phase timings and error, if any"""
+    flow = {'index': index, 'error': None}
+    session = requests.Session()
+    session.hooks['response'].append(status_counter)
+    flow_video = os.path.join(workdir, f"flow_{index}.mp4")
+    shutil.copyfile(video_path, flow_video)
+    if not same_content:
+        with open(flow_video, 'ab') as f:
+            f.write(os.urandom(16))
+    start = time.perf_counter()
+    try:
+        task_id = api_client.send_video(url, flow_video, session=session, render=render)
+        flow['upload'] = time.perf_counter() - start
+        if not task_id:
+            flow['error'] = 'upload'
+            return flow
+
+        processing_start = time.perf_counter()
+        status_data = None
+        for status_data in api_client.watch_status(url, task_id, session=session, timeout=timeout):
+            if 'prediction' not in flow and status_data.get('prediction'):
+                flow['prediction'] = time.perf_counter() - processing_start
+            if api_client._is_finished(status_data):
+                break
+        flow['processing'] = time.perf_counter() - processing_start
+        if not status_data or not api_client._is_finished(status_data):
+            flow['error'] = 'timeout'
+            return flow
+        if status_data.get('status') != 'completed':
+            flow['error'] = 'processing'
+            return flow
+
+        download_start = time.perf_counter()
+        file_type = 'keypoints' if render == 'none' else 'visualization'
+        if not api_client.download_file(f"{url}/api/download/{task_id}/{file_type}",
+                                        os.path.join(workdir, f"flow_{index}_{file_type}.mp4"), session=session):
+            flow['error'] = 'download'
+            return flow
+        flow['download'] = time.perf_counter() - download_start
+        flow['total'] = time.perf_counter() - start
+        session.delete(f"{url}/api/cleanup/{task_id}")
+        return flow
+    except Exception as e:
+        flow['error'] = f"exception: {e}"
+        return flow
+    finally:
+        session.close()
+        for name in os.listdir(workdir):
+            if name.startswith(f"flow_{index}_") or name == f"flow_{index}.mp4":
+                os.remove(os.path.join(workdir, name))
+
+
+def run_load(url, video_path, workdir, concurrency, flows=None, duration=None, rate=None, render=None,
+             same_content=False, timeout=600, server_pid=None, seed=0):
+    """Run flows against url and return the report's results dict"""
+    status_counter = StatusCounter()
+    sampler = ResourceSampler(server_pid)
+    results = []
+    rng = random.Random(seed)
+    # Uploads resume by file; keep this run's sessions out of the working directory
+    api_client.UPLOAD_STATE_FILE = os.path.join(workdir, '.penalty_uploads.json')
+
+    def flow_task(index, arrived):
+        flow = run_flow(url, video_path, workdir, index, render, same_content, status_counter, timeout)
+        if 'total' in flow:
+            # From arrival, including any wait for a free thread
+            flow['total'] = time.perf_counter() - arrived
+        results.append(flow)
+
+    sampler.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull), \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="flow") as pool:
+        index = 0
+        in_flight = []
+        while True:
+            elapsed = time.perf_counter() - start
+            if (flows is not None and index >= flows) or (duration is not None and elapsed >= duration):
+                break
+            if rate:
+                in_flight.append(pool.submit(flow_task, index, time.perf_counter()))
+                time.sleep(rng.expovariate(rate))
+            else:
+                # Closed loop: a new flow as soon as a thread is free
+                in_flight = [future for future in in_flight if not future.done()]
+                if len(in_flight) >= concurrency:
+                    time.sleep(0.05)
+                    continue
+                in_flight.append(pool.submit(flow_task, index, time.perf_counter()))
+            index += 1
+    wall = time.perf_counter() - start
+    sampler.stop()
+
+    completed = [flow for flow in results if not flow['error']]
+    errors = {}
+    for flow in results:
+        if flow['error']:
+            kind = flow['error'].split(':')[0]
+            errors[kind] = errors.get(kind, 0) + 1
+    responses = sum(status_counter.counts.values())
+    phases = {}
+    for phase in PHASES:
+        values = [flow[phase] for flow in results if phase in flow]
+        if values:
+            phases[phase] = {f'p{p}_s': round(percentile(values, p), 3) for p in PERCENTILES}
+            phases[phase].update(mean_s=round(sum(values) / len(values), 3), max_s=round(max(values), 3),
+                                 count=len(values))
+    return {
+        'flows': len(results),
+        'completed': len(completed),
+        'wall_s': round(wall, 2),
+        'throughput_per_s': round(len(completed) / wall, 3) if wall else None,
+        'error_rate': round(1 - len(completed) / len(results), 3) if results else None,
+        'errors': errors,
+        'responses': responses,
+        'rate_429': round(status_counter.counts.get(429, 0) / responses, 3) if responses else None,
+        'status_codes': {str(code): count for code, count in sorted(status_counter.counts.items())},
+        'phases': phases,
+        'server': sampler.summary()
+    }
+
+
+def print_report(report, baseline=None):
+    """Print the results; with a baseline, add its values and the ratio"""
+    results = report['results']
+    base = (baseline or {}).get('results', {})
+
+    def compare(value, base_value):
+        if base_value in (None, 0) or value is None:
+            return ""
+        return f"  (baseline {base_value}, {value / base_value:.2f}x)"
+
+    print(f"{results['completed']}/{results['flows']} flows completed in {results['wall_s']} s, "
+          f"{results['throughput_per_s']} flows/s{compare(results['throughput_per_s'], base.get('throughput_per_s'))}")
+    print(f"Error rate {results['error_rate']} {results['errors'] or ''}, "
+          f"429 rate {results['rate_429']} of {results['responses']} responses")
+    header = f"{'Phase':<12} " + " ".join(f"{f'p{p} s':>9}" for p in PERCENTILES) + f" {'mean s':>9} {'count':>6}"
+    if baseline:
+        header += f" {'base p95':>9} {'ratio':>7}"
+    print(header)
+    for phase, stats in results['phases'].items():
+        line = f"{phase:<12} " + " ".join(f"{stats[f'p{p}_s']:>9.3f}" for p in PERCENTILES)
+        line += f" {stats['mean_s']:>9.3f} {stats['count']:>6}"
+        base_stats = base.get('phases', {}).get(phase)
+        if base_stats and base_stats.get('p95_s'):
+            line += f" {base_stats['p95_s']:>9.3f} {stats['p95_s'] / base_stats['p95_s']:>6.2f}x"
+        print(line)
+    server = results.get('server')
+    if server:
+        print(f"Server: {server['cpu_percent']}% CPU ({server['cpu_s']} s), "
+              f"RSS mean {server['rss_mean_mb']} MB, peak {server['rss_peak_mb']} MB")
+    if baseline and baseline.get('config') != report['config']:
+        print(f"Warning: baseline config {baseline.get('config')} differs from this run {report['config']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the API server with concurrent upload/status/download flows")
+    parser.add_argument("--url", help="Server to test (default: start a stub server for the run)")
+    parser.add_argument("--server-pid", type=int, help="With --url: pid of the server, to sample its resource use")
+    parser.add_argument("--port", type=int, default=5077, help="Port of the stub server (default: 5077)")
+    parser.add_argument("--workers", type=int, default=2, help="Stub server worker processes (default: 2)")
+    parser.add_argument("--max-queued", type=int, default=8, help="Stub server queue length (default: 8)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Flows in flight at most (default: 4)")
+    parser.add_argument("--flows", type=int, help="Number of flows to start (default: 20 without --duration)")
+    parser.add_argument("--duration", type=float, help="Seconds to keep starting flows")
+    parser.add_argument("--rate", type=float,
+                        help="Flows arriving per second (Poisson); default: closed loop at --concurrency")
+    parser.add_argument("--render", choices=["background", "inline", "none"],
+                        help="Render mode of the uploads (default: the server's)")
+    parser.add_argument("--video", help="Video to upload (default: a synthetic penalty video)")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--same-content", action="store_true",
+                        help="Upload identical bytes every time, e.g. to measure result cache hits")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds a flow may wait for its job")
+    parser.add_argument("--output", default="load_test_report.json", help="Report file (default: load_test_report.json)")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against an earlier report")
+    args = parser.parse_args()
+    if args.flows is None and args.duration is None:
+        args.flows = 20
+
+    workdir = tempfile.mkdtemp(prefix="penalty_load_")
+    server = None
+    try:
+        video = args.video or make_penalty_video(os.path.join(workdir, 'penalty.mp4'), args.width, args.height,
+                                                 args.frames, goal_missing_every=7)
+        url = args.url.rstrip('/') if args.url else None
+        server_pid = args.server_pid
+        if url is None:
+            print(f"Starting stub server with {args.workers} workers...")
+            server = start_stub_server(args.port, args.workers, args.max_queued, workdir)
+            url, server_pid = f"http://127.0.0.1:{args.port}", server.pid
+        wait_for_workers(url)
+
+        load = (f"{args.flows} flows" if args.flows is not None else f"{args.duration} s") + \
+               (f" at {args.rate}/s" if args.rate else " closed loop")
+        print(f"Running {load}, concurrency {args.concurrency} against {url}")
+        results = run_load(url, video, workdir, args.concurrency, args.flows, args.duration, args.rate, args.render,
+                           args.same_content, args.timeout, server_pid)
+        report = {
+            'config': {
+                'url': args.url or 'stub', 'workers': None if args.url else args.workers,
+                'max_queued': None if args.url else args.max_queued, 'concurrency': args.concurrency,
+                'flows': args.flows, 'duration': args.duration, 'rate': args.rate, 'render': args.render,
+                'video': args.video or f"synthetic {args.width}x{args.height} {args.frames} frames",
+                'same_content': args.same_content
+            },
+            'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'processor': platform.processor(), 'cpus': os.cpu_count()},
+            'created_at': time.time(),
+            'results': results
+        }
+    finally:
+        if server is not None:
+            stop_stub_server(server)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+API server running the pipeline with stub models, for load tests
+
+Starts api_server in a scratch working folder (uploads, results, job
+database and synthetic goalkeeper animations all live there) with its
+worker pool running MasterScript.process_job on StubPoseInferencer and
+StubClassifier (see synthetic.py). The whole upload, queue, pipeline and
+download path runs as in production, without a GPU or model weights.
+The result cache is off unless --result-cache is given, so every upload
+goes through the pipeline.
+
+Usage:
+    python benchmarks/stub_server.py [--port 5077] [--workers 2] [--max-queued 8] [--workdir DIR]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic import make_animations, StubPoseInferencer, StubClassifier
+
+# Stub classifier of this worker process, created by init_stub_worker
+_model = None
+
+
+def init_stub_worker():
+    """Pool initializer: MasterScript.init_worker with stub models"""
+    global _model
+    import MasterScript
+    from Classified_Clips.MMpose import Infer3D
+    from log_utils import configure_logging
+    configure_logging()
+    MasterScript._warm_infer3d = Infer3D(device='cpu', inferencer=StubPoseInferencer())
+    MasterScript.load_animations(MasterScript.ANIMATIONS_FOLDER)
+    _model = StubClassifier()
+
+
+def run_stub_job(job):
+    import MasterScript
+    # The stage cache keys predictions on the model file, so it is off with a stub model
+    return MasterScript.process_job(job, model=_model, use_cache=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API server with the stub pipeline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5077)
+    parser.add_argument("--workers", type=int, default=2, help="Pipeline worker processes (default: 2)")
+    parser.add_argument("--max-queued", type=int, default=8, help="Uploads allowed to wait (default: 8)")
+    parser.add_argument("--workdir", help="Working folder (default: a new temporary folder)")
+    parser.add_argument("--result-cache", action="store_true",
+                        help="Answer repeated uploads of the same video from the result cache")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="penalty_stub_server_")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    # Goal_Viz loads "Fbx Animations" relative to the working directory
+    make_animations(os.path.join(workdir, "Fbx Animations"))
+
+    # api_server reads these at import; the pool is started below with the stub job
+    os.environ['PENALTY_RUN_WORKERS'] = '0'
+    os.environ['PENALTY_WORKER_PROCESSES'] = str(args.workers)
+    os.environ['PENALTY_MAX_QUEUED_JOBS'] = str(args.max_queued)
+    if not args.result_cache:
+        os.environ['PENALTY_RESULT_CACHE'] = 'off'
+    import api_server
+
+    api_server.scheduler.pool.run_job = run_stub_job
+    api_server.scheduler.pool.initializer = init_stub_worker
+    api_server.scheduler.start()
+    print(f"Stub API server in {workdir}, {args.workers} workers, queue of {args.max_queued}")
+    api_server.app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Synthetic inputs and stub models for running the pipeline without the real
+dataset or model weights.
+
+make_penalty_video draws a white goal frame on a pitch with a figure
+running up to the ball. StubPoseInferencer and StubClassifier stand in for
+MMPoseInferencer and the Keras model with the same call signatures and
+output shapes, so they can be passed to Infer3D(inferencer=...) and
+process_single_video(..., model=...).
+"""
+
+import os
+import cv2
+import numpy as np
+
+# Same colour detect_goal looks for
+GOAL_COLOR = (220, 220, 220)
+PITCH_COLOR = (40, 120, 40)
+NUM_KEYPOINTS = 17
+
+
+def make_penalty_video(path, width=1280, height=720, num_frames=90, fps=30, goal_missing_every=0):
+    """
+    Write a penalty-like mp4 of num_frames at width x height. The goal is
+    left out of every goal_missing_every-th frame (0 keeps it in all
+    frames) so the goalkeeper animation offset logic is exercised.
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    goal = (int(width * 0.25), int(height * 0.2), int(width * 0.75), int(height * 0.65))
+    post = max(4, width // 200)
+    for i in range(num_frames):
+        frame = np.full((height, width, 3), PITCH_COLOR, np.uint8)
+        if not goal_missing_every or i % goal_missing_every != goal_missing_every - 1:
+            cv2.rectangle(frame, goal[:2], goal[2:], GOAL_COLOR, post)
+        _draw_figure(frame, i / max(1, num_frames - 1))
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def _draw_figure(frame, t):
+    """Stick figure running from the bottom left towards the penalty spot"""
+    height, width = frame.shape[:2]
+    x = int(width * (0.1 + 0.35 * t))
+    y = int(height * 0.8)
+    size = height // 12
+    stride = int(size * 0.4 * np.sin(t * 12 * np.pi))
+    cv2.circle(frame, (x, y - 2 * size), size // 3, (30, 30, 30), -1)
+    cv2.line(frame, (x, y - 2 * size), (x, y - size), (30, 30, 30), max(2, size // 8))
+    cv2.line(frame, (x, y - size), (x - stride, y), (30, 30, 30), max(2, size // 8))
+    cv2.line(frame, (x, y - size), (x + stride, y), (30, 30, 30), max(2, size // 8))
+    cv2.circle(frame, (width // 2, int(height * 0.82)), max(3, size // 5), (255, 255, 255), -1)
+
+
+def make_animations(folder, frames_per_direction=30, width=300, height=200):
+    """Write dive_<direction> PNG sequences with alpha, like Fbx Animations"""
+    for direction_idx, direction in enumerate(('left', 'center', 'right')):
+        sequence_folder = os.path.join(folder, f'dive_{direction}')
+        os.makedirs(sequence_folder, exist_ok=True)
+        for i in range(frames_per_direction):
+            sprite = np.zeros((height, width, 4), np.uint8)
+            x = width // 2 + (direction_idx - 1) * i * width // (2 * frames_per_direction)
+            cv2.ellipse(sprite, (x, height // 2), (width // 8, height // 3), i * 3, 0, 360, (0, 0, 200, 255), -1)
+            # Soft edge so compositing sees partial alpha
+            sprite[:, :, 3] = cv2.GaussianBlur(sprite[:, :, 3], (9, 9), 0)
+            cv2.imwrite(os.path.join(sequence_folder, f'frame_{i:03d}.png'), sprite)
+    return folder
+
+
+class StubPoseInferencer:
+    """
+    Stands in for MMPoseInferencer(pose3d='human3d'): calling it yields one
+    result per frame with 17 [x, y, z] keypoints for one person and, with
+    return_vis, an RGB visualization the size of the frame
+    """
+
+    def __init__(self, seed=0):
+        rng = np.random.default_rng(seed)
+        self._skeleton = rng.normal(0, 0.3, (NUM_KEYPOINTS, 3))
+        self._calls = 0
+
+    def __call__(self, frame, return_vis=False):
+        t = self._calls * 0.05
+        self._calls += 1
+        keypoints = self._skeleton + np.array([np.sin(t), 0.0, np.cos(t)]) * 0.1
+        result = {
+            'predictions': [[{
+                'keypoints': keypoints.tolist(),
+                'keypoint_scores': [0.9] * NUM_KEYPOINTS
+            }]]
+        }
+        if return_vis:
+            result['visualization'] = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)]
+        yield result
+
+
+class _Tensor:
+    """The part of a tf.Tensor the pipeline uses"""
+
+    def __init__(self, value):
+        self._value = value
+
+    def numpy(self):
+        return self._value
+
+
+class StubClassifier:
+    """
+    Stands in for the Conv3D Keras model: takes (batch, 26, 17, 3, 1) and
+    returns softmax scores over (center, left, right) from a fixed random
+    projection, so the output depends on the keypoints
+    """
+
+    def __init__(self, seed=0):
+        rng = np.random.default_rng(seed)
+        self._weights = rng.normal(0, 0.05, (26 * NUM_KEYPOINTS * 3, 3))
+
+    def __call__(self, x, training=False):
+        x = np.asarray(x, dtype=np.float64)
+        logits = x.reshape(x.shape[0], -1) @ self._weights
+        scores = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return _Tensor(scores / scores.sum(axis=1, keepdims=True))
+
+
+def make_keypoints(num_frames=26, seed=0):
+    """Per-frame keypoints list as Infer3D produces it"""
+    inferencer = StubPoseInferencer(seed)
+    frame = np.zeros((8, 8, 3), np.uint8)
+    return [next(inferencer(frame))['predictions'][0][0]['keypoints'] for _ in range(num_frames)]
@@ -0,0 +1,247 @@
+"""
+Retention and disk quota for API uploads and results.
+
+The janitor runs on a background thread of one server process per host
+(the first to lock <job db>.janitor.lock) and, every interval:
+
+- removes finished jobs not downloaded for ttl seconds: their upload,
+  their result folder and their job records
+- then, while uploads and results together take more than max_bytes,
+  removes finished jobs least recently downloaded first
+- removes upload sessions that received nothing for session_ttl seconds
+
+Queued and running jobs, and jobs whose visualization is still being
+rendered, are never touched. What it did is kept in a stats file so every
+server process can report it.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from job_store import COMPLETED, ERROR
+
+try:
+    import fcntl
+except ImportError:  # Windows: the janitor runs in every process that starts it
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+RETENTION_HOURS_ENV = 'PENALTY_RETENTION_HOURS'
+DISK_QUOTA_MB_ENV = 'PENALTY_DISK_QUOTA_MB'
+JANITOR_INTERVAL_ENV = 'PENALTY_JANITOR_INTERVAL'
+SESSION_TTL_HOURS_ENV = 'PENALTY_UPLOAD_SESSION_TTL_HOURS'
+DEFAULT_RETENTION_HOURS = 72
+DEFAULT_DISK_QUOTA_MB = 10240
+DEFAULT_INTERVAL = 300
+DEFAULT_SESSION_TTL_HOURS = 24
+
+
+def folder_size(path):
+    """Total bytes of the files under path"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+
+def job_files(job, upload_folder):
+    """The upload and result folder of a job record, where they exist"""
+    paths = []
+    if job.get('unique_filename'):
+        paths.append(os.path.join(upload_folder, job['unique_filename']))
+    result_folder = job.get('result_folder')
+    if not result_folder and job.get('manifest_file'):
+        result_folder = os.path.dirname(job['manifest_file'])
+    if not result_folder and job.get('output_folder') and job.get('unique_filename'):
+        # process_single_video writes to <output_folder>/<video name>
+        result_folder = os.path.join(job['output_folder'], os.path.splitext(job['unique_filename'])[0])
+    if result_folder:
+        paths.append(result_folder)
+    return [path for path in paths if os.path.exists(path)]
+
+
+def remove_job_files(job, upload_folder):
+    """Delete a job's upload and result folder; returns bytes freed"""
+    freed = 0
+    for path in job_files(job, upload_folder):
+        if os.path.isdir(path):
+            freed += folder_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+            # Drop the per-video parent folder once its last result is gone
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        else:
+            freed += os.path.getsize(path)
+            os.remove(path)
+    return freed
+
+
+def last_used(job):
+    """When a job's results were last downloaded, or finished if never"""
+    return job.get('last_downloaded_at') or job.get('completed_at') or job['updated_at']
+
+
+class Janitor:
+    def __init__(self, store, upload_folder, processed_folder, upload_sessions=None, ttl=None, max_bytes=None,
+                 session_ttl=None, interval=DEFAULT_INTERVAL, lock_path=None, stats_path=None,
+                 related_jobs=None):
+        """
+        Args:
+            store: Job store with the task records
+            upload_folder, processed_folder: Folders counted against max_bytes
+            upload_sessions: UploadSessions whose stale sessions are removed
+            ttl: Seconds a finished job is kept after its last download
+            max_bytes: Quota for upload_folder and processed_folder together
+            session_ttl: Seconds an idle upload session is kept
+            interval: Seconds between runs
+            lock_path: File locked by the one process that runs the janitor
+            stats_path: JSON file the janitor's counters are kept in
+            related_jobs: related_jobs(job_id) lists ids of records to
+                delete along with a job, e.g. its background render job
+        """
+        self.store = store
+        self.upload_folder = upload_folder
+        self.processed_folder = processed_folder
+        self.upload_sessions = upload_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.session_ttl = session_ttl
+        self.interval = interval
+        self.lock_path = lock_path
+        self.stats_path = stats_path
+        self.related_jobs = related_jobs or (lambda job_id: [])
+        self._stats = {}
+        self._lock_file = None
+        self._started = False
+
+    def start(self):
+        """Run the janitor on a daemon thread, in this process only if it gets the lock (idempotent)"""
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._loop, name="janitor", daemon=True).start()
+
+    def _try_lock(self):
+        if self._lock_file is not None or not self.lock_path or fcntl is None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Held for the life of the process
+        self._lock_file = lock_file
+        return True
+
+    def _loop(self):
+        while True:
+            if self._try_lock():
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.error("Janitor run failed: %s", e)
+            time.sleep(self.interval)
+
+    def remove_job(self, job):
+        """Delete a job's files and its records; returns bytes freed"""
+        freed = remove_job_files(job, self.upload_folder)
+        self.store.delete(job['task_id'])
+        for job_id in self.related_jobs(job['task_id']):
+            self.store.delete(job_id)
+        return freed
+
+    def run_once(self, now=None):
+        """One pass of TTL expiry, quota eviction and session cleanup; returns this pass's counts"""
+        now = now or time.time()
+        start = time.time()
+        run = {'expired_jobs': 0, 'evicted_jobs': 0, 'expired_sessions': 0, 'freed_bytes': 0}
+
+        # Least recently downloaded first; renders still to come keep their job
+        finished = sorted((job for job in self.store.find((COMPLETED, ERROR))
+                           if job.get('render_status') not in ('pending', 'rendering')
+                           and not job.get('parent_id')), key=last_used)
+
+        if self.ttl is not None:
+            keep = []
+            for job in finished:
+                if now - last_used(job) > self.ttl:
+                    run['freed_bytes'] += self.remove_job(job)
+                    run['expired_jobs'] += 1
+                else:
+                    keep.append(job)
+            finished = keep
+
+        if self.upload_sessions and self.session_ttl is not None:
+            sessions, freed = self.upload_sessions.expire(self.session_ttl)
+            run['expired_sessions'] += sessions
+            run['freed_bytes'] += freed
+
+        disk_bytes = folder_size(self.upload_folder) + folder_size(self.processed_folder)
+        if self.max_bytes is not None:
+            for job in finished:
+                if disk_bytes <= self.max_bytes:
+                    break
+                freed = self.remove_job(job)
+                disk_bytes -= freed
+                run['freed_bytes'] += freed
+                run['evicted_jobs'] += 1
+            if disk_bytes > self.max_bytes:
+                logger.warning("Uploads and results take %.1f MB, over the %.1f MB quota, with nothing left to evict",
+                               disk_bytes / (1024 * 1024), self.max_bytes / (1024 * 1024))
+
+        if run['expired_jobs'] or run['evicted_jobs'] or run['expired_sessions']:
+            logger.info("Janitor removed %d expired and %d evicted jobs and %d stale upload sessions, freed %.1f MB",
+                        run['expired_jobs'], run['evicted_jobs'], run['expired_sessions'],
+                        run['freed_bytes'] / (1024 * 1024))
+        self._record(run, disk_bytes, time.time() - start)
+        return run
+
+    def _record(self, run, disk_bytes, duration):
+        stats = self.stats()
+        for name, value in run.items():
+            stats[name] = stats.get(name, 0) + value
+        stats.update(runs=stats.get('runs', 0) + 1, last_run_at=time.time(), last_run_s=round(duration, 3),
+                     disk_bytes=disk_bytes, quota_bytes=self.max_bytes, ttl_s=self.ttl)
+        self._stats = stats
+        if self.stats_path:
+            tmp_path = f"{self.stats_path}.tmp-{os.getpid()}"
+            with open(tmp_path, 'w') as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, self.stats_path)
+
+    def stats(self):
+        """Totals since the stats file was created: jobs removed, bytes freed, runs, current disk use"""
+        if self.stats_path:
+            try:
+                with open(self.stats_path) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                return {}
+        return dict(self._stats)
+
+
+def janitor_settings():
+    """ttl, max_bytes, session_ttl and interval from the environment; 0 turns a limit off"""
+    def hours(name, default):
+        value = float(os.environ.get(name, default))
+        return value * 3600 if value > 0 else None
+
+    quota_mb = float(os.environ.get(DISK_QUOTA_MB_ENV, DEFAULT_DISK_QUOTA_MB))
+    return {
+        'ttl': hours(RETENTION_HOURS_ENV, DEFAULT_RETENTION_HOURS),
+        'max_bytes': int(quota_mb * 1024 * 1024) if quota_mb > 0 else None,
+        'session_ttl': hours(SESSION_TTL_HOURS_ENV, DEFAULT_SESSION_TTL_HOURS),
+        'interval': float(os.environ.get(JANITOR_INTERVAL_ENV, DEFAULT_INTERVAL))
+    }
@@ -0,0 +1,366 @@
+"""
+Bounded job scheduler for the API server.
+
+Jobs are records in the shared job store (see job_store.py). At most
+max_queued of them may wait; the rest of the uploads get QueueFull. The
+queue is drained by WorkerPools: worker processes, one job per process at
+a time, which are started once and keep their models loaded (see
+MasterScript.init_worker). Dispatcher threads claim jobs from a broker
+atomically, so a job runs exactly once, and send heartbeats while it runs.
+
+Any HTTP worker can enqueue, but only one process per host leads: the
+first to take an exclusive lock next to the job database. The leader runs
+the local pool, if the server has workers, and puts jobs whose heartbeats
+stopped (a worker host died) back in the queue. Pools on other hosts
+(worker.py) claim through the API's worker endpoints instead of the store.
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from job_store import QueueLimitReached, QUEUED, PROCESSING
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single server process runs the pool
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds between heartbeats of a running job, and without one before the job is requeued
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+# Runs of a job lost with its worker before it is failed instead of requeued
+MAX_ATTEMPTS = 3
+
+
+class WorkerLost(Exception):
+    """A job's worker stopped sending heartbeats"""
+
+
+class JobTaken(Exception):
+    """A job was requeued and claimed elsewhere while this worker ran it"""
+
+
+class QueueFull(Exception):
+    """The queue has no room; retry_after is a suggested wait in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+def _warm_up():
+    """No-op run once per worker so the processes start and load their models"""
+    return True
+
+
+class WorkerPool:
+    def __init__(self, broker, run_job, workers=1, initializer=None, initargs=(), on_start=None, on_done=None,
+                 on_error=None, poll_interval=0.5, heartbeat_interval=HEARTBEAT_INTERVAL, worker_id=None):
+        """
+        Args:
+            broker: Where jobs come from: claim(worker_id) returns a job
+                or None, heartbeat(job_id, worker_id) returns False once the
+                job is no longer this worker's. The job store, or an
+                HTTP client of the API server (worker.py)
+            run_job: Picklable function run as run_job(job) in a worker process
+            workers: Number of worker processes, i.e. jobs running at once
+            initializer: Called with initargs in each new worker process
+            on_start, on_done, on_error: Called as on_start(job),
+                on_done(job, result) and on_error(job, exception) on a
+                dispatcher thread
+            poll_interval: Seconds between claims while the queue is empty
+            heartbeat_interval: Seconds between heartbeats of running jobs
+            worker_id: Prefix of the dispatcher ids jobs are claimed under
+        """
+        self.broker = broker
+        self.run_job = run_job
+        self.workers = workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.on_start = on_start
+        self.on_done = on_done
+        self.on_error = on_error
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        # A fresh id per pool, so jobs of an earlier pool are never mistaken for this one's
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.running = 0
+
+        self._wakeup = threading.Condition()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _new_pool(self):
+        # spawn, so CUDA is initialized in each worker and not inherited
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                   initializer=self.initializer, initargs=self.initargs)
+
+    def start(self):
+        """Start the worker processes and one dispatcher thread per process"""
+        with self._pool_lock:
+            self._pool = self._new_pool()
+            pool = self._pool
+        for _ in range(self.workers):
+            pool.submit(_warm_up)
+        for i in range(self.workers):
+            threading.Thread(target=self._dispatch, args=(i,), name=f"job-dispatcher-{i}", daemon=True).start()
+
+    def wake(self):
+        """Claim now instead of at the next poll, e.g. after a job was queued"""
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _dispatch(self, index):
+        worker_id = f"{self.worker_id}:{index}"
+        while True:
+            try:
+                job = self.broker.claim(worker_id)
+            except Exception as e:
+                logger.warning("Could not claim a job: %s", e)
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+
+            with self._pool_lock:
+                pool = self._pool
+            if self.on_start:
+                self.on_start(job)
+            self.running += 1
+            try:
+                result = self._run(pool, job, worker_id)
+            except JobTaken:
+                logger.warning("Dropped the result of job %s, it was taken from this worker", job['task_id'])
+            except BrokenProcessPool as e:
+                # A worker died (e.g. out of memory); replace the pool for later jobs
+                logger.error("Worker process died running job %s, restarting the pool", job['task_id'])
+                self._replace_pool(pool)
+                if self.on_error:
+                    self.on_error(job, e)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(job, e)
+            else:
+                if self.on_done:
+                    self.on_done(job, result)
+            finally:
+                self.running -= 1
+
+    def _run(self, pool, job, worker_id):
+        """
+        Run job on the pool, sending heartbeats until it finishes. Raises
+        JobTaken once a heartbeat finds the job is no longer this worker's,
+        whatever the run's outcome.
+        """
+        future = pool.submit(self.run_job, job)
+        taken = False
+        while True:
+            try:
+                result = future.result(timeout=self.heartbeat_interval)
+            except FutureTimeout:
+                if taken:
+                    continue
+                try:
+                    if not self.broker.heartbeat(job['task_id'], worker_id):
+                        logger.warning("Job %s was taken from this worker, its result will be dropped",
+                                       job['task_id'])
+                        taken = True
+                except Exception as e:
+                    logger.warning("Heartbeat for job %s failed: %s", job['task_id'], e)
+            except BrokenProcessPool:
+                raise
+            except Exception:
+                if taken:
+                    raise JobTaken(job['task_id']) from None
+                raise
+            else:
+                if taken:
+                    raise JobTaken(job['task_id'])
+                return result
+
+    def _replace_pool(self, broken_pool):
+        with self._pool_lock:
+            if self._pool is broken_pool:
+                self._pool = self._new_pool()
+        broken_pool.shutdown(wait=False)
+
+
+class JobScheduler:
+    def __init__(self, store, run_job, workers=1, max_queued=8, initializer=None, initargs=(),
+                 on_start=None, on_done=None, on_error=None, lock_path=None,
+                 poll_interval=0.5, default_duration=60.0, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 max_attempts=MAX_ATTEMPTS):
+        """
+        Args:
+            store: Job store shared with the other server processes
+            run_job: Picklable function run as run_job(job) in a worker process
+            workers: Number of worker processes, i.e. jobs running at once;
+                0 leaves the jobs to workers on other hosts
+            max_queued: Jobs allowed to wait on top of the running ones
+            initializer: Called with initargs in each new worker process
+            on_start, on_done, on_error: Called as on_start(job),
+                on_done(job, result) and on_error(job, exception) on a
+                dispatcher thread of the process running the pool; on_error
+                also for jobs whose worker was lost max_attempts times
+            lock_path: File locked by the process that leads; None leads
+                in every process that calls start()
+            poll_interval: Seconds between store polls for jobs queued by
+                other processes
+            default_duration: Assumed job length in seconds for Retry-After
+                until a job has finished
+            heartbeat_timeout: Seconds without a heartbeat before a running
+                job is put back in the queue
+            max_attempts: Runs of a job lost with its worker before it fails
+        """
+        self.store = store
+        self.max_queued = max_queued
+        self.on_done = on_done
+        self.on_error = on_error
+        self.lock_path = lock_path
+        self.average_duration = default_duration
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.pool = WorkerPool(store, run_job, workers, initializer, initargs, on_start=on_start,
+                               on_done=self.job_done, on_error=self.job_failed, poll_interval=poll_interval)
+
+        self._lock = threading.Lock()
+        self._started = False
+        self._leader = False
+        self._lock_file = None
+
+    @property
+    def workers(self):
+        return self.pool.workers
+
+    def start(self):
+        """
+        Lead in this process if no other process on the host does;
+        otherwise keep trying in the background in case that process exits
+        (idempotent)
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        if self._try_lead():
+            return
+        threading.Thread(target=self._wait_for_leadership, name="job-leader", daemon=True).start()
+
+    def _try_lead(self):
+        previous_pool = None
+        if self.lock_path and fcntl is not None:
+            lock_file = open(self.lock_path, 'a+')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            # Held for the life of the process. It names the leader's pool, so
+            # the next leader knows which jobs the previous one left behind.
+            lock_file.seek(0)
+            previous_pool = lock_file.read().strip() or None
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write(self.pool.worker_id)
+            lock_file.flush()
+            self._lock_file = lock_file
+
+        self._leader = True
+        if previous_pool:
+            # Jobs still claimed by the previous leader's pool belonged to a
+            # server that is gone; worker.py hosts keep theirs
+            requeued = sum(self.store.release(job['task_id'], job['claimed_by'])
+                           for job in self.store.stale(time.time())
+                           if (job.get('claimed_by') or '').startswith(previous_pool + ':'))
+            if requeued:
+                logger.warning("Requeued %d jobs interrupted by a previous server", requeued)
+
+        if self.workers:
+            self.pool.start()
+        threading.Thread(target=self._requeue_lost, name="job-reaper", daemon=True).start()
+        logger.info("Job scheduler leading in pid %d: %d worker processes, queue of %d",
+                    os.getpid(), self.workers, self.max_queued)
+        return True
+
+    def _wait_for_leadership(self):
+        while not self._try_lead():
+            time.sleep(5)
+
+    def _requeue_lost(self):
+        """Put jobs whose worker stopped sending heartbeats back in the queue, or fail them"""
+        while True:
+            time.sleep(self.pool.heartbeat_interval)
+            try:
+                for job in self.store.stale(time.time() - self.heartbeat_timeout):
+                    attempts = job.get('attempts', 0) + 1
+                    if attempts < self.max_attempts:
+                        if self.store.release(job['task_id'], job['claimed_by'], attempts=attempts):
+                            logger.warning("Worker %s stopped responding, requeued job %s (attempt %d)",
+                                           job['claimed_by'], job['task_id'], attempts)
+                    elif self.on_error:
+                        self.on_error(job, WorkerLost(f"Worker lost {attempts} times running the job"))
+            except Exception as e:
+                logger.error("Could not requeue lost jobs: %s", e)
+
+    def submit(self, job_id, fields, priority=0):
+        """
+        Queue a job with the given fields. Returns its 1-based queue
+        position, or raises QueueFull. Jobs wait in the store until a
+        worker, in this or another process or host, claims them.
+        Background jobs (negative priority) run only when no other job
+        waits and are not limited by max_queued.
+        """
+        try:
+            self.store.enqueue(job_id, fields, max_queued=self.max_queued if priority >= 0 else None,
+                               priority=priority)
+        except QueueLimitReached:
+            raise QueueFull(self.retry_after())
+        self.pool.wake()
+        return self.store.queue_position(job_id)
+
+    def job_done(self, job, result):
+        """Record a job finished by a worker here or on another host"""
+        # Smoothed job duration for Retry-After estimates
+        self.average_duration = 0.8 * self.average_duration + 0.2 * (time.time() - job['claimed_at'])
+        if self.on_done:
+            self.on_done(job, result)
+
+    def job_failed(self, job, error):
+        if self.on_error:
+            self.on_error(job, error)
+
+    def is_full(self):
+        return self.store.count(QUEUED, min_priority=0) >= self.max_queued
+
+    def position(self, job_id):
+        """1-based position of a waiting job, or None if it is not queued"""
+        return self.store.queue_position(job_id)
+
+    def retry_after(self):
+        """Seconds until a queue slot is expected to free up: the next running job finishing"""
+        running = max(1, self.store.count(PROCESSING))
+        return max(1, math.ceil(self.average_duration / running))
+
+    def stats(self):
+        counts = self.store.counts()
+        return {
+            'queued': counts.get(QUEUED, 0),
+            'running': counts.get(PROCESSING, 0),
+            'workers': self.workers,
+            'max_queued': self.max_queued,
+            'jobs': counts,
+            'runs_pool': self._leader and self.workers > 0,
+            'average_duration_s': round(self.average_duration, 2)
+        }
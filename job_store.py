@@ -0,0 +1,413 @@
+"""
+Shared job store for the API server.
+
+Every HTTP worker and pipeline process reads and writes job records here
+instead of a per-process dict, so status and download requests work on
+any gunicorn worker and jobs survive a restart.
+
+SQLiteJobStore keeps jobs in one SQLite database in WAL mode, with the
+status and queue order in indexed columns and the other fields as JSON.
+State changes are atomic: a job moves between states only if it is still
+in the expected one, so two workers can never claim the same job. Jobs
+are claimed highest priority first, then in the order they were queued.
+
+The store is also the broker for workers on other hosts (see worker.py):
+a worker holding a job sends heartbeats, and a job whose heartbeat stops
+is found by stale() and released back to the queue.
+
+MemoryJobStore has the same interface for a single process and tests.
+Other processes, such as the API's local worker pool, cannot see it.
+
+The store is chosen with PENALTY_JOB_STORE: sqlite:///path/to/jobs.db
+(default sqlite:///jobs.db) or memory://.
+"""
+
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+
+JOB_STORE_ENV = 'PENALTY_JOB_STORE'
+DEFAULT_JOB_STORE = 'sqlite:///jobs.db'
+
+QUEUED = 'queued'
+PROCESSING = 'processing'
+COMPLETED = 'completed'
+ERROR = 'error'
+
+
+class QueueLimitReached(Exception):
+    """enqueue found max_queued jobs already waiting"""
+
+
+class MemoryJobStore:
+    """In-process job store with the same semantics as SQLiteJobStore"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._seq = 0
+        self._lock = threading.RLock()
+
+    def enqueue(self, job_id, fields, max_queued=None, status=QUEUED, priority=0):
+        """
+        Add a queued job, unless max_queued jobs of the same or higher
+        priority are already waiting. A different status adds a job that is
+        not for the workers, e.g. one already completed.
+        """
+        with self._lock:
+            if max_queued is not None and self.count(QUEUED, min_priority=priority) >= max_queued:
+                raise QueueLimitReached(job_id)
+            self._seq += 1
+            now = time.time()
+            self._jobs[job_id] = dict(fields, task_id=job_id, status=status, _seq=self._seq, priority=priority,
+                                      created_at=now, updated_at=now)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job else None
+
+    def update(self, job_id, **fields):
+        """Set fields on a job; returns False if it does not exist"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            job.update(fields, updated_at=time.time())
+            return True
+
+    def transition(self, job_id, from_states, to_state, worker_id=None, **fields):
+        """
+        Move a job to to_state only if its status is one of from_states and,
+        if worker_id is given, it is still claimed by worker_id
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] not in from_states:
+                return False
+            if worker_id is not None and job.get('claimed_by') != worker_id:
+                return False
+            job.update(fields, status=to_state, updated_at=time.time())
+            return True
+
+    def claim(self, worker_id):
+        """Take the oldest queued job for worker_id; returns it or None"""
+        with self._lock:
+            queued = [job for job in self._jobs.values() if job['status'] == QUEUED]
+            if not queued:
+                return None
+            job = min(queued, key=self._claim_order)
+            now = time.time()
+            job.update(status=PROCESSING, claimed_by=worker_id, claimed_at=now, heartbeat_at=now, updated_at=now)
+            return self._public(job)
+
+    def heartbeat(self, job_id, worker_id):
+        """
+        Record that worker_id is still running job_id; False if the job is
+        no longer processing under that worker. Not a change to the job's
+        status, so updated_at stays.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != PROCESSING or job.get('claimed_by') != worker_id:
+                return False
+            job['heartbeat_at'] = time.time()
+            return True
+
+    def release(self, job_id, worker_id, **fields):
+        """Put a job processing under worker_id back in the queue, setting fields"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != PROCESSING or job.get('claimed_by') != worker_id:
+                return False
+            job.update(fields, status=QUEUED, claimed_by=None, updated_at=time.time())
+            return True
+
+    def stale(self, before):
+        """Processing jobs whose last heartbeat (or claim) was before the given time"""
+        with self._lock:
+            return [self._public(job) for job in self._jobs.values()
+                    if job['status'] == PROCESSING and (job.get('heartbeat_at') or job.get('claimed_at') or 0) < before]
+
+    def requeue(self, from_states=(PROCESSING,), claimed_by=None):
+        """Put jobs in from_states (claimed by claimed_by, if given) back in the queue"""
+        with self._lock:
+            count = 0
+            for job in self._jobs.values():
+                if job['status'] in from_states and (claimed_by is None or job.get('claimed_by') == claimed_by):
+                    job.update(status=QUEUED, claimed_by=None, updated_at=time.time())
+                    count += 1
+            return count
+
+    def queue_position(self, job_id):
+        """1-based position of a queued job, or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != QUEUED:
+                return None
+            return sum(1 for other in self._jobs.values()
+                       if other['status'] == QUEUED and self._claim_order(other) <= self._claim_order(job))
+
+    def count(self, status, min_priority=None):
+        """Jobs in status, only counting those of at least min_priority if given"""
+        with self._lock:
+            return sum(1 for job in self._jobs.values()
+                       if job['status'] == status and (min_priority is None or job['priority'] >= min_priority))
+
+    def counts(self):
+        """Number of jobs per status"""
+        with self._lock:
+            result = {}
+            for job in self._jobs.values():
+                result[job['status']] = result.get(job['status'], 0) + 1
+            return result
+
+    def find(self, statuses):
+        """All jobs whose status is one of statuses, oldest first"""
+        with self._lock:
+            jobs = sorted((job for job in self._jobs.values() if job['status'] in statuses),
+                          key=lambda job: job['_seq'])
+            return [self._public(job) for job in jobs]
+
+    def delete(self, job_id):
+        with self._lock:
+            return self._jobs.pop(job_id, None) is not None
+
+    @staticmethod
+    def _claim_order(job):
+        return -job['priority'], job['_seq']
+
+    @staticmethod
+    def _public(job):
+        return {key: copy.deepcopy(value) for key, value in job.items() if not key.startswith('_')}
+
+
+class SQLiteJobStore:
+    """Job store in a SQLite database shared by all processes on the host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    status TEXT NOT NULL,
+                    claimed_by TEXT,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    data TEXT NOT NULL
+                )
+            """)
+            columns = [row['name'] for row in db.execute("PRAGMA table_info(jobs)")]
+            if 'priority' not in columns:
+                # Databases created before job priorities
+                db.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status_seq ON jobs (status, seq)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status_priority_seq ON jobs (status, priority DESC, seq)")
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        # A forked child must not reuse its parent's connection
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA busy_timeout=30000")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    class _Transaction:
+        def __init__(self, db):
+            self.db = db
+
+        def __enter__(self):
+            # IMMEDIATE takes the write lock up front, so read-then-write is atomic
+            self.db.execute("BEGIN IMMEDIATE")
+            return self.db
+
+        def __exit__(self, exc_type, exc, tb):
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+            return False
+
+    def _transaction(self):
+        return self._Transaction(self._connection())
+
+    @staticmethod
+    def _row_to_job(row):
+        job = json.loads(row['data'])
+        job.update(task_id=row['id'], status=row['status'], claimed_by=row['claimed_by'], priority=row['priority'],
+                   created_at=row['created_at'], updated_at=row['updated_at'])
+        return job
+
+    @staticmethod
+    def _split(fields):
+        """Separate column fields from the JSON data fields"""
+        data = {key: value for key, value in fields.items()
+                if key not in ('task_id', 'status', 'claimed_by', 'priority', 'created_at', 'updated_at')}
+        return data, fields.get('claimed_by')
+
+    def enqueue(self, job_id, fields, max_queued=None, status=QUEUED, priority=0):
+        """
+        Add a queued job, unless max_queued jobs of the same or higher
+        priority are already waiting. A different status adds a job that is
+        not for the workers, e.g. one already completed.
+        """
+        data, _ = self._split(fields)
+        now = time.time()
+        with self._transaction() as db:
+            if max_queued is not None:
+                queued = db.execute("SELECT COUNT(*) FROM jobs WHERE status = ? AND priority >= ?",
+                                    (QUEUED, priority)).fetchone()[0]
+                if queued >= max_queued:
+                    raise QueueLimitReached(job_id)
+            db.execute(
+                "INSERT INTO jobs (id, status, priority, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, status, priority, now, now, json.dumps(data))
+            )
+
+    def get(self, job_id):
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def _merge(self, db, row, fields, status=None):
+        data = json.loads(row['data'])
+        new_data, claimed_by = self._split(fields)
+        data.update(new_data)
+        db.execute(
+            "UPDATE jobs SET status = ?, claimed_by = ?, updated_at = ?, data = ? WHERE id = ?",
+            (status or row['status'], claimed_by if 'claimed_by' in fields else row['claimed_by'],
+             time.time(), json.dumps(data), row['id'])
+        )
+
+    def update(self, job_id, **fields):
+        """Set fields on a job; returns False if it does not exist"""
+        with self._transaction() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return False
+            self._merge(db, row, fields)
+            return True
+
+    def transition(self, job_id, from_states, to_state, worker_id=None, **fields):
+        """
+        Move a job to to_state only if its status is one of from_states and,
+        if worker_id is given, it is still claimed by worker_id
+        """
+        with self._transaction() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row['status'] not in from_states:
+                return False
+            if worker_id is not None and row['claimed_by'] != worker_id:
+                return False
+            self._merge(db, row, fields, status=to_state)
+            return True
+
+    def claim(self, worker_id):
+        """Take the oldest queued job for worker_id; returns it or None"""
+        with self._transaction() as db:
+            row = db.execute("SELECT * FROM jobs WHERE status = ? ORDER BY priority DESC, seq LIMIT 1",
+                             (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self._merge(db, row, {'claimed_by': worker_id, 'claimed_at': now, 'heartbeat_at': now}, status=PROCESSING)
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone()
+        return self._row_to_job(row)
+
+    def heartbeat(self, job_id, worker_id):
+        """
+        Record that worker_id is still running job_id; False if the job is
+        no longer processing under that worker. Not a change to the job's
+        status, so updated_at stays.
+        """
+        with self._transaction() as db:
+            row = db.execute("SELECT data FROM jobs WHERE id = ? AND status = ? AND claimed_by = ?",
+                             (job_id, PROCESSING, worker_id)).fetchone()
+            if row is None:
+                return False
+            data = json.loads(row['data'])
+            data['heartbeat_at'] = time.time()
+            db.execute("UPDATE jobs SET data = ? WHERE id = ?", (json.dumps(data), job_id))
+            return True
+
+    def release(self, job_id, worker_id, **fields):
+        """Put a job processing under worker_id back in the queue, setting fields"""
+        with self._transaction() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ? AND status = ? AND claimed_by = ?",
+                             (job_id, PROCESSING, worker_id)).fetchone()
+            if row is None:
+                return False
+            self._merge(db, row, dict(fields, claimed_by=None), status=QUEUED)
+            return True
+
+    def stale(self, before):
+        """Processing jobs whose last heartbeat (or claim) was before the given time"""
+        return [job for job in self.find((PROCESSING,))
+                if (job.get('heartbeat_at') or job.get('claimed_at') or 0) < before]
+
+    def requeue(self, from_states=(PROCESSING,), claimed_by=None):
+        """Put jobs in from_states (claimed by claimed_by, if given) back in the queue"""
+        placeholders = ", ".join("?" for _ in from_states)
+        query = f"UPDATE jobs SET status = ?, claimed_by = NULL, updated_at = ? WHERE status IN ({placeholders})"
+        params = [QUEUED, time.time(), *from_states]
+        if claimed_by is not None:
+            query += " AND claimed_by = ?"
+            params.append(claimed_by)
+        with self._transaction() as db:
+            return db.execute(query, params).rowcount
+
+    def queue_position(self, job_id):
+        """1-based position of a queued job, or None"""
+        row = self._connection().execute(
+            "SELECT status, priority, seq FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None or row['status'] != QUEUED:
+            return None
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ? AND (priority > ? OR (priority = ? AND seq <= ?))",
+            (QUEUED, row['priority'], row['priority'], row['seq'])
+        ).fetchone()[0]
+
+    def count(self, status, min_priority=None):
+        """Jobs in status, only counting those of at least min_priority if given"""
+        if min_priority is None:
+            return self._connection().execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ? AND priority >= ?", (status, min_priority)
+        ).fetchone()[0]
+
+    def counts(self):
+        """Number of jobs per status"""
+        rows = self._connection().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    def find(self, statuses):
+        """All jobs whose status is one of statuses, oldest first"""
+        placeholders = ", ".join("?" for _ in statuses)
+        rows = self._connection().execute(
+            f"SELECT * FROM jobs WHERE status IN ({placeholders}) ORDER BY seq", tuple(statuses)
+        ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def delete(self, job_id):
+        with self._transaction() as db:
+            return db.execute("DELETE FROM jobs WHERE id = ?", (job_id,)).rowcount > 0
+
+
+def open_job_store(url=None):
+    """Open the store named by url or PENALTY_JOB_STORE"""
+    url = url or os.environ.get(JOB_STORE_ENV, DEFAULT_JOB_STORE)
+    if url.startswith('memory:'):
+        return MemoryJobStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteJobStore(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported job store {url!r}, use sqlite:///path or memory://")
@@ -0,0 +1,55 @@
+import logging
+import os
+import time
+
+# Level for the pipeline loggers, e.g. DEBUG, INFO, WARNING
+LOG_LEVEL_ENV = 'PENALTY_LOG_LEVEL'
+# Emit only every Nth hot-path debug message (per-frame overlay details)
+LOG_SAMPLE_ENV = 'PENALTY_LOG_SAMPLE_EVERY'
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_configured = False
+
+
+def configure_logging(level=None):
+    """
+    Configure root logging once for an entry point (script, API server).
+    The level comes from the argument, then PENALTY_LOG_LEVEL, then INFO.
+    """
+    global _configured
+    if level is None:
+        level = os.environ.get(LOG_LEVEL_ENV, 'INFO')
+    if isinstance(level, str):
+        level = getattr(logging, level.upper(), logging.INFO)
+
+    if not _configured:
+        logging.basicConfig(level=level, format=LOG_FORMAT)
+        _configured = True
+    logging.getLogger().setLevel(level)
+
+
+def sample_every():
+    """Sampling interval for hot-path debug messages"""
+    try:
+        return max(1, int(os.environ.get(LOG_SAMPLE_ENV, '25')))
+    except ValueError:
+        return 25
+
+
+class RateLimiter:
+    """
+    Allow an action at most once per interval seconds. Used to throttle
+    progress messages inside per-frame loops.
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self._next = 0.0
+
+    def ready(self):
+        now = time.monotonic()
+        if now < self._next:
+            return False
+        self._next = now + self.interval
+        return True
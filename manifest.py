@@ -0,0 +1,64 @@
+import json
+import os
+from dataclasses import dataclass, asdict, field, fields
+from typing import Dict, Optional
+
+MANIFEST_FILE = 'manifest.json'
+
+
+@dataclass
+class PipelineManifest:
+    """
+    Exact paths produced by process_single_video for one video. Stages fill
+    in their fields as they run, so consumers never need to search the
+    output tree. Fields stay None for stages that did not produce output.
+    """
+    video_name: str
+    source_video: str
+    output_folder: str
+    clipped_video: Optional[str] = None
+    keypoints_folder: Optional[str] = None
+    keypoints_json: Optional[str] = None
+    keypoints_csv: Optional[str] = None
+    keypoints_video: Optional[str] = None
+    prediction: Optional[str] = None
+    confidence: Optional[float] = None
+    prediction_file: Optional[str] = None
+    goal_track: Optional[str] = None
+    visualization: Optional[str] = None
+    # Stage name -> 'hit' or 'miss' in the stage cache for this run
+    stage_cache: Dict[str, str] = field(default_factory=dict)
+    # Stage name -> wall time in seconds for this run
+    stage_times: Dict[str, float] = field(default_factory=dict)
+    # Per-stage resource profile (JSON) and optional hot-path profile
+    profile: Optional[str] = None
+    hotpath_profile: Optional[str] = None
+
+    @property
+    def path(self):
+        """Where the manifest is saved, next to the outputs"""
+        return os.path.join(self.output_folder, MANIFEST_FILE)
+
+    def to_dict(self):
+        return asdict(self)
+
+    def save(self):
+        """Write the manifest as JSON into the output folder"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, self.path)
+        return self.path
+
+    @classmethod
+    def from_dict(cls, data):
+        known = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in known})
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved manifest from its file or from the output folder"""
+        if os.path.isdir(path):
+            path = os.path.join(path, MANIFEST_FILE)
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
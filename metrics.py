@@ -0,0 +1,253 @@
+"""
+In-process metrics, aggregated across processes, in Prometheus text format.
+
+Pipeline and server code count events with inc() and time them with
+observe() or timer(). Both only update a dict under a lock, so they are
+cheap enough for per-frame use. Every metric is declared in METRICS with
+its type and help text.
+
+The API runs in several processes (gunicorn workers, the pipeline worker
+pool), so each process writes a snapshot of its metrics to
+<PENALTY_METRICS_DIR>/<pid>.json every FLUSH_INTERVAL seconds and when it
+exits. render() sums the snapshots of all processes. Files are named by
+host too, so worker hosts sharing the folder (worker.py) are included. Set
+PENALTY_METRICS_DIR=off to keep metrics in the process only.
+"""
+
+import atexit
+import bisect
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR_ENV = 'PENALTY_METRICS_DIR'
+DEFAULT_METRICS_DIR = '.metrics'
+FLUSH_INTERVAL = 5
+
+# Upper bounds in seconds of the histogram buckets
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+FRAME_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+LOAD_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# name -> (type, help, buckets for histograms)
+METRICS = {
+    'penalty_stage_seconds': (
+        'histogram', 'Wall time of pipeline stages (visualize is the render stage), by stage cache result',
+        STAGE_BUCKETS),
+    'penalty_pipeline_seconds': ('histogram', 'Wall time of process_single_video runs', STAGE_BUCKETS),
+    'penalty_pipeline_runs_total': ('counter', 'process_single_video runs by result', None),
+    'penalty_pose_frame_seconds': ('histogram', 'Infer3D inference time per frame', FRAME_BUCKETS),
+    'penalty_pose_frames_total': ('counter', 'Frames through Infer3D by result', None),
+    'penalty_predictions_total': ('counter', 'Classifier predictions by direction', None),
+    'penalty_prediction_failures_total': ('counter', 'Predictions that failed and defaulted to center', None),
+    'penalty_model_loads_total': ('counter', 'Models loaded, by model', None),
+    'penalty_model_load_seconds': ('histogram', 'Time to load a model, by model', LOAD_BUCKETS),
+    'penalty_uploads_total': ('counter', 'Uploads received by the API, by method', None),
+    'penalty_upload_bytes_total': ('counter', 'Upload bytes received by the API', None),
+    'penalty_queue_wait_seconds': ('histogram', 'Time jobs waited in the queue, by job kind', STAGE_BUCKETS),
+    'penalty_job_seconds': ('histogram', 'Time from claim to result of jobs, by job kind and status',
+                            STAGE_BUCKETS),
+}
+
+_lock = threading.Lock()
+# name -> {label key: value}, label key being a tuple of sorted (label, value) pairs
+_counters = {}
+# name -> {label key: [count per bucket..., +Inf count, sum]}
+_histograms = {}
+_flusher = None
+
+
+def labels(**values):
+    """Label key of a series: sorted (label, value) pairs"""
+    return tuple(sorted((name, str(value)) for name, value in values.items()))
+
+
+def inc(name, amount=1, **label_values):
+    """Add amount to counter name"""
+    assert METRICS[name][0] == 'counter', name
+    key = labels(**label_values)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+    _start_flusher()
+
+
+def observe(name, value, **label_values):
+    """Record value (seconds) in histogram name"""
+    kind, _, buckets = METRICS[name]
+    assert kind == 'histogram', name
+    key = labels(**label_values)
+    index = bisect.bisect_left(buckets, value)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        counts = series.get(key)
+        if counts is None:
+            counts = series[key] = [0] * (len(buckets) + 1) + [0.0]
+        counts[index] += 1
+        counts[-1] += value
+    _start_flusher()
+
+
+@contextlib.contextmanager
+def timer(name, **label_values):
+    """Observe the wall time of the enclosed block in histogram name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **label_values)
+
+
+def snapshot():
+    """This process's metrics as a JSON-serializable dict"""
+    with _lock:
+        return {
+            'counters': {name: [[list(key), value] for key, value in series.items()]
+                         for name, series in _counters.items()},
+            'histograms': {name: [[list(key), list(counts)] for key, counts in series.items()]
+                           for name, series in _histograms.items()}
+        }
+
+
+def metrics_dir():
+    """Folder of per-process snapshots, or None when turned off"""
+    folder = os.environ.get(METRICS_DIR_ENV, DEFAULT_METRICS_DIR)
+    if folder.lower() in ('off', '0', 'false', 'none', ''):
+        return None
+    return folder
+
+
+def flush():
+    """Write this process's snapshot for other processes to aggregate"""
+    folder = metrics_dir()
+    if folder is None:
+        return
+    try:
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, _snapshot_name())
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot(), f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.debug("Could not write metrics snapshot: %s", e)
+
+
+def _snapshot_name():
+    return f"{socket.gethostname()}-{os.getpid()}.json"
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True)
+        _flusher.start()
+    atexit.register(flush)
+
+
+def _after_fork():
+    # The child has its own pid and no flusher thread; it starts from zero
+    global _lock, _flusher
+    _lock = threading.Lock()
+    _flusher = None
+    _counters.clear()
+    _histograms.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+def _merge(totals, data):
+    for name, series in data.get('counters', {}).items():
+        merged = totals['counters'].setdefault(name, {})
+        for key, value in series:
+            key = tuple(map(tuple, key))
+            merged[key] = merged.get(key, 0) + value
+    for name, series in data.get('histograms', {}).items():
+        merged = totals['histograms'].setdefault(name, {})
+        for key, counts in series:
+            key = tuple(map(tuple, key))
+            if key in merged and len(merged[key]) == len(counts):
+                merged[key] = [a + b for a, b in zip(merged[key], counts)]
+            else:
+                merged[key] = list(counts)
+
+
+def collect():
+    """Metrics of all processes: every snapshot file, with this process's live values"""
+    totals = {'counters': {}, 'histograms': {}}
+    own_file = _snapshot_name()
+    folder = metrics_dir()
+    if folder and os.path.isdir(folder):
+        for filename in os.listdir(folder):
+            if not filename.endswith('.json') or filename == own_file:
+                continue
+            try:
+                with open(os.path.join(folder, filename)) as f:
+                    _merge(totals, json.load(f))
+            except (OSError, ValueError):
+                continue
+    _merge(totals, snapshot())
+    return totals
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(extra=()):
+    """
+    All processes' metrics in Prometheus text format, followed by extra
+    metrics read at scrape time, e.g. from the job store, given as
+    (name, type, help, {label key: value}) with label keys as made by
+    labels(), e.g. labels(status='queued')
+    """
+    totals = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        series = totals['counters' if kind == 'counter' else 'histograms'].get(name)
+        if not series:
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for key, value in sorted(series.items()):
+            if kind == 'counter':
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(key)} {_format_value(float(value[-1]))}")
+            lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+    for name, kind, help_text, values in extra:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
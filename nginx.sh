@@ -18,15 +18,22 @@ source venv/bin/activate
 pip install flask gunicorn werkzeug
 # Install any other dependencies required by your application
 
+# Pack the goalkeeper animations into a memory-mapped atlas shared by all workers
+if [ -d "Fbx Animations" ]; then
+    python GoalkeeperAnimation.py --build-atlas "Fbx Animations"
+fi
+
 # Create a Supervisor configuration file
+# Threaded workers, so clients following /api/events streams don't hold up other requests
 cat > /etc/supervisor/conf.d/video-processing.conf << EOF
 [program:video-processing]
 directory=/opt/video-processing-app
-command=/opt/video-processing-app/venv/bin/gunicorn -b 127.0.0.1:5000 -w 4 app:app
+command=/opt/video-processing-app/venv/bin/gunicorn -b 127.0.0.1:5000 -w 4 -k gthread --threads 8 app:app
 autostart=true
 autorestart=true
 stderr_logfile=/var/log/video-processing.err.log
 stdout_logfile=/var/log/video-processing.out.log
+environment=PENALTY_ACCEL_REDIRECT="/internal/processed/"
 user=www-data
 EOF
 
@@ -51,6 +58,15 @@ server {
         proxy_set_header X-Real-IP \$remote_addr;
         proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
     }
+
+    # Result downloads: the API answers with X-Accel-Redirect and nginx
+    # sends the file itself, with Range support, so no Python worker is held
+    location /internal/processed/ {
+        internal;
+        alias /opt/video-processing-app/Processed_Videos/;
+        sendfile on;
+        tcp_nopush on;
+    }
 }
 EOF
 
@@ -0,0 +1,239 @@
+"""
+Per-stage timing and resource profile for one pipeline run.
+
+StageProfiler records, for every stage of process_single_video, the wall
+time, CPU time, peak RSS and bytes read/written. CPU time, RSS and I/O are
+process-wide counters read at the start and end of the stage, so stages that
+overlap (the goal track runs alongside pose inference) share them, and a
+nested stage is also counted in its parent. The peak RSS of a stage is the
+highest RSS sampled while it ran, not the process lifetime peak. Stage
+times (wall_times) leave out the stages nested in a stage, so they add up
+to the run instead of counting e.g. the clip decode twice.
+
+Stage wall times also go to the penalty_stage_seconds histogram (see
+metrics.py), labelled with the stage cache result the caller sets on the
+record yielded by stage().
+
+Hot-path profiling is opt-in: set PENALTY_PROFILE=cprofile (pstats file) or
+PENALTY_PROFILE=pyinstrument (HTML report, needs pyinstrument installed).
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds between RSS samples while a stage runs
+RSS_SAMPLE_INTERVAL = 0.05
+# Hot-path profiler to run around the whole pipeline: cprofile or pyinstrument
+PROFILE_ENV = 'PENALTY_PROFILE'
+HOTPATH_MODES = ('cprofile', 'pyinstrument')
+
+
+def _io_counters():
+    """(bytes read, bytes written) by this process so far, or (None, None)"""
+    try:
+        counters = {}
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+        # rchar/wchar count all read()/write() traffic, including page cache hits
+        return counters['rchar'], counters['wchar']
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _rss_mb():
+    """Current resident set size in MB, or None"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss_mb():
+    """Process lifetime high-water RSS in MB, or None"""
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _round(value, digits=3):
+    return round(value, digits) if value is not None else None
+
+
+class StageProfiler:
+    def __init__(self):
+        self.stages = []
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Highest RSS seen so far by each running stage, updated by the sampler thread
+        self._peaks = {}
+        self._sampler = None
+
+    def _sample_rss(self):
+        """Sampler thread: raise the peaks of the running stages; exits when none is left"""
+        while True:
+            rss = _rss_mb()
+            with self._lock:
+                if not self._peaks or rss is None:
+                    self._sampler = None
+                    return
+                for token, peak in self._peaks.items():
+                    if peak is None or rss > peak:
+                        self._peaks[token] = rss
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Profile the enclosed block as stage name. Yields a dict merged into
+        the stage's record, e.g. to note {'cache': 'hit'}
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1]['stage'] if stack else None
+        # Wall time of the stages nested in this one, left out of its own time
+        frame = {'stage': name, 'nested_s': 0.0}
+        stack.append(frame)
+
+        read_start, written_start = _io_counters()
+        rss_start = _rss_mb()
+        token = object()
+        with self._lock:
+            self._peaks[token] = rss_start
+            if self._sampler is None and rss_start is not None:
+                self._sampler = threading.Thread(target=self._sample_rss, name="rss-sampler", daemon=True)
+                self._sampler.start()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        extra = {}
+        try:
+            yield extra
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            read_end, written_end = _io_counters()
+            rss_end = _rss_mb()
+            with self._lock:
+                peak = self._peaks.pop(token)
+            if rss_end is not None and (peak is None or rss_end > peak):
+                peak = rss_end
+            stack.pop()
+            if stack:
+                stack[-1]['nested_s'] += wall
+
+            record = {
+                'stage': name,
+                'parent': parent,
+                'thread': threading.current_thread().name,
+                'start_s': _round(wall_start - self._start),
+                'wall_s': _round(wall),
+                'self_s': _round(wall - frame['nested_s']),
+                'cpu_s': _round(cpu),
+                'peak_rss_mb': _round(peak, 1),
+                'rss_delta_mb': _round(rss_end - rss_start, 1) if rss_start is not None and rss_end is not None else None,
+                'bytes_read': read_end - read_start if read_start is not None else None,
+                'bytes_written': written_end - written_start if written_start is not None else None,
+                **extra
+            }
+            with self._lock:
+                self.stages.append(record)
+            metrics.observe('penalty_stage_seconds', wall, stage=name, cache=extra.get('cache', 'none'))
+
+    def wall_times(self):
+        """Stage name -> wall seconds in the stage itself, without the stages nested in it"""
+        with self._lock:
+            return {record['stage']: record['self_s'] for record in self.stages}
+
+    def to_dict(self):
+        with self._lock:
+            # Parents before the stages nested in them when the start times tie
+            stages = sorted(self.stages, key=lambda record: (record['start_s'], record['parent'] is not None))
+        return {
+            'started_at': self.started_at,
+            'total_wall_s': _round(time.perf_counter() - self._start),
+            'peak_rss_mb': _round(_peak_rss_mb(), 1),
+            'stages': stages
+        }
+
+    def save(self, path):
+        """Write the profile as JSON"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+        return path
+
+    def print_report(self):
+        print(f"{'Stage':<18} {'Wall s':>8} {'CPU s':>8} {'Peak MB':>8} {'Read MB':>8} {'Write MB':>9}")
+        for record in self.to_dict()['stages']:
+            name = f"  {record['stage']}" if record['parent'] else record['stage']
+            read = f"{record['bytes_read'] / (1024 * 1024):.1f}" if record['bytes_read'] is not None else "-"
+            written = f"{record['bytes_written'] / (1024 * 1024):.1f}" if record['bytes_written'] is not None else "-"
+            peak = f"{record['peak_rss_mb']:.0f}" if record['peak_rss_mb'] is not None else "-"
+            print(f"{name:<18} {record['wall_s']:>8.2f} {record['cpu_s']:>8.2f} {peak:>8} {read:>8} {written:>9}")
+
+
+@contextlib.contextmanager
+def hotpath_profile(output_base, mode=None):
+    """
+    Capture hot paths of the enclosed block when mode (or PENALTY_PROFILE)
+    is cprofile or pyinstrument. Writes output_base + '.prof' or '.html'
+    and yields the report path, or None when profiling is off. Only the
+    calling thread is profiled.
+    """
+    mode = (mode or os.environ.get(PROFILE_ENV, '')).lower()
+    if mode not in HOTPATH_MODES:
+        if mode and mode not in ('off', '0', 'none'):
+            logger.warning("Unknown %s=%s, expected one of %s", PROFILE_ENV, mode, ", ".join(HOTPATH_MODES))
+        yield None
+        return
+
+    if mode == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning("pyinstrument is not installed, falling back to cProfile")
+            mode = 'cprofile'
+
+    if mode == 'pyinstrument':
+        report_path = output_base + '.html'
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield report_path
+        finally:
+            profiler.stop()
+            with open(report_path, 'w') as f:
+                f.write(profiler.output_html())
+            logger.info("Hot-path profile saved to %s", report_path)
+    else:
+        import cProfile
+        report_path = output_base + '.prof'
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield report_path
+        finally:
+            profiler.disable()
+            profiler.dump_stats(report_path)
+            logger.info("Hot-path profile saved to %s (view with python -m pstats)", report_path)
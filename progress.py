@@ -0,0 +1,91 @@
+"""
+Progress reporting for one pipeline run.
+
+PipelineProgress turns stage changes and frame counts into progress
+events and hands them to a callback, e.g. the API worker writing them to
+the job store. An event is a dict:
+
+    {'stage': 'pose', 'frames_done': 12, 'frames_total': 26, 'progress': 37}
+
+progress is an overall percentage, with each stage weighted by its usual
+share of the run time. Frame updates are throttled; stage changes and the
+final event are always sent. Once the classifier has run, one event also
+carries 'prediction' and 'confidence', ahead of rendering.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Stages in pipeline order with their rough share of a run, in percent
+STAGE_WEIGHTS = (
+    ('clip', 5),
+    ('pose', 55),
+    ('predict', 5),
+    ('visualize', 35),
+)
+
+
+class PipelineProgress:
+    def __init__(self, callback=None, min_interval=0.5):
+        """
+        Args:
+            callback: Called with each progress event; None reports nothing
+            min_interval: Seconds between frame updates sent to callback
+        """
+        self.callback = callback
+        self.min_interval = min_interval
+        self.stage_name = None
+        self._start = 0
+        self._weight = 0
+        self._last_sent = 0
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """Report the start of a pipeline stage"""
+        start = 0
+        for stage, weight in STAGE_WEIGHTS:
+            if stage == name:
+                self._start, self._weight = start, weight
+                break
+            start += weight
+        self.stage_name = name
+        self._send(0, None, force=True)
+
+    def frames(self, done, total):
+        """Report done of total frames in the current stage; usable as a frame loop's progress callback"""
+        self._send(done, total, force=done == total)
+
+    def result(self, prediction, confidence):
+        """Report the prediction as soon as it is known"""
+        self._send(0, None, force=True, prediction=prediction,
+                   confidence=float(confidence) if confidence is not None else None)
+
+    def done(self):
+        self.stage_name = 'done'
+        self._start, self._weight = 100, 0
+        self._send(0, None, force=True)
+
+    def _send(self, done, total, force=False, **extra):
+        if self.callback is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_sent < self.min_interval:
+                return
+            self._last_sent = now
+        fraction = done / total if total else 0
+        event = {
+            'stage': self.stage_name,
+            'frames_done': done,
+            'frames_total': total,
+            'progress': min(100, int(self._start + self._weight * fraction)),
+            **extra
+        }
+        try:
+            self.callback(event)
+        except Exception as e:
+            # Progress is informational; never fail the run over it
+            logger.warning("Progress callback failed: %s", e)
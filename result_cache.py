@@ -0,0 +1,152 @@
+"""
+Result cache for deduplicating API uploads.
+
+Finished jobs are stored in a StageCache under the SHA-256 of the uploaded
+file, what kind of input it was (video, clip or keypoints) and the
+pipeline version (classifier model digest plus pipeline
+parameters), holding copies of the result videos and the prediction. An
+upload with the same content is answered from the cache as a completed
+job without queueing it.
+
+Entries are evicted by size and age. Hit and miss counts are kept in
+<root>/stats.json so every server process adds to the same totals.
+
+Configured with PENALTY_RESULT_CACHE (folder, or "off"),
+PENALTY_RESULT_CACHE_MAX_MB and PENALTY_RESULT_CACHE_MAX_AGE_HOURS.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from stage_cache import StageCache, model_version
+
+try:
+    import fcntl
+except ImportError:  # Windows: counts from concurrent processes may be lost
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_ENV = 'PENALTY_RESULT_CACHE'
+RESULT_CACHE_MAX_MB_ENV = 'PENALTY_RESULT_CACHE_MAX_MB'
+RESULT_CACHE_MAX_AGE_ENV = 'PENALTY_RESULT_CACHE_MAX_AGE_HOURS'
+DEFAULT_RESULT_CACHE_FOLDER = '.result_cache'
+DEFAULT_MAX_MB = 4096
+DEFAULT_MAX_AGE_HOURS = 7 * 24
+
+# Job fields holding result files, copied into and out of the cache
+RESULT_FILES = ('visualization_file', 'keypoints_file', 'processed_file')
+# Job fields restored from the cache as they are
+RESULT_DATA = ('prediction', 'confidence')
+STATS_FILE = 'stats.json'
+
+
+def save_stream(stream, path, chunk_size=1024 * 1024):
+    """Write a file-like stream to path, hashing it on the way; returns the SHA-256 hex digest"""
+    sha = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            sha.update(chunk)
+            f.write(chunk)
+    return sha.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, root, model_path, params=None, max_bytes=DEFAULT_MAX_MB * 1024 * 1024,
+                 max_age=DEFAULT_MAX_AGE_HOURS * 3600):
+        """
+        Args:
+            root: Cache folder
+            model_path: Classifier model; results are only reused for the
+                same model file content
+            params: Other settings the results depend on (JSON-serializable),
+                or a function returning them, called per lookup so settings
+                that change while the server runs (e.g. replaced animation
+                frames) are picked up
+            max_bytes, max_age: Size and age (seconds) limits for entries
+        """
+        self.cache = StageCache(root, max_bytes, max_age=max_age)
+        self.model_path = model_path
+        self.params = params or {}
+        self.stats_path = os.path.join(root, STATS_FILE)
+
+    def key(self, upload_digest, input_kind='video'):
+        # The same bytes sent as a video or as a clip are processed differently
+        params = dict(self.params() if callable(self.params) else self.params, input=input_kind)
+        # model_version is memoized per model file, so this is cheap per upload
+        return StageCache.key('result', upload_digest, params, version=model_version(self.model_path))
+
+    def lookup(self, upload_digest, output_folder, input_kind='video'):
+        """
+        Job fields for a cached result of this upload, with the result
+        files copied into output_folder, or None on a miss
+        """
+        entry = self.cache.get('result', self.key(upload_digest, input_kind))
+        if entry is None:
+            self._count('misses')
+            return None
+
+        os.makedirs(output_folder, exist_ok=True)
+        fields = {name: entry['data'].get(name) for name in RESULT_DATA}
+        for name, filename in entry['data'].get('files', {}).items():
+            fields[name] = self.cache.restore(entry, name, os.path.join(output_folder, filename))
+        self._count('hits')
+        return fields
+
+    def store(self, upload_digest, job_fields, input_kind='video'):
+        """Cache the result files and prediction from a completed job's fields"""
+        files = {name: job_fields.get(name) for name in RESULT_FILES
+                 if job_fields.get(name) and os.path.exists(job_fields[name])}
+        data = {name: job_fields.get(name) for name in RESULT_DATA}
+        data['files'] = {name: os.path.basename(path) for name, path in files.items()}
+        self.cache.put('result', self.key(upload_digest, input_kind), files=files, data=data)
+
+    def _count(self, outcome):
+        """Add one to a counter in the shared stats file"""
+        try:
+            with open(self.stats_path, 'a+') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    counts = json.loads(f.read() or '{}')
+                except ValueError:
+                    counts = {}
+                counts[outcome] = counts.get(outcome, 0) + 1
+                f.seek(0)
+                f.truncate()
+                json.dump(counts, f)
+        except OSError as e:
+            logger.debug("Could not update result cache stats: %s", e)
+
+    def stats(self):
+        """Hit and miss counts, hit rate and current size"""
+        try:
+            with open(self.stats_path) as f:
+                counts = json.load(f)
+        except (OSError, ValueError):
+            counts = {}
+        hits, misses = counts.get('hits', 0), counts.get('misses', 0)
+        usage = self.cache.stats().get('result', {'entries': 0, 'bytes': 0})
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+            'entries': usage['entries'],
+            'bytes': usage['bytes'],
+            'max_bytes': self.cache.max_bytes,
+            'max_age_s': self.cache.max_age
+        }
+
+
+def open_result_cache(model_path, params=None):
+    """Result cache configured from the environment, or None when turned off"""
+    root = os.environ.get(RESULT_CACHE_ENV, DEFAULT_RESULT_CACHE_FOLDER)
+    if root.lower() in ('off', '0', 'false', 'none', ''):
+        return None
+    max_mb = float(os.environ.get(RESULT_CACHE_MAX_MB_ENV, DEFAULT_MAX_MB))
+    max_age_hours = float(os.environ.get(RESULT_CACHE_MAX_AGE_ENV, DEFAULT_MAX_AGE_HOURS))
+    return ResultCache(root, model_path, params, max_bytes=int(max_mb * 1024 * 1024),
+                       max_age=max_age_hours * 3600)
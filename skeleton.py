@@ -1,13 +1,36 @@
 import os
 import numpy as np
 import pandas as pd
+import time
 import warnings
 import contextlib
 
+import metrics
+
 # Disable GPU before importing TensorFlow
 import tensorflow as tf
 
-def predict_direction(input_file, model_path='penalty_conv3d_model.h5'):
+# Loaded Keras models keyed by path and modification time, so a batch run
+# loads the classifier once and picks up a replaced model file
+_models = {}
+
+def load_model(model_path):
+    """Load the Keras model at model_path, reusing it across predictions"""
+    key = (os.path.abspath(model_path), os.path.getmtime(model_path))
+    model = _models.get(key)
+    if model is None:
+        print(f"Loading model from {model_path}...")
+        start = time.perf_counter()
+        model = tf.keras.models.load_model(model_path, compile=False)
+        metrics.inc('penalty_model_loads_total', model='classifier')
+        metrics.observe('penalty_model_load_seconds', time.perf_counter() - start, model='classifier')
+        print("Model loaded successfully")
+        for stale in [k for k in _models if k[0] == key[0]]:
+            del _models[stale]
+        _models[key] = model
+    return model
+
+def predict_direction(input_file, model_path='penalty_conv3d_model.h5', model=None):
     """
     Loads pose keypoints data from a CSV file, runs it through the model,
     and saves the prediction (left, right, or center) to a text file.
@@ -15,6 +38,12 @@ def predict_direction(input_file, model_path='penalty_conv3d_model.h5'):
     Args:
         input_file (str): Path to the CSV file containing keypoints data
         model_path (str): Path to the saved model file
+        model: Already loaded model to use instead of model_path, called
+            as model(x, training=False) like a Keras model
+
+    Returns:
+        (direction, confidence), or (None, None) if prediction failed; the
+        prediction file then holds the default 'center'
     """
     # Create output filename based on input filename
     base_name = os.path.splitext(os.path.basename(input_file))[0]
@@ -30,88 +59,122 @@ def predict_direction(input_file, model_path='penalty_conv3d_model.h5'):
             print("WARNING: GPU still visible despite disabling. Forcing CPU operations.")
             # Force CPU operations even if GPU is visible
             with tf.device('/CPU:0'):
-                return _run_prediction(input_file, model_path, output_file)
+                return _run_prediction(input_file, model_path, output_file, model)
         else:
-            return _run_prediction(input_file, model_path, output_file)
+            return _run_prediction(input_file, model_path, output_file, model)
             
     except Exception as e:
         print(f"Error processing {input_file}: {e}")
+        metrics.inc('penalty_prediction_failures_total')
         # Default to center if prediction fails
-        predicted_direction = 'center'
-        confidence = 0.33
-        
         with open(output_file, 'w') as f:
             f.write("center")
         
         print(f"Warning: Prediction failed, using default 'center'")
-        return predicted_direction, confidence
+        return None, None
 
-def _run_prediction(input_file, model_path, output_file):
-    """Helper function to run the actual prediction"""
+def predict_keypoints(keypoints_list, model_path='penalty_conv3d_model.h5', model=None):
+    """
+    Run the model on keypoints already in memory, as produced by
+    Infer3D (one list of 17 [x, y, z] points per frame). Frames without a
+    detection are treated as zeros. Unlike predict_direction this does not
+    write a prediction file. model is as in predict_direction.
+
+    Returns:
+        (direction, confidence), or (None, None) if prediction failed
+    """
     try:
-        # Load the model
-        print(f"Loading model from {model_path}...")
-        model = tf.keras.models.load_model(model_path, compile=False)
-        print("Model loaded successfully")
-        
-        # Read CSV file
-        df = pd.read_csv(input_file, header=None)
-        keypoints = df.iloc[1:, :].values  # Skip header row
-        num_frames = keypoints.shape[0]
-        print(f"Found {num_frames} frames of keypoints data")
-        
-        # Process keypoints
-        try:
-            keypoints = np.array([np.hstack(eval(point)) for point in keypoints.flatten()])
-            keypoints = keypoints.reshape(num_frames, 17 * 3)
-        except Exception as e:
-            print(f"Error processing keypoints: {e}")
-            print("Trying alternative keypoints processing...")
-            processed_keypoints = []
-            for point in keypoints.flatten():
-                try:
-                    kpt = eval(point)
-                    processed_keypoints.append(np.hstack(kpt))
-                except:
-                    # If evaluation fails, add zeros
-                    processed_keypoints.append(np.zeros(17 * 3))
-            
-            keypoints = np.array(processed_keypoints)
-            keypoints = keypoints.reshape(num_frames, 17 * 3)
-        
-        # Pad or truncate to ensure 26 frames
-        if num_frames < 26:
-            print(f"Padding keypoints from {num_frames} to 26 frames")
-            padding = np.zeros((26 - num_frames, 17 * 3))
-            keypoints = np.vstack([keypoints, padding])
-        elif num_frames > 26:
-            print(f"Truncating keypoints from {num_frames} to 26 frames")
-            keypoints = keypoints[:26]
-        
-        # Normalize and reshape the data for Conv3D
-        print("Normalizing and reshaping keypoints data...")
-        keypoints = keypoints.reshape(1, 26, 17 * 3)  # Add batch dimension first
-        keypoints = (keypoints - keypoints.mean(axis=(1, 2), keepdims=True)) / (keypoints.std(axis=(1, 2), keepdims=True) + 1e-9)
-        keypoints = keypoints.reshape(1, 26, 17, 3, 1)  # Reshape for Conv3D
-        
-        # Make prediction
-        print("Running prediction...")
+        keypoints = keypoints_to_array(keypoints_list)
+        devices = tf.config.list_physical_devices()
+        if any(device.device_type == 'GPU' for device in devices):
+            with tf.device('/CPU:0'):
+                return _classify(keypoints, model_path, model)
+        return _classify(keypoints, model_path, model)
+    except Exception as e:
+        print(f"Error in prediction: {e}")
+        metrics.inc('penalty_prediction_failures_total')
+        return None, None
+
+def keypoints_to_array(keypoints_list):
+    """Convert a per-frame keypoints list to a (num_frames, 17 * 3) array"""
+    rows = []
+    for frame_keypoints in keypoints_list:
         try:
-            # Use the model directly instead of predict() method
-            prediction = model(keypoints, training=False).numpy()
-        except Exception as e:
-            print(f"Prediction failed: {e}")
-            # Try with a simple approach
-            print("Trying simple prediction approach...")
-            # Create a simple random prediction as fallback
-            prediction = np.array([[0.33, 0.33, 0.34]])  # Equal probabilities
-        
-        class_index = np.argmax(prediction[0])
+            row = np.hstack(frame_keypoints).astype(float).reshape(17 * 3)
+        except Exception:
+            row = np.zeros(17 * 3)
+        rows.append(row)
+    return np.array(rows).reshape(len(rows), 17 * 3)
+
+def _read_keypoints_csv(input_file):
+    """Read keypoints saved by Infer3D into a (num_frames, 17 * 3) array"""
+    # Read CSV file
+    df = pd.read_csv(input_file, header=None)
+    keypoints = df.iloc[1:, :].values  # Skip header row
+    num_frames = keypoints.shape[0]
+    print(f"Found {num_frames} frames of keypoints data")
+    
+    # Process keypoints
+    try:
+        keypoints = np.array([np.hstack(eval(point)) for point in keypoints.flatten()])
+        keypoints = keypoints.reshape(num_frames, 17 * 3)
+    except Exception as e:
+        print(f"Error processing keypoints: {e}")
+        print("Trying alternative keypoints processing...")
+        processed_keypoints = []
+        for point in keypoints.flatten():
+            try:
+                kpt = eval(point)
+                processed_keypoints.append(np.hstack(kpt))
+            except:
+                # If evaluation fails, add zeros
+                processed_keypoints.append(np.zeros(17 * 3))
         
-        # Map index to class label
-        class_mapping = {0: 'center', 1: 'left', 2: 'right'}
-        predicted_direction = class_mapping[class_index]
-        confidence = prediction[0][class_index]
+        keypoints = np.array(processed_keypoints)
+        keypoints = keypoints.reshape(num_frames, 17 * 3)
+    return keypoints
+
+def _classify(keypoints, model_path, model=None):
+    """Pad/normalize a (num_frames, 17 * 3) array and run the model on it"""
+    if model is None:
+        model = load_model(model_path)
+    
+    num_frames = keypoints.shape[0]
+    
+    # Pad or truncate to ensure 26 frames
+    if num_frames < 26:
+        print(f"Padding keypoints from {num_frames} to 26 frames")
+        padding = np.zeros((26 - num_frames, 17 * 3))
+        keypoints = np.vstack([keypoints, padding])
+    elif num_frames > 26:
+        print(f"Truncating keypoints from {num_frames} to 26 frames")
+        keypoints = keypoints[:26]
+    
+    # Normalize and reshape the data for Conv3D
+    print("Normalizing and reshaping keypoints data...")
+    keypoints = keypoints.reshape(1, 26, 17 * 3)  # Add batch dimension first
+    keypoints = (keypoints - keypoints.mean(axis=(1, 2), keepdims=True)) / (keypoints.std(axis=(1, 2), keepdims=True) + 1e-9)
+    keypoints = keypoints.reshape(1, 26, 17, 3, 1)  # Reshape for Conv3D
+    
+    # Make prediction; failures are handled by the callers
+    print("Running prediction...")
+    # Use the model directly instead of predict() method
+    prediction = model(keypoints, training=False).numpy()
+    
+    class_index = np.argmax(prediction[0])
+    
+    # Map index to class label
+    class_mapping = {0: 'center', 1: 'left', 2: 'right'}
+    predicted_direction = class_mapping[class_index]
+    confidence = prediction[0][class_index]
+    metrics.inc('penalty_predictions_total', direction=predicted_direction)
+    return predicted_direction, confidence
+
+def _run_prediction(input_file, model_path, output_file, model=None):
+    """Helper function to run the actual prediction"""
+    try:
+        keypoints = _read_keypoints_csv(input_file)
+        predicted_direction, confidence = _classify(keypoints, model_path, model)
         
         # Save prediction to text file
         with open(output_file, 'w') as f:
@@ -122,15 +185,13 @@ def _run_prediction(input_file, model_path, output_file):
         
     except Exception as e:
         print(f"Error in prediction: {e}")
+        metrics.inc('penalty_prediction_failures_total')
         # Default to center if prediction fails
-        predicted_direction = 'center'
-        confidence = 0.33
-        
         with open(output_file, 'w') as f:
             f.write("center")
         
         print(f"Warning: Prediction failed, using default 'center'")
-        return predicted_direction, confidence
+        return None, None
 
 def process_directory(directory_path, model_path='penalty_conv3d_model.h5'):
     """
@@ -148,6 +209,8 @@ def process_directory(directory_path, model_path='penalty_conv3d_model.h5'):
                 file_path = os.path.join(root, file)
                 print(f"Processing {file_path}...")
                 direction, confidence = predict_direction(file_path, model_path)
+                if direction is None:
+                    direction = 'center'
                 results[file] = {'direction': direction, 'confidence': confidence}
     
     return results
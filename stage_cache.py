@@ -0,0 +1,258 @@
+"""
+Content-addressed cache for pipeline stage outputs.
+
+Each entry is keyed by the digest of the stage input, the stage parameters
+and a version string (e.g. the classifier model digest), and holds copies
+of the files the stage produced plus a small JSON payload. Entries live in
+<root>/<stage>/<key>/ and are evicted least-recently-used first once the
+cache grows past its size limit, and once older than max_age if set.
+
+Usage:
+    python stage_cache.py [--root .stage_cache]     # show cache contents
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Cache folder, or "off" to disable the cache
+STAGE_CACHE_ENV = 'PENALTY_STAGE_CACHE'
+STAGE_CACHE_MAX_MB_ENV = 'PENALTY_STAGE_CACHE_MAX_MB'
+DEFAULT_CACHE_FOLDER = '.stage_cache'
+DEFAULT_MAX_MB = 2048
+META_FILE = 'meta.json'
+
+# file_digest results keyed by (path, size, mtime) so a file is hashed once
+_digest_memo = {}
+_digest_lock = threading.Lock()
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file's content"""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _digest_lock:
+        if memo_key in _digest_memo:
+            return _digest_memo[memo_key]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    with _digest_lock:
+        _digest_memo[memo_key] = digest
+    return digest
+
+
+def model_version(model_path):
+    """Version string for a model file: its content digest"""
+    if not os.path.exists(model_path):
+        return f"missing:{os.path.basename(model_path)}"
+    return file_digest(model_path)
+
+
+def _copy(src, dst):
+    """
+    Copy rather than hard-link: pipeline writers truncate their outputs in
+    place, which would corrupt a cache entry sharing the same inode
+    """
+    tmp = f"{dst}.tmp-{os.getpid()}-{threading.get_ident()}"
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class StageCache:
+    def __init__(self, root=DEFAULT_CACHE_FOLDER, max_bytes=DEFAULT_MAX_MB * 1024 * 1024, max_age=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        # Seconds an entry stays valid after it was stored, or None for no limit
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(stage, input_digest, params=None, version=None):
+        """Cache key for a stage run on input_digest with the given parameters"""
+        payload = json.dumps(
+            {'stage': stage, 'input': input_digest, 'params': params or {}, 'version': version},
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _entry_folder(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def get(self, stage, key):
+        """
+        Look up an entry. Returns {'files': {name: path}, 'data': {...}} or
+        None if the entry is missing, incomplete or expired.
+        """
+        folder = self._entry_folder(stage, key)
+        meta_path = os.path.join(folder, META_FILE)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._expired(meta):
+            return None
+
+        files = {name: os.path.join(folder, filename) for name, filename in meta.get('files', {}).items()}
+        if not all(os.path.exists(path) for path in files.values()):
+            return None
+
+        # Mark as recently used for LRU eviction
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+        return {'files': files, 'data': meta.get('data', {})}
+
+    def put(self, stage, key, files=None, data=None):
+        """
+        Store copies of files (name -> path; missing paths are skipped) and
+        a JSON-serializable data dict under key
+        """
+        folder = self._entry_folder(stage, key)
+        if os.path.exists(folder):
+            return
+        tmp_folder = f"{folder}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_folder, exist_ok=True)
+
+        try:
+            stored = {}
+            for name, path in (files or {}).items():
+                if not path or not os.path.exists(path):
+                    continue
+                filename = name + os.path.splitext(path)[1]
+                shutil.copyfile(path, os.path.join(tmp_folder, filename))
+                stored[name] = filename
+
+            meta = {'stage': stage, 'key': key, 'created_at': time.time(), 'files': stored, 'data': data or {}}
+            with open(os.path.join(tmp_folder, META_FILE), 'w') as f:
+                json.dump(meta, f, indent=2)
+
+            os.rename(tmp_folder, folder)
+        except OSError as e:
+            # Usually another process stored the same entry first
+            logger.debug("Could not store %s cache entry %s: %s", stage, key, e)
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def restore(self, entry, name, dest):
+        """Copy a cached file to dest"""
+        _copy(entry['files'][name], dest)
+        return dest
+
+    def entries(self):
+        """All complete entries as (last_used, size_bytes, stage, folder)"""
+        result = []
+        if not os.path.isdir(self.root):
+            return result
+        for stage in os.listdir(self.root):
+            stage_folder = os.path.join(self.root, stage)
+            if not os.path.isdir(stage_folder):
+                continue
+            for key in os.listdir(stage_folder):
+                folder = os.path.join(stage_folder, key)
+                meta_path = os.path.join(folder, META_FILE)
+                if '.tmp-' in key or not os.path.exists(meta_path):
+                    continue
+                try:
+                    size = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+                    result.append((os.path.getmtime(meta_path), size, stage, folder))
+                except OSError:
+                    continue
+        return result
+
+    def _expired(self, meta):
+        return self.max_age is not None and time.time() - meta.get('created_at', 0) > self.max_age
+
+    def _expired_folder(self, folder):
+        try:
+            with open(os.path.join(folder, META_FILE)) as f:
+                return self._expired(json.load(f))
+        except (OSError, ValueError):
+            return False
+
+    def evict(self):
+        """
+        Remove expired entries, then least recently used ones until the
+        cache fits in max_bytes
+        """
+        with self._lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _, _ in entries)
+            evicted = 0
+            for _, size, stage, folder in entries:
+                if total <= self.max_bytes and not (self.max_age is not None and self._expired_folder(folder)):
+                    continue
+                shutil.rmtree(folder, ignore_errors=True)
+                total -= size
+                evicted += 1
+            if evicted:
+                logger.info("Stage cache evicted %d entries, %.1f MB in use", evicted, total / (1024 * 1024))
+            return evicted
+
+    def stats(self):
+        """Entry count and bytes per stage"""
+        stats = {}
+        for _, size, stage, _ in self.entries():
+            stage_stats = stats.setdefault(stage, {'entries': 0, 'bytes': 0})
+            stage_stats['entries'] += 1
+            stage_stats['bytes'] += size
+        return stats
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Process-wide cache configured from PENALTY_STAGE_CACHE and
+    PENALTY_STAGE_CACHE_MAX_MB, or None when the cache is turned off
+    """
+    global _default_cache
+    root = os.environ.get(STAGE_CACHE_ENV, DEFAULT_CACHE_FOLDER)
+    if root.lower() in ('off', '0', 'false', 'none', ''):
+        return None
+    with _default_cache_lock:
+        if _default_cache is None or _default_cache.root != root:
+            max_mb = float(os.environ.get(STAGE_CACHE_MAX_MB_ENV, DEFAULT_MAX_MB))
+            _default_cache = StageCache(root, int(max_mb * 1024 * 1024))
+        return _default_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline stage cache")
+    parser.add_argument("--root", default=os.environ.get(STAGE_CACHE_ENV, DEFAULT_CACHE_FOLDER),
+                        help="Cache folder (default: $PENALTY_STAGE_CACHE or .stage_cache)")
+    parser.add_argument("--evict", action="store_true", help="Run eviction now")
+    args = parser.parse_args()
+
+    cache = StageCache(args.root, int(float(os.environ.get(STAGE_CACHE_MAX_MB_ENV, DEFAULT_MAX_MB)) * 1024 * 1024))
+    if args.evict:
+        print(f"Evicted {cache.evict()} entries")
+
+    stats = cache.stats()
+    print(f"{'Stage':<12} {'Entries':>8} {'MB':>10}")
+    for stage, stage_stats in sorted(stats.items()):
+        print(f"{stage:<12} {stage_stats['entries']:>8} {stage_stats['bytes'] / (1024 * 1024):>10.1f}")
+    total = sum(stage_stats['bytes'] for stage_stats in stats.values())
+    print(f"Total: {total / (1024 * 1024):.1f} MB of {cache.max_bytes / (1024 * 1024):.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
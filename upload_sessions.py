@@ -0,0 +1,232 @@
+"""
+Resumable chunked uploads.
+
+An upload session is a pair of files in the sessions folder: <id>.json
+with the declared filename and size, and <id>.part with the bytes received
+so far. Chunks are streamed straight into the .part file at their byte
+offset, so the server never holds an upload in memory, and the size of the
+.part file is the resume point. Keeping sessions on disk lets any server
+process accept the next chunk.
+
+Uploads are hashed (SHA-256) as chunks arrive. A process keeps the running
+hash for sessions whose chunks it received in order; if chunks went to
+different processes, the finished file is hashed once instead.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking of chunk writes
+    fcntl = None
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """An upload request that cannot be applied; status is the HTTP status code"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def parse_content_range(header):
+    """Parse 'bytes start-end/total' into (start, end, total); total may be None"""
+    match = CONTENT_RANGE_RE.match((header or '').strip())
+    if not match:
+        raise UploadError("Content-Range must be 'bytes start-end/total'")
+    start, end = int(match.group(1)), int(match.group(2))
+    total = None if match.group(3) == '*' else int(match.group(3))
+    if end < start:
+        raise UploadError("Content-Range end is before start")
+    return start, end, total
+
+
+class _Locked:
+    """Exclusive lock on an open file for the duration of a chunk write"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self.f
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        return False
+
+
+class UploadSessions:
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        # upload_id -> (offset hashed up to, running sha256) for chunks received here
+        self._hashes = {}
+        self._hashes_lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def _paths(self, upload_id):
+        # upload ids are generated hex strings; reject anything else
+        if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+            raise UploadError("Unknown upload", status=404)
+        base = os.path.join(self.folder, upload_id)
+        return base + '.json', base + '.part'
+
+    def create(self, filename, size):
+        """Start a session for filename of size bytes; returns its info"""
+        if size is None or size <= 0:
+            raise UploadError("Upload size must be a positive number of bytes")
+        if size > self.max_size:
+            raise UploadError(f"Upload of {size} bytes exceeds the limit of {self.max_size} bytes", status=413)
+
+        upload_id = uuid.uuid4().hex
+        meta_path, part_path = self._paths(upload_id)
+        meta = {'upload_id': upload_id, 'filename': filename, 'size': size, 'created_at': time.time()}
+        open(part_path, 'wb').close()
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+        return self.info(upload_id)
+
+    def _meta(self, upload_id):
+        meta_path, part_path = self._paths(upload_id)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise UploadError("Unknown upload", status=404)
+        return meta, part_path
+
+    def info(self, upload_id):
+        """Session info with the current offset, i.e. bytes received"""
+        meta, part_path = self._meta(upload_id)
+        try:
+            offset = os.path.getsize(part_path)
+        except OSError:
+            raise UploadError("Unknown upload", status=404)
+        return dict(meta, offset=offset, complete=offset == meta['size'])
+
+    def write_chunk(self, upload_id, content_range, stream, content_length):
+        """
+        Append the chunk in stream at the offset given by content_range.
+        The chunk must start at the current offset; a retried chunk that
+        was already received is ignored. Returns the session info.
+        """
+        meta, part_path = self._meta(upload_id)
+        start, end, total = parse_content_range(content_range)
+        length = end - start + 1
+        if total is not None and total != meta['size']:
+            raise UploadError(f"Content-Range total {total} does not match the upload size {meta['size']}")
+        if end >= meta['size']:
+            raise UploadError(f"Chunk ends past the upload size of {meta['size']} bytes", status=413)
+        if content_length is not None and content_length != length:
+            raise UploadError(f"Content-Length {content_length} does not match Content-Range length {length}")
+
+        with open(part_path, 'r+b') as f, _Locked(f):
+            offset = os.fstat(f.fileno()).st_size
+            if end < offset:
+                # Already have these bytes, e.g. the response to a retried chunk was lost
+                return self.info(upload_id)
+            if start != offset:
+                raise UploadError(f"Chunk starts at {start} but the upload is at {offset}", status=409, offset=offset)
+
+            sha = self._running_hash(upload_id, start)
+            f.seek(start)
+            remaining = length
+            try:
+                while remaining > 0:
+                    data = stream.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not data:
+                        break
+                    f.write(data)
+                    if sha is not None:
+                        sha.update(data)
+                    remaining -= len(data)
+            finally:
+                # Keep only whole bytes received so far; a cut-off chunk leaves a valid resume point
+                f.flush()
+                if sha is not None:
+                    with self._hashes_lock:
+                        self._hashes[upload_id] = (start + length - remaining, sha)
+            if remaining:
+                raise UploadError(f"Chunk ended {remaining} bytes early", offset=os.fstat(f.fileno()).st_size)
+        return self.info(upload_id)
+
+    def _running_hash(self, upload_id, offset):
+        """The running hash to continue at offset, or None if this process does not have one"""
+        with self._hashes_lock:
+            if offset == 0:
+                return hashlib.sha256()
+            hashed_to, sha = self._hashes.pop(upload_id, (None, None))
+            return sha if hashed_to == offset else None
+
+    def finish(self, upload_id, dest_path):
+        """
+        Move a complete upload to dest_path and end the session; returns the
+        session info with the upload's 'sha256'
+        """
+        info = self.info(upload_id)
+        if not info['complete']:
+            raise UploadError(f"Upload incomplete: {info['offset']} of {info['size']} bytes", status=409,
+                              offset=info['offset'])
+        meta_path, part_path = self._paths(upload_id)
+        with self._hashes_lock:
+            hashed_to, sha = self._hashes.pop(upload_id, (None, None))
+        if hashed_to != info['size']:
+            sha = hashlib.sha256()
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+                    sha.update(chunk)
+        os.replace(part_path, dest_path)
+        os.remove(meta_path)
+        return dict(info, sha256=sha.hexdigest())
+
+    def expire(self, max_age):
+        """Remove sessions that received no bytes for max_age seconds; returns (sessions, bytes) removed"""
+        removed, freed = 0, 0
+        cutoff = time.time() - max_age
+        for name in os.listdir(self.folder):
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json':
+                continue
+            try:
+                meta_path, part_path = self._paths(upload_id)
+            except UploadError:
+                continue
+            try:
+                last_write = max(os.path.getmtime(path) for path in (meta_path, part_path) if os.path.exists(path))
+                size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            except (OSError, ValueError):
+                continue
+            if last_write >= cutoff:
+                continue
+            for path in (part_path, meta_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            with self._hashes_lock:
+                self._hashes.pop(upload_id, None)
+            removed += 1
+            freed += size
+        return removed, freed
+
+    def abort(self, upload_id):
+        meta_path, part_path = self._paths(upload_id)
+        self._meta(upload_id)
+        with self._hashes_lock:
+            self._hashes.pop(upload_id, None)
+        for path in (part_path, meta_path):
+            if os.path.exists(path):
+                os.remove(path)
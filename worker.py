@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Pipeline worker host for the Football Penalty Analysis API
+
+Claims jobs from an API server's worker endpoints (/api/worker), runs them
+with MasterScript.process_job on warm worker processes and reports
+progress, heartbeats and results back. Add hosts to take on more uploads;
+the API server only queues them. A host that dies stops sending
+heartbeats, and the server puts its jobs back in the queue.
+
+Uploads and results live on storage shared with the API server: --root is
+the server's working folder (uploads/, Processed_Videos/, "Fbx Animations"
+and the classifier), e.g. an NFS mount. Job paths are relative to it.
+
+The server accepts worker hosts only when PENALTY_WORKER_TOKEN is set;
+give the same token with --token or the environment variable.
+
+Usage:
+    PENALTY_WORKER_TOKEN=... python worker.py --server http://192.168.18.10 --root /mnt/penalty [--processes 2]
+"""
+
+import argparse
+import os
+import socket
+import time
+import requests
+
+from job_queue import WorkerPool, HEARTBEAT_INTERVAL
+from log_utils import configure_logging
+
+WORKER_TOKEN_ENV = 'PENALTY_WORKER_TOKEN'
+
+
+class HTTPBroker:
+    """Claims, heartbeats and results of jobs through the API server's worker endpoints"""
+
+    def __init__(self, server_url, token=None):
+        self.server_url = server_url.rstrip('/')
+        self.session = requests.Session()
+        if token:
+            self.session.headers['X-Worker-Token'] = token
+
+    def _post(self, path, body, timeout=30):
+        return self.session.post(f"{self.server_url}/api/worker{path}", json=body, timeout=timeout)
+
+    def claim(self, worker_id):
+        response = self._post('/claim', {'worker_id': worker_id})
+        if response.status_code == 204:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def heartbeat(self, job_id, worker_id):
+        response = self._post(f"/jobs/{job_id}/heartbeat", {'worker_id': worker_id})
+        if response.status_code == 409:
+            return False
+        response.raise_for_status()
+        return True
+
+    def progress(self, job, event):
+        """Send a progress event (see progress.py), best effort"""
+        try:
+            self._post(f"/jobs/{job['task_id']}/progress", {'worker_id': job['claimed_by'], 'event': event},
+                       timeout=10)
+        except requests.exceptions.RequestException:
+            pass
+
+    def complete(self, job, manifest):
+        # The manifest was written to the shared folder; the server reads the results from it
+        path = manifest.path if manifest else None
+        self._report(job, 'complete', {'worker_id': job['claimed_by'], 'manifest': path})
+        print(f"Job {job['task_id']} done: {manifest.prediction if manifest else 'no results'}")
+
+    def fail(self, job, error):
+        self._report(job, 'fail', {'worker_id': job['claimed_by'], 'error': str(error)})
+        print(f"Job {job['task_id']} failed: {error}")
+
+    def _report(self, job, action, body):
+        try:
+            response = self._post(f"/jobs/{job['task_id']}/{action}", body, timeout=60)
+            if response.status_code == 409:
+                print(f"Job {job['task_id']} was requeued by the server, result dropped")
+                return
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            # The job's heartbeats stop, so the server requeues it
+            print(f"Could not report job {job['task_id']} to the server: {e}")
+
+
+# Broker and classifier of this worker process, set by init_remote_worker
+_broker = None
+_model_path = None
+
+
+def init_remote_worker(server_url, token, model_path):
+    """Pool initializer: MasterScript.init_worker plus a connection to the server for progress"""
+    global _broker, _model_path
+    from MasterScript import init_worker
+    _broker = HTTPBroker(server_url, token)
+    _model_path = model_path
+    init_worker(model_path)
+
+
+def run_remote_job(job):
+    from MasterScript import process_job
+    return process_job(job, progress_callback=lambda event: _broker.progress(job, event), model_path=_model_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Football Penalty Analysis API jobs on this host")
+    parser.add_argument("--server", default="http://192.168.18.10", help="API server URL (default: http://192.168.18.10)")
+    parser.add_argument("--root", default=".",
+                        help="The API server's working folder, shared with this host (default: current folder)")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes, i.e. jobs run at once (default: 1)")
+    parser.add_argument("--model", default="penalty_conv3d_model.h5",
+                        help="Classifier model, relative to --root (default: penalty_conv3d_model.h5)")
+    parser.add_argument("--token", default=os.environ.get(WORKER_TOKEN_ENV),
+                        help=f"Worker token of the server (default: ${WORKER_TOKEN_ENV})")
+    parser.add_argument("--poll-interval", type=float, default=2,
+                        help="Seconds between claims while the queue is empty (default: 2)")
+    args = parser.parse_args()
+    if not args.token:
+        parser.error(f"a worker token is required: --token or ${WORKER_TOKEN_ENV}")
+    configure_logging()
+
+    # Job paths (uploads/..., Processed_Videos/...) are relative to the server's folder
+    os.chdir(args.root)
+    server_url = args.server.rstrip('/')
+    broker = HTTPBroker(server_url, args.token)
+    worker_id = f"worker@{socket.gethostname()}:{os.getpid()}"
+    pool = WorkerPool(
+        broker,
+        run_remote_job,
+        workers=args.processes,
+        initializer=init_remote_worker,
+        initargs=(server_url, args.token, args.model),
+        on_start=lambda job: print(f"Running job {job['task_id']} ({job.get('original_filename')})"),
+        on_done=broker.complete,
+        on_error=broker.fail,
+        poll_interval=args.poll_interval,
+        heartbeat_interval=HEARTBEAT_INTERVAL,
+        worker_id=worker_id
+    )
+    pool.start()
+    print(f"Worker {worker_id}: {args.processes} processes in {os.getcwd()}, taking jobs from {server_url}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print("Stopping; jobs still running here are requeued by the server")
+
+
+if __name__ == "__main__":
+    main()